@@ -39,11 +39,10 @@ class BlocProjection():
         self.pplus = np.exp(E+dE - fast_logsumexp(E+dE)[0])  # modified probability distribution
         self.pminus = np.exp(E-dE - fast_logsumexp(E-dE)[0])  # modified probability distribution
 
-        self.pkplusdE = np.zeros(tanSpace.n//2+1)
-        self.pkminusdE = np.zeros(tanSpace.n//2+1)
-        for k in range(5):
-            self.pkplusdE[k] = self.pplus[np.abs(tanSpace.allStates.sum(1))==(self.n-k*2)].sum()
-            self.pkminusdE[k] = self.pminus[np.abs(tanSpace.allStates.sum(1))==(self.n-k*2)].sum()
+        # bin p(k) by the number of votes in the minority
+        self.kix = tanSpace.minority_size()
+        self.pkplusdE = np.bincount(self.kix, weights=self.pplus, minlength=self.n//2+1)
+        self.pkminusdE = np.bincount(self.kix, weights=self.pminus, minlength=self.n//2+1)
 
     def dlogp(self, k, run_checks=False):
         """Calculate change in log likelihood (or change in energy) when probability
@@ -68,30 +67,23 @@ class BlocProjection():
         
         assert (self.tanSpace.n//2)>=k>=1
         
-        # use symmetry to extract dissenting coalitions including flip symmetry
-        projVotes = np.vstack([i for i in self.tanSpace.allStates
-                               if abs(i.sum())==(self.n-k*2)]).astype(np.int64)
-        projVotes = [projVotes[[i,len(projVotes)-1-i],:] for i in range(len(projVotes)//2)]
-        namesInBlocs = [', '.join(np.sort(self.names[pv[0]==-np.sign(pv[0].sum())]))
-                       for pv in projVotes]
+        # use symmetry to extract dissenting coalitions including flip symmetry, where the
+        # states with the first spin down come first in the ordering of states
+        ix = np.flatnonzero(self.kix==k)
+        ix = ix[:ix.size//2]
+        projVotes = self.tanSpace.allStates[ix].astype(np.int64)
+        flipix = self.tanSpace.state_index(-projVotes)
+        minority = projVotes==-np.sign(projVotes.sum(1))[:,None]
+        namesInBlocs = [', '.join(np.sort(self.names[m])) for m in minority]
         if run_checks:
-            assert all([(pv[0]==-pv[1]).all() for pv in projVotes])
+            assert (self.tanSpace.allStates[flipix]==-projVotes).all()
+            assert (self.tanSpace.state_index(projVotes)==ix).all()
             assert all([len(i)==(2*k+k-1+k-1) for i in namesInBlocs])
 
         # get log likelihood ratios when the energy is changed along the chosen direction
-        logp = np.zeros(len(projVotes))
-        dlogp = np.zeros(len(projVotes))
-        for i,pv in enumerate(projVotes):
-            thisp = 0
-            thispplusdE = 0
-            thispminusdE = 0
-            for pv_ in pv:
-                ix = (self.tanSpace.allStates==pv_[None,:]).all(1)
-                thisp += self.tanSpace.p[ix]
-                thispplusdE += self.pplus[ix]
-                thispminusdE += self.pminus[ix]
-            logp[i] = np.log10(thisp)
-            dlogp[i] = (np.log10(thispplusdE) - np.log10(thispminusdE)) / (2*self.eps)
+        logp = np.log10(self.tanSpace.p[ix] + self.tanSpace.p[flipix])
+        dlogp = (np.log10(self.pplus[ix] + self.pplus[flipix]) -
+                 np.log10(self.pminus[ix] + self.pminus[flipix])) / (2*self.eps)
 
         return logp, dlogp, namesInBlocs
 #end BlocProjection
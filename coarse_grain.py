@@ -6,12 +6,87 @@ from .utils import *
 
 
 
-def p_k(X, weights=None, K=3):
+def state_counts(X, K):
+    """Number of components of each sample in each of the K states.
+
+    Parameters
+    ----------
+    X : ndarray
+        Samples of dimensions (n_samples, n) with states in {0,...,K-1}.
+    K : int
+
+    Returns
+    -------
+    ndarray
+        Counts of dimensions (n_samples, K).
+    """
+    
+    X = np.asarray(X)
+    K = int(K)
+    offset = K * np.arange(len(X))[:,None]
+    return np.bincount((X + offset).ravel(), minlength=len(X)*K).reshape(len(X), K)
+
+def _iter_chunks(X, weights, chunk_size):
+    """Iterate through blocks of rows of X and weights. Only the block being used is read
+    into memory, so X can be a memory-mapped array."""
+
+    if chunk_size is None:
+        chunk_size = max(len(X), 1)
+    for i in range(0, len(X), chunk_size):
+        yield (np.asarray(X[i:i+chunk_size]),
+               None if weights is None else np.asarray(weights[i:i+chunk_size]))
+
+def _sum_by_key(chunks, n_keys):
+    """Number of samples and total weight for each key accumulated over chunks.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Of (keys, weights) where weights can be None.
+    n_keys : int
+        Keys are in {0,...,n_keys-1}. When this is small, keys are binned directly.
+
+    Returns
+    -------
+    ndarray
+        Unique keys in ascending order.
+    ndarray
+        Number of samples for each key.
+    ndarray
+        Total weight for each key. Equal to the number of samples if no weights are given.
+    """
+    
+    if n_keys<=2**24:
+        counts = np.zeros(n_keys, dtype=int)
+        w = np.zeros(n_keys)
+        for keys, weights in chunks:
+            counts += np.bincount(keys, minlength=n_keys)
+            w += np.bincount(keys, weights=weights, minlength=n_keys)
+        uniq = np.nonzero(counts)[0]
+        return uniq, counts[uniq], w[uniq]
+
+    # sparse keys are merged with the keys seen so far
+    uniq = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=int)
+    w = np.zeros(0)
+    for keys, weights in chunks:
+        if weights is None:
+            weights = np.ones(len(keys))
+        uniq, ix = np.unique(np.concatenate((uniq, keys)), return_inverse=True)
+        counts = np.bincount(ix, weights=np.concatenate((counts, np.ones(len(keys)))),
+                             minlength=uniq.size).astype(int)
+        w = np.bincount(ix, weights=np.concatenate((w, weights)), minlength=uniq.size)
+    return uniq, counts, w
+
+def p_k(X, weights=None, K=3, chunk_size=None):
     """From sample of K-Potts states, calculate probability distribution over
     coarse-graining of unique state counts. 
 
     K=3 is what is used in large_fim.Coupling3.
 
+    Each sample is mapped to the index of its partition with PartitionIndex and the
+    weights are summed over partitions with bincount.
+
     Parameters
     ----------
     X : ndarray
@@ -21,6 +96,9 @@ def p_k(X, weights=None, K=3):
     K : int, 3
         3 for 3-state Potts model. Assuming states are as {0,1,2}.
         2 for regular binary Ising model. Assuming states are as {0,1}.
+    chunk_size : int, None
+        If given, process X in blocks of this many rows such that X can be a memory-mapped
+        array larger than memory.
 
     Returns
     -------
@@ -31,26 +109,16 @@ def p_k(X, weights=None, K=3):
     """
     
     assert K>1
-    assert set(np.unique(X)) <= frozenset((list(range(K))))
-   
-    counts = np.zeros((len(X), K), dtype=int)
-    for k in range(K):
-        counts[:,k] = (X==k).sum(1)
-    # sort by order so that the only thing that distinguishes rows is the total
-    # no. in each bin
-    counts = np.sort(counts, axis=1)[:,::-1]
-
-    if weights is None:
-        bins, p = np.unique(counts, axis=0, return_counts=True)
-        p = p / p.sum()
-    else:
-        bins, ix, p = np.unique(counts, axis=0, return_counts=True, return_inverse=True)
-        summedWeights = np.zeros(p.size)
-        for i in range(ix.max()+1):
-            summedWeights[i] += weights[ix==i].sum() / (ix==i).sum()
-        p = p * summedWeights / p.dot(summedWeights)
+    index = PartitionIndex(X.shape[1], K)
 
-    return p, bins
+    def keys():
+        for X_, weights_ in _iter_chunks(X, weights, chunk_size):
+            assert ((X_>=0) & (X_<K)).all()
+            yield index.state_index(X_), weights_
+    
+    uniq, counts, w = _sum_by_key(keys(), len(index))
+    p = w / w.sum()
+    return p, index.unrank(uniq)
 
 def enumerate_unique_splits(n, K=3):
     """Iterate through unique binnings of neurons for K-state Potts model. See
@@ -65,75 +133,50 @@ def enumerate_unique_splits(n, K=3):
     Returns
     -------
     ndarray
+        Splits with the largest group first in decreasing lexicographic order.
     """
     
-    assert K in (2,3)
-
-    splits = np.zeros((count_unique_splits(n, K), K), dtype=int)
-
-    if K==3:
-        s = 0  # keep track of arrangements as we iterate through them
-        for i in range(n, n//3-(n%3)==0, -1):
-            n1 = min(n - i, i)
-            for j in range(n1, n1//2-1, -1):
-                k = n - i - j
-                if k<=j:
-                    splits[s] = i, j, k
-                    s += 1
-    elif K==2:
-        counter = 0
-        for i in range(n, int(np.ceil(n/2))-1, -1):
-            splits[counter] = i, n-i
-            counter += 1
-    return splits
+    return PartitionIndex(n, K).splits()[::-1]
  
 def count_unique_splits(n, K=3):
-    """Count number of unique binnings of neurons for k=3 Potts model.
+    """Count number of unique binnings of neurons for K-state Potts model.
 
-    Imagine binning the neurons into 3 groups. The only thing that matters is how many are
+    Imagine binning the neurons into K groups. The only thing that matters is how many are
     in each group. Obviously, only the number of neurons in each group matters, not which
     neuron is in which group. Furthermore, we only care about the numbers in each
     partition, and not the order in which the partitions are lined up.
     
     Thus, we can imagine taking the largest plurality first. This must be equal to or
-    larger than N/3. Then, the second group must be equal to or larger than the last
-    group. So we must iterate through N-i down to (N-i)/2. The number in the last
-    partition is given by the previous two partitions.
+    larger than N/K. Then, the second group must be equal to or larger than the next
+    group and so on. The number in the last partition is given by the previous
+    partitions. See PartitionIndex.
     
     Parameters
     ----------
     n : int
+    K : int, 3
 
     Returns
     -------
     int
     """
     
-    assert K in (2,3)
-
-    if K==2:
-        return int(n//2) + 1
-
-    elif K==3:
-        s = 0  # keep track of arrangements as we iterate through them
-        for i in range(n, n//3-(n%3)==0, -1):
-            n1 = min(n - i, i)
-            for j in range(n1, n1//2-1, -1):
-                k = n - i - j
-                if k<=j:
-                    s += 1
-        return s
-
-def p_maj(X, weights=None):
+    return len(PartitionIndex(n, K))
+
+def p_maj(X, weights=None, chunk_size=None):
     """Coarse-grained probability distribution only considering the probability of k votes
     in the plurality.
 
     Parameters
     ----------
     X : ndarray
+        Samples with states as nonnegative integers.
     weights : ndarray, None
         Relative weights for each element given in X. This does not have to be normalized
         to one.
+    chunk_size : int, None
+        If given, process X in blocks of this many rows such that X can be a memory-mapped
+        array larger than memory.
 
     Returns
     -------
@@ -143,16 +186,174 @@ def p_maj(X, weights=None):
         Bins.
     """
     
-    counts = np.array([np.bincount(row).max() for row in X])
-
-    if weights is None:
-        bins, p = np.unique(counts, return_counts=True)
-        p = p / p.sum()
-    else:
-        bins, ix, p = np.unique(counts, return_counts=True, return_inverse=True)
-        summedWeights = np.zeros(p.size)
-        for i in range(ix.max()+1):
-            summedWeights[i] += weights[ix==i].sum() / (ix==i).sum()
-        p = p * summedWeights / p.dot(summedWeights)
+    def keys():
+        for X_, weights_ in _iter_chunks(X, weights, chunk_size):
+            yield state_counts(X_, X_.max()+1).max(1), weights_
 
+    bins, counts, w = _sum_by_key(keys(), X.shape[1]+1)
+    p = w / w.sum()
     return p, bins
+
+
+
+# ======= #
+# Classes #
+# ======= #
+class PartitionIndex():
+    """Index of the partitions of n components into K states where only the number of
+    components in each state matters and not which state is which. Each partition is
+    represented by its counts sorted in decreasing order, and partitions are ranked in
+    increasing lexicographic order of these count vectors, the same order as
+    np.unique(counts, axis=0).
+
+    Ranking and unranking use a precomputed table of the number of ways of completing a
+    count vector given its prefix, so neither requires enumerating partitions.
+    """
+    def __init__(self, n, K):
+        """
+        Parameters
+        ----------
+        n : int
+        K : int
+        """
+
+        assert n>=1 and K>=2
+        self.n = n
+        self.K = K
+        
+        # N[L,m,t] is the number of nonincreasing sequences of length L with entries <= m
+        # that sum to t
+        N = np.zeros((K, n+1, n+1), dtype=np.int64)
+        N[0,:,0] = 1
+        for L in range(1, K):
+            N[L,0] = N[L-1,0]
+            for m in range(1, n+1):
+                N[L,m] = N[L,m-1]
+                N[L,m,m:] += N[L-1,m,:n+1-m]
+        
+        # C[L,t,v] is the number of sequences with total t that start with an entry less
+        # than v followed by L entries
+        v = np.arange(n+1)
+        t = np.arange(n+1)[:,None]
+        F = np.where(v[None,:]<=t, N[:,v[None,:],np.clip(t-v[None,:], 0, n)], 0)
+        self._C = np.concatenate((np.zeros((K,n+1,1), dtype=np.int64), np.cumsum(F, axis=2)),
+                                 axis=2)
+        self._C.setflags(write=False)
+
+    def __len__(self):
+        return int(self._C[self.K-1,self.n,-1])
+
+    def rank(self, counts):
+        """Index of each partition.
+
+        Parameters
+        ----------
+        counts : ndarray
+            Count vectors sorted in decreasing order of dimensions (n_samples, K).
+
+        Returns
+        -------
+        ndarray
+            Indices.
+        """
+        
+        counts = np.atleast_2d(counts)
+        assert counts.shape[1]==self.K
+        ix = np.zeros(len(counts), dtype=np.int64)
+        remaining = np.zeros(len(counts), dtype=np.int64) + self.n
+        for j in range(self.K-1):
+            ix += self._C[self.K-1-j, remaining, counts[:,j]]
+            remaining -= counts[:,j]
+        return ix
+
+    def unrank(self, ix):
+        """Count vector sorted in decreasing order for each index.
+
+        Parameters
+        ----------
+        ix : ndarray
+
+        Returns
+        -------
+        ndarray
+            Counts of dimensions (len(ix), K).
+        """
+        
+        ix = np.array(ix, dtype=np.int64, ndmin=1)
+        assert ((ix>=0) & (ix<len(self))).all()
+        counts = np.zeros((len(ix), self.K), dtype=int)
+        remaining = np.zeros(len(ix), dtype=np.int64) + self.n
+        for j in range(self.K-1):
+            C = self._C[self.K-1-j, remaining]
+            counts[:,j] = (C[:,:-1]<=ix[:,None]).sum(1) - 1
+            ix = ix - C[np.arange(len(ix)), counts[:,j]]
+            remaining -= counts[:,j]
+        counts[:,-1] = remaining
+        return counts
+
+    def splits(self):
+        """All partitions in order of their index.
+
+        Returns
+        -------
+        ndarray
+            Counts of dimensions (len(self), K).
+        """
+
+        return self.unrank(np.arange(len(self)))
+
+    def state_index(self, X):
+        """Partition index of each state.
+
+        Parameters
+        ----------
+        X : ndarray
+            States in {0,...,K-1} of dimensions (n_samples, n).
+
+        Returns
+        -------
+        ndarray
+        """
+        
+        return self.rank(np.sort(state_counts(X, self.K), axis=1)[:,::-1])
+
+    def all_states_index(self):
+        """Partition index of all K^n states in the order where the first component is the
+        most significant digit of the state index in base K, as for bin_states() and
+        xpotts_states(). The counts are built up one component at a time without listing
+        the states.
+
+        Returns
+        -------
+        ndarray
+        """
+        
+        K = self.K
+        counts = np.zeros((1,K), dtype=np.int16)
+        for i in range(self.n):
+            counts = np.concatenate([counts + (np.arange(K)==d) for d in range(K)])
+        return self.rank(np.sort(counts, axis=1)[:,::-1])
+
+    def coarse_index(self, X=None):
+        """Indices of partitions that appear in the states of X and the index into them of
+        each state, equivalent to np.unique on the sorted counts of each state.
+
+        Parameters
+        ----------
+        X : ndarray, None
+            States. If None, all K^n states as in all_states_index().
+
+        Returns
+        -------
+        ndarray
+            Unique indices, which run from 0 to the number of partitions that appear.
+        ndarray
+            Inverse indices for each state.
+        """
+        
+        ix = self.all_states_index() if X is None else self.state_index(X)
+        # relabel partitions such that only those that appear are counted
+        present = np.bincount(ix, minlength=len(self))>0
+        invix = (np.cumsum(present)-1)[ix]
+        return np.arange(present.sum()), invix
+#end PartitionIndex
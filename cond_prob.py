@@ -1,21 +1,30 @@
 # Author: Eddie Lee, edl56@cornell.edu
 import numpy as np
-from misc.utils import unique_rows
 from uuid import uuid4
 import pickle
 import os
 
 
 def calc_p_S_given_case(X, issue, issueTable, solver,
-                        sample_size=1000):
+                        sample_size=1000,
+                        n_cpus=None,
+                        seed=None,
+                        exact_max_free=12,
+                        checkpoint=None):
     """
-    Calculate the probability of a super vote for a particular case. This means taking p(S|s) 
-    for the subset that we have votes for for that particular issue and then averaging over 
+    Calculate the probability of a super vote for a particular case. This means taking p(S|s)
+    for the subset that we have votes for for that particular issue and then averaging over
     all s that correspond to the issue, i.e. p(S|case) = sum_s p(S|s)*p(s|case)
-    
+
     Instead of iterating through all states which is much more memory expensive, I just sample
-    from p(S|s) to estimate p(S|case).
-    
+    from p(S|s) to estimate p(S|case). When the number of free spins for a condition is
+    small, p(S|s) is instead calculated exactly by enumerating the free spins.
+
+    Conditions are farmed out to workers, each with its own RNG stream spawned from the same
+    SeedSequence such that the result does not depend on the number of cpus. States are
+    packed into integer keys, and the result for each condition is appended to a checkpoint
+    file as it arrives.
+
     Parameters
     ----------
     X : ndarray
@@ -26,6 +35,17 @@ def calc_p_S_given_case(X, issue, issueTable, solver,
         This will be used to sample.
     sample_size : int
         Size of the sample.
+    n_cpus : int, None
+        If None, all cpus are used. If 1, run serially.
+    seed : int or np.random.SeedSequence, None
+    exact_max_free : int, 12
+        Conditions with at most this many free spins are enumerated exactly.
+    checkpoint : str, None
+        Path of append-only checkpoint. If it exists, conditions that were already
+        calculated are read from it and skipped. The checkpoint starts with a hash of the
+        inputs, and resuming from a checkpoint written for different inputs (including the
+        seed, which must be given to resume) is refused. If None, a temporary file in
+        cache/ is used and removed at the end.
 
     Returns
     -------
@@ -36,67 +56,212 @@ def calc_p_S_given_case(X, issue, issueTable, solver,
     """
 
     from coniii.utils import state_probs
-    
-    tmpfile = 'cache/%s.p'%str(uuid4())
+    from multiprocess import Pool, cpu_count
+    from threadpoolctl import threadpool_limits
+
+    if checkpoint is None:
+        tmpfile = 'cache/%s.p'%str(uuid4())
+    else:
+        tmpfile = checkpoint
+    n = X.shape[1]
+    assert n<63, "States cannot be packed into int64 keys."
 
     # Get all states that correspond to this issue, but only keep track of the unique states.
     issueix = np.where(issueTable==issue)[0]
     datap, uniqStates = state_probs(X[issueix])
     print("Iterating over %d unique states instead of all %d states."%(len(uniqStates),len(issueix)))
-    
-    # Iterate through all unique votes for this issue and generate samples from the conditional
-    # distribution of the Super Court where the subset s is fixed.
-    condSampleP = []
-    condSampleUniqStates = []
-    toRemoveIx = np.zeros((len(uniqStates)), dtype=bool)
-    for i,s in enumerate(uniqStates):
-        if np.any(s):
-            # Use Bayes' rule for calculation of P(S|s).
-            fixedSpins = [(nonzeroix,s[nonzeroix]) for nonzeroix in np.where(s!=0)[0]]
-            solver.sampler.generate_cond_samples(sample_size, fixedSpins, burn_in=1000, parallel=True)
-            # symmetrize (assuming of course that the given data set has not been symmetrized)
-            condSample = np.vstack((solver.sampler.samples, -solver.sampler.samples))
-
-            # for each condition, compress the probability distrib
-            uniqinvix = unique_rows(condSample, return_inverse=True)
-            uniqix = unique_rows(condSample)
-            condp = np.bincount(uniqinvix).astype(float)
-            condp /= condp.sum()
-            # weight distrib by prob of the condition
-            condSampleP.append( condp )
-            condSampleUniqStates.append( condSample[uniqix].astype(int) )
-
-            # save results just in case of error
-            pickle.dump({'condSampleUniqStates':condSampleUniqStates, 'condSampleP':condSampleP},
-                        open(tmpfile,'wb'), -1)
-        else:
-            # Remove any empty votes
-            toRemoveIx[i] = True
 
+    # Remove any empty votes
+    toRemoveIx = ~np.any(uniqStates, axis=1)
     if toRemoveIx.any():
         datap = datap[toRemoveIx==0]
         datap /= datap.sum()
         uniqStates = uniqStates[toRemoveIx==0]
         print("Removed %d states"%toRemoveIx.sum())
 
-    # weight the distributions by the prob of the condition
-    condSampleP = [p*datap[i] for i,p in enumerate(condSampleP)]
+    # each condition gets its own stream regardless of which worker handles it
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    streams = seed.spawn(len(uniqStates))
+
+    # load conditions that were already calculated for the same inputs
+    header = _checkpoint_header(uniqStates, datap, sample_size, seed, exact_max_free)
+    results = {}
+    if os.path.isfile(tmpfile):
+        fileHeader, results = _read_checkpoint(tmpfile)
+        assert fileHeader is None or fileHeader==header, \
+                "Checkpoint %s was written for different inputs."%tmpfile
+    todo = [i for i in range(len(uniqStates)) if not i in results]
 
-    # combine cond samples into a single reweighted distribution
-    sample = np.vstack(condSampleUniqStates)
-    samplep = np.concatenate(condSampleP)
+    def cond_dist(i, solver=solver, sample_size=sample_size):
+        # Iterate through all unique votes for this issue and generate samples from the
+        # conditional distribution of the Super Court where the subset s is fixed.
+        s = uniqStates[i]
+        if (s==0).sum()<=exact_max_free:
+            keys, condp = _exact_cond_dist(s, solver.sampler)
+        else:
+            # Use Bayes' rule for calculation of P(S|s).
+            fixedSpins = [(nonzeroix,s[nonzeroix]) for nonzeroix in np.where(s!=0)[0]]
+            solver.sampler.rng = np.random.RandomState(np.random.MT19937(streams[i]))
+            solver.sampler.generate_cond_samples(sample_size, fixedSpins, burn_in=1000,
+                                                 parallel=False)
+            # for each condition, compress the probability distrib
+            keys, counts = np.unique(pack_states(solver.sampler.samples), return_counts=True)
+            condp = counts / counts.sum()
+
+        # symmetrize (assuming of course that the given data set has not been symmetrized)
+        keys = np.concatenate((keys, 2**n-1-keys))
+        condp = np.concatenate((condp, condp)) / 2
+        return i, keys, condp
+
+    # save results as they come in just in case of error
+    with open(tmpfile, 'ab') as f:
+        if f.tell()==0:
+            pickle.dump(('header', header), f, -1)
+            f.flush()
+        if n_cpus==1 or len(todo)<=1:
+            for i in todo:
+                results[i] = _append_checkpoint(f, cond_dist(i))
+        else:
+            with threadpool_limits(limits=1, user_api='blas'):
+                with Pool(min(n_cpus or cpu_count(), len(todo))) as pool:
+                    for r in pool.imap_unordered(cond_dist, todo):
+                        results[r[0]] = _append_checkpoint(f, r)
+
+    # weight the distributions by the prob of the condition and combine cond samples into a
+    # single reweighted distribution by combining probabilities of states that are duplicates
+    keys = np.concatenate([results[i][0] for i in range(len(uniqStates))])
+    samplep = np.concatenate([results[i][1]*datap[i] for i in range(len(uniqStates))])
     assert np.isclose(samplep.sum(), 1)
-    assert len(sample)==len(samplep)
-    
-    # compress combined sample by combining probabilities of states that are duplicates
-    uinvix = unique_rows(sample, return_inverse=True)
-    usample = sample[unique_rows(sample)]
-
-    combsamplep = np.zeros(len(usample))
-    for i,ix in enumerate(np.unique(uinvix)):
-        combsamplep[i] = samplep[uinvix==ix].sum()
+
+    ukeys, uinvix = np.unique(keys, return_inverse=True)
+    combsamplep = np.bincount(uinvix.ravel(), weights=samplep, minlength=ukeys.size)
     assert np.isclose(combsamplep.sum(), 1), combsamplep.sum()
-    
+
     # clean up
-    os.remove(tmpfile)
-    return combsamplep, usample
+    if checkpoint is None:
+        os.remove(tmpfile)
+    return combsamplep, unpack_states(ukeys, n)
+
+def pack_states(X):
+    """Pack states in {-1,1} basis into int64 keys where the first spin is the most
+    significant bit.
+
+    Parameters
+    ----------
+    X : ndarray
+        (n_samples, n)
+
+    Returns
+    -------
+    ndarray
+    """
+
+    n = X.shape[1]
+    return (X>0).astype(np.int64).dot(2**np.arange(n-1, -1, -1, dtype=np.int64))
+
+def unpack_states(keys, n):
+    """Inverse of pack_states().
+
+    Parameters
+    ----------
+    keys : ndarray
+    n : int
+
+    Returns
+    -------
+    ndarray
+        (n_samples, n) in {-1,1} basis.
+    """
+
+    return ((keys[:,None]>>np.arange(n-1, -1, -1, dtype=np.int64)[None,:])&1).astype(int)*2-1
+
+def _exact_cond_dist(s, sampler):
+    """Conditional distribution over all states that agree with the nonzero spins of s.
+
+    Parameters
+    ----------
+    s : ndarray
+        Partial vote with nonvotes=0.
+    sampler : coniii.samplers.Sampler
+        Must have calc_e and theta.
+
+    Returns
+    -------
+    ndarray
+        Packed keys of states.
+    ndarray
+        Conditional probabilities.
+    """
+
+    from coniii.utils import bin_states
+    from coniii.enumerate import fast_logsumexp
+
+    free = np.where(s==0)[0]
+    states = np.tile(s.astype(np.int64), (2**free.size,1))
+    states[:,free] = bin_states(free.size, True)
+    E = -sampler.calc_e(states, sampler.theta)
+    return pack_states(states), np.exp(E - fast_logsumexp(E)[0])
+
+def _checkpoint_header(uniqStates, datap, sample_size, seed, exact_max_free):
+    """Hash of the inputs that determine the result for each condition.
+
+    Parameters
+    ----------
+    uniqStates : ndarray
+    datap : ndarray
+    sample_size : int
+    seed : np.random.SeedSequence
+    exact_max_free : int
+
+    Returns
+    -------
+    str
+    """
+
+    import hashlib
+    h = hashlib.sha1(repr((sample_size, exact_max_free, seed.entropy, seed.spawn_key,
+                           uniqStates.shape)).encode())
+    h.update(np.ascontiguousarray(uniqStates, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(datap, dtype=float).tobytes())
+    return h.hexdigest()
+
+def _append_checkpoint(f, result):
+    i, keys, condp = result
+    pickle.dump((i, keys, condp), f, -1)
+    f.flush()
+    return keys, condp
+
+def _read_checkpoint(fname):
+    """Read records from append-only checkpoint. A record that was incompletely written
+    is truncated from the file such that new records can be appended.
+
+    Parameters
+    ----------
+    fname : str
+
+    Returns
+    -------
+    str
+        Header hash of inputs or None if there is no complete header.
+    dict
+        Keys and probabilities for each condition index.
+    """
+
+    header = None
+    results = {}
+    with open(fname, 'r+b') as f:
+        pos = 0
+        while True:
+            try:
+                record = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                break
+            if record[0]=='header':
+                header = record[1]
+            else:
+                i, keys, condp = record
+                results[i] = keys, condp
+            pos = f.tell()
+        f.truncate(pos)
+    return header, results
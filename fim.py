@@ -4,13 +4,13 @@
 # ====================================================================================== #
 from .utils import *
 
-import importlib
 from itertools import combinations, product
-from coniii.enumerate import fast_logsumexp, mp_fast_logsumexp
+from coniii.enumerate import fast_logsumexp
 from coniii.utils import define_ising_helper_functions
 from multiprocess import Pool, cpu_count
 from scipy.sparse import coo_matrix
 from . import mvm
+from .models import ExactIsing, ExactPotts
 
 calc_e, _, _ = define_ising_helper_functions()
 np.seterr(divide='ignore')
@@ -53,10 +53,7 @@ class Magnetization():
         self.n_cpus = n_cpus
         self.high_prec = high_prec
 
-        if high_prec: 
-            self.ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym_hp'%n)
-        else:
-            self.ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%n)
+        self.ising = ExactIsing(n)
         self.sisj = self.ising.calc_observables(self.hJ)
         self.p = self.ising.p(self.hJ)
         self.allStates = bin_states(n, True).astype(int)
@@ -310,9 +307,11 @@ class Magnetization():
             # factor out linear dependence on eps
             try:
                 if self.high_prec:
-                    A = mp.matrix(A)
-                    C = mp.matrix(C)
-                    dJ = A**-1 * C / eps
+                    from .utils import refined_solve
+                    # perturbed observables are affine in eps, so the change per unit
+                    # eps is taken at eps=1 to avoid cancellation in C-sisj
+                    dC = self.observables_after_perturbation(iStar, eps=1)[0] - self.sisj
+                    dJ = refined_solve(A, dC)
                 else:
                     dJ = np.linalg.solve(A,C)/eps
             except np.linalg.LinAlgError:
@@ -331,18 +330,13 @@ class Magnetization():
                                                                       p=p,
                                                                       sisj=np.concatenate((si,sisj)))
             # print if relative change is more than .1% for any entry
-            if self.high_prec:
-                relerr = (list(map(mp.log10, np.abs(dJ-dJtwiceEps))) -
-                          np.array(list(map(mp.log10, np.abs(dJ)))))
-            else:
-                relerr = np.log10(np.abs(dJ-dJtwiceEps))-np.log10(np.abs(dJ))
+            relerr = np.log10(np.abs(dJ-dJtwiceEps))-np.log10(np.abs(dJ))
             if (relerr>-3).any():
                 print("Unstable solution. Recommend shrinking eps. %E"%(10**relerr.max()))
         else:
             relerr = None
                    
-        if ((self.high_prec and mp.norm(A)*mp.norm(A**-1)>1e15) or
-            (not self.high_prec and np.linalg.cond(A)>1e15)):
+        if np.linalg.cond(A)>1e15:
             warn("A is badly conditioned.")
             errflag = 1
         else:
@@ -351,6 +345,19 @@ class Magnetization():
             return dJ, errflag, (A, C), relerr
         return dJ, errflag
     
+    def all_observables(self):
+        """Means and pairwise correlations of every state in the same order as the
+        parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_states, n_parameters)
+        """
+        
+        ix = np.triu_indices(self.n, k=1)
+        return np.hstack((self.allStates, self.allStates[:,ix[0]]*self.allStates[:,ix[1]])).astype(float)
+
     def dkl_curvature(self, *args, **kwargs):
         """Wrapper for _dkl_curvature() to find best finite diff step size."""
 
@@ -544,50 +551,90 @@ class Magnetization():
         return logsumEk
 
     @staticmethod
-    def p2pk_high_prec(p, uix, invix):
-        """Convert the full probability distribution to the probability of having k votes
-        in the majority. Assuming that n is odd.
+    def dkl_pk_high_prec(p, dnegE, uix, invix, pk=None, order=None):
+        """KL divergence in bits from p(k) to the p(k) after a perturbation to the
+        parameters that changes the negative energy of every state by dnegE.
 
-        High precision version (p is an array of mp.mpf types).
+        Instead of comparing two separately normalized distributions, the change in
+        log p(k) is computed directly in the log domain as
+            log1p(<expm1(dnegE)>_k) - log1p(<expm1(dnegE)>),
+        and the divergence is summed as sum_k p(k) * (exp(x_k) - 1 - x_k), which has no
+        cancellation between terms. Sums are in double-double precision and are taken over
+        all groups at once with utils.segment_dd_sum.
 
         Parameters
         ----------
         p : ndarray
+            Probability of every state.
+        dnegE : ndarray
+            Change in negative energy of every state.
+        uix : ndarray
+        invix : ndarray
+        pk : ndarray, None
+            p(k), which only depends on the model and can be computed once.
+        order : ndarray, None
+            np.argsort(invix, kind='stable'), which can be computed once.
 
         Returns
         -------
-        ndarray
-            p(k)
+        float
         """
         
-        pk = np.zeros(len(uix), dtype=object)
-        for i in range(len(uix)):
-            pk[i] = p[invix==i].sum()
-
-        return pk
-
-    @staticmethod
-    def logp2pk_high_prec(E, uix, invix):
-        """Convert the full probability distribution to the probability of having k votes
-        in the majority.
+        from .utils import dd_sum, expm1mx, segment_dd_sum
+
+        # p*expm1(dnegE) in the log domain so that large changes to improbable states
+        # do not overflow
+        absw = np.where(dnegE>1,
+                        dnegE + np.log1p(-np.exp(-np.abs(dnegE))),
+                        np.log(np.abs(np.expm1(np.minimum(dnegE, 1)))))
+        w = np.sign(dnegE) * np.exp(np.log(p) + absw)
+        if order is None:
+            order = np.argsort(invix, kind='stable')
+        if pk is None:
+            pk = segment_dd_sum(p, invix, len(uix), order)
+        wk = segment_dd_sum(w, invix, len(uix), order)
+        nonzero = pk>0
+        dlogpk = np.log1p(wk[nonzero] / pk[nonzero]) - np.log1p(dd_sum(w))
+        return dd_sum(pk[nonzero] * expm1mx(dlogpk)) / np.log(2)
+
+    def model_stats(self, hJ=None):
+        """Energies of all states, the log partition function, and the unnormalized log
+        p(k) for the given parameters.
+
+        These are memoized on the model with a hash of the parameters and of the coarse
+        graining, so the many calls with the same parameters, e.g. from the step size
+        search in maj_curvature(), share a single calculation.
 
         Parameters
         ----------
-        E : ndarray
-            Energies of each configuration.
-        uix : ndarray
-        invix : ndarray
+        hJ : ndarray, None
+            By default, the parameters of the model.
 
         Returns
         -------
         ndarray
-            The unnormalized log probability: log p(k) + logZ.
+            Energies of all states (read only).
+        float
+            logZ
+        ndarray
+            log p(k) + logZ (read only).
         """
-         
-        logsumEk = np.zeros(len(uix), dtype=object)
-        for i in range(len(uix)):
-            logsumEk[i] = mp_fast_logsumexp(-E[invix==i])[0]
-        return logsumEk
+        
+        from .utils import ParameterCache
+
+        if hJ is None:
+            hJ = self.hJ
+        hJ = np.asarray(hJ, dtype=np.float64)
+        if not '_statsCache' in self.__dict__.keys():
+            self._statsCache = ParameterCache()
+        
+        def calc(hJ=hJ):
+            E = calc_all_energies(self.n, self.kStates, hJ)
+            logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+            E.flags.writeable = False
+            logsumEk.flags.writeable = False
+            return E, fast_logsumexp(-E)[0], logsumEk
+        return self._statsCache.get(calc, hJ, self.coarseInvix)
 
     def maj_curvature(self, *args, **kwargs):
         """Wrapper for _maj_curvature() to find best finite diff step size."""
@@ -693,9 +740,7 @@ class Magnetization():
         n = self.n
         if hJ is None:
             hJ = self.hJ
-        E = calc_all_energies(n, self.kStates, hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats(hJ)
         p = np.exp(logsumEk - logZ)
         assert np.isclose(p.sum(),1), p.sum()
         if dJ is None:
@@ -818,9 +863,7 @@ class Magnetization():
     def _test_maj_curvature(self):
         n = self.n
         hJ = self.hJ
-        E = calc_all_energies(n, self.kStates, hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats(hJ)
         p = np.exp(logsumEk - logZ)
         dJ = self.dJ
 
@@ -863,13 +906,15 @@ class Magnetization():
                                  n_cpus=None,
                                  check_stability=False,
                                  rtol=1e-3,
-                                 full_output=False,
-                                 dps=20):
+                                 full_output=False):
         """Calculate the hessian of the KL divergence (Fisher information metric) w.r.t.
         the theta_{ij} parameters replacing the spin i by sampling from j for the number
         of k votes in the majority.
 
-        Use single step finite difference method to estimate Hessian.
+        Use single step finite difference method to estimate Hessian. Perturbations are
+        applied to the energies directly and divergences are calculated in the log
+        domain with compensated sums (see dkl_pk_high_prec), which avoids the round off
+        error in comparing two nearly identical distributions.
         
         Parameters
         ----------
@@ -885,7 +930,6 @@ class Magnetization():
         rtol : float, 1e-3
             Relative tolerance for each entry in Hessian when checking stability.
         full_output : bool, False
-        dps : int, 20
             
         Returns
         -------
@@ -898,68 +942,49 @@ class Magnetization():
             Norm difference between hessian with step size eps and eps/2.
         """
         
-        import mpmath as mp
-        mp.mp.dps = dps
-
-        mplog2_ = lambda x:mp.log(x)/mp.log(2)
-        mplog2 = lambda x: list(map(mplog2_, x))
         n = self.n
+        if n_cpus is None:
+            n_cpus = self.n_cpus
         if hJ is None:
             hJ = self.hJ
-        p = self.p2pk_high_prec(self.ising.p(hJ), self.coarseUix, self.coarseInvix)
-        log2p = np.array(mplog2(p))
+            p = self.p
+        else:
+            p = self.ising.p(hJ)
         if dJ is None:
             dJ = self.dJ
+        # change in negative energy of each state is linear in the change in parameters
+        X = self.all_observables()
+        # p(k) and the grouping of states are shared by all entries
+        from functools import partial
+        from .utils import segment_dd_sum
+        uix, invix = self.coarseUix, self.coarseInvix
+        order = np.argsort(invix, kind='stable')
+        pk = segment_dd_sum(p, invix, len(uix), order)
+        dkl = partial(self.dkl_pk_high_prec, uix=uix, invix=invix, pk=pk, order=order)
+        # step in each direction (no rounding to machine precision is necessary because
+        # the parameters themselves are never shifted)
+        epsdJ_ = epsdJ/2
 
         def diag(i,
-                 hJ=hJ,
-                 ising=self.ising,
                  dJ=dJ,
                  p=p,
-                 p2pk=self.p2pk_high_prec,
-                 uix=self.coarseUix,
-                 invix=self.coarseInvix):
-            # round epsdJ_ to machine precision
-            mxix = np.argmax(np.abs(dJ[i]))
-            newhJ = hJ[mxix] + dJ[i][mxix]*epsdJ
-            epsdJ_ = (newhJ - hJ[mxix]) / dJ[i][mxix] / 2
-            if np.isnan(epsdJ_): return 0.
-
-            newhJ = hJ + dJ[i]*epsdJ_
-            modp = p2pk(ising.p(newhJ), uix, invix)
-            dklplus = 2*(log2p-mplog2(modp)).dot(p)
-
-            newhJ -= 2*dJ[i]*epsdJ_
-            modp = p2pk(ising.p(newhJ), uix, invix)
-            dklminus = 2*(log2p-mplog2(modp)).dot(p)
-
+                 X=X,
+                 dkl=dkl):
+            dnegE = X.dot(dJ[i]) * epsdJ_
+            dklplus = 2*dkl(p, dnegE)
+            dklminus = 2*dkl(p, -dnegE)
             return (dklplus+dklminus) / 2 / epsdJ_**2
 
         # theta_j+del) to second order.
         def off_diag(args,
-                     hJ=hJ,
-                     ising=self.ising,
-                     p2pk=self.p2pk_high_prec,
                      dJ=dJ,
                      p=p,
-                     uix=self.coarseUix,
-                     invix=self.coarseInvix):
+                     X=X,
+                     dkl=dkl):
             i, j = args
-            
-            # round epsdJ_ to machine precision
-            mxix = np.argmax(np.abs(dJ[i]+dJ[j]))
-            newhJ = hJ[mxix] + (dJ[i][mxix]+dJ[j][mxix])*epsdJ
-            epsdJ_ = (newhJ - hJ[mxix]) / (dJ[i][mxix]+dJ[j][mxix]) / 2
-            if np.isnan(epsdJ_): return 0.
-
-            newhJ = hJ + (dJ[i]+dJ[j])*epsdJ_
-            modp = p2pk(ising.p(newhJ), uix, invix)
-            dklplus = (log2p-mplog2(modp)).dot(p)
-
-            newhJ -= 2*(dJ[i]+dJ[j])*epsdJ_
-            modp = p2pk(ising.p(newhJ), uix, invix)
-            dklminus = (log2p-mplog2(modp)).dot(p)
-            
+            dnegE = X.dot(dJ[i]+dJ[j]) * epsdJ_
+            dklplus = dkl(p, dnegE)
+            dklminus = dkl(p, -dnegE)
             return (dklplus+dklminus) / 2 / epsdJ_**2
 
         hess = np.zeros((len(dJ),len(dJ)))
@@ -1061,6 +1086,89 @@ class Magnetization():
             dJ = self.dJ
         return dJ.T.dot(eigvec)
 
+    def state_index(self, X):
+        """Row positions of states in self.allStates, which are ordered as in
+        bin_states(n, sym=True), from their binary code where the first spin is the most
+        significant bit. This avoids comparing against all 2^n states.
+
+        Parameters
+        ----------
+        X : ndarray
+            (n_samples, n) in {-1,1} basis.
+
+        Returns
+        -------
+        ndarray
+        """
+        
+        X = np.atleast_2d(X)
+        assert X.shape[1]==self.n and (np.abs(X)==1).all()
+        return (X>0).astype(np.int64).dot(2**np.arange(self.n-1, -1, -1, dtype=np.int64))
+
+    def minority_size(self, X=None):
+        """Number of spins k in the minority for each state such that p(k) can be binned
+        with np.bincount.
+
+        Parameters
+        ----------
+        X : ndarray, None
+            (n_samples, n) in {-1,1} basis. By default, self.allStates.
+
+        Returns
+        -------
+        ndarray
+            Values in 0, ..., n//2.
+        """
+        
+        if X is None:
+            X = self.allStates
+        return (self.n - np.abs(X.sum(1))) // 2
+
+    def _pk_bins(self):
+        """Coarse-grained bin of each state for p(k) and the number of bins."""
+        return self.minority_size(), self.n//2+1
+
+    def dlogpk_batch(self, ds, eps=None, ds_as_dJ=False):
+        """Rate of change in log2 p(k) when moving along many perturbation directions at
+        once such as the columns of the FIM eigenmatrix. The change in energy of every
+        state is a single product with the observables, and p(k) is summed within bins
+        with a segmented reduction. See utils.directional_dlogpk.
+
+        Parameters
+        ----------
+        ds : ndarray
+            Perturbation directions as columns that will be mapped to the change in the
+            maxent parameters with self.dJ.
+        eps : float, None
+            If None, the analytic derivative is returned. Otherwise, the symmetric finite
+            difference with this step size.
+        ds_as_dJ : bool, False
+            If True, columns of ds are perturbations of the maxent parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_bins, n_directions), where bins are ordered such that the number of voters
+            in the majority decreases by one voter at a time. If ds is a vector, only the
+            first dimension is returned.
+        """
+        
+        from .utils import directional_dlogpk
+
+        ds = np.asarray(ds)
+        if ds_as_dJ:
+            dJ = ds
+        else:
+            dJ = self.dJ.T.dot(ds)
+        
+        # change in log p of each state is the negative change in energy
+        dE = -self.all_observables().dot(dJ.reshape(dJ.shape[0], -1))
+        invix, nBins = self._pk_bins()
+        dlogp = directional_dlogpk(np.log(self.p), dE, invix, nBins, eps=eps)
+        if ds.ndim==1:
+            return dlogp[:,0]
+        return dlogp
+
     def component_subspace_dlogpk(self, hess, eps=1e-5):
         """Rate of change in log[p(k)] when moving along the principal mode of each
         component's subspace.
@@ -1071,6 +1179,7 @@ class Magnetization():
         ----------
         hess : ndarray
         eps : float, 1e-5
+            If None, the analytic derivative is returned.
 
         Returns
         -------
@@ -1080,29 +1189,15 @@ class Magnetization():
         """
         
         from .influence import block_subspace_eig
-        from coniii.utils import define_ising_helper_functions
-        calc_e, calc_observables, _ = define_ising_helper_functions()
         n = self.n
-        dlogp = []
-        
-        for ix in range(n):
-            # iterate over components whose subspaces we explore
-            # subspace eigenvector
-            eigval, eigvec = block_subspace_eig(hess, n-1)
-
-            v = eigvec[ix][:,0].real  # take principal eigenvector
-            dE = calc_e(self.allStates.astype(np.int64), v.dot(self.dJ[ix*(n-1):(ix+1)*(n-1)])/(n-1))*eps
-            E = np.log(self.p)
-            pplus = np.exp(E+dE - fast_logsumexp(E+dE)[0])  # modified probability distribution
-            pminus = np.exp(E-dE - fast_logsumexp(E-dE)[0])  # modified probability distribution
-
-            pkplusdE = np.zeros(n//2+1)
-            pkminusdE = np.zeros(n//2+1)
-            for k in range(n//2+1):
-                pkplusdE[k] = pplus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-                pkminusdE[k] = pminus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-            dlogp.append( (np.log2(pkplusdE) - np.log2(pkminusdE))/(2*eps) )
-        return dlogp
+        
+        # subspace eigenvectors
+        eigval, eigvec = block_subspace_eig(hess, n-1)
+        
+        # principal eigenvector of each component's subspace mapped to parameter space
+        dJ = np.vstack([eigvec[ix][:,0].real.dot(self.dJ[ix*(n-1):(ix+1)*(n-1)])/(n-1)
+                        for ix in range(n)]).T
+        return list(self.dlogpk_batch(dJ, eps=eps, ds_as_dJ=True).T)
 
     def __get_state__(self):
         # always close multiprocess pool when pickling
@@ -1278,8 +1373,25 @@ class MagnetizationConstant(Magnetization):
 class Coupling(Magnetization):
     """Perturbation that increases correlation between pairs of spins.
     """
-    def compute_dJ(self):
-        # precompute linear change to parameters for small perturbation
+    def compute_dJ(self, batch=False):
+        """Linear change to parameters for small perturbation.
+
+        Parameters
+        ----------
+        batch : bool, False
+            If True, solve for all perturbations at once with
+            solve_linearized_perturbation_batch() instead of searching for the best eps
+            for each perturbation separately.
+
+        Returns
+        -------
+        ndarray
+            (n_perturbation_parameters, n_maxent_parameters)
+        """
+        
+        if batch:
+            return self.solve_linearized_perturbation_batch()
+
         dJ = np.zeros((self.n*(self.n-1), self.n+(self.n-1)*self.n//2))
         counter = 0
         for i in range(self.n):
@@ -1360,6 +1472,63 @@ class Coupling(Magnetization):
         jit_observables_after_perturbation_plus(n, siNew, sisjNew, i, a, eps)
 
         return np.concatenate((siNew, sisjNew))
+
+    def perturbation_pairs(self):
+        """Pairs (i,a) where spin i is made more like spin a in the same order as the rows
+        of dJ.
+
+        Returns
+        -------
+        ndarray
+            (n*(n-1), 2)
+        """
+
+        return np.array([(i,a) for i in range(self.n) for a in np.delete(range(self.n),i)])
+
+    def observables_after_perturbation_batch(self, eps=None):
+        """Observables after each perturbation in perturbation_pairs(), all at once.
+        
+        Parameters
+        ----------
+        eps : float, None
+
+        Returns
+        -------
+        ndarray
+            (n_perturbations, n_observables)
+        """
+        
+        eps = eps or self.eps
+        n = self.n
+        pairs = self.perturbation_pairs()
+        M = corr_matrix(self.sisj[n:], n)
+        return observables_after_replacement(self.sisj, n, pairs[:,0],
+                                             self.sisj[pairs[:,1]][:,None],
+                                             M[pairs[:,1]],
+                                             eps)
+
+    def solve_linearized_perturbation_batch(self, eps=None):
+        """Linear change in the parameters for all perturbations at once.
+
+        The central difference of _solve_linearized_perturbation() reduces to the
+        covariance matrix of the observables because the perturbed observables are affine
+        in eps, so a single linear solve gives dJ for every perturbation.
+
+        Parameters
+        ----------
+        eps : float, None
+
+        Returns
+        -------
+        ndarray
+            dJ of dimensions (n_perturbations, n_parameters).
+        """
+        
+        eps = eps or self.eps
+        X = self.all_observables()
+        cov = (X.T * self.p).dot(X) - np.outer(self.sisj, self.sisj)
+        dC = (self.observables_after_perturbation_batch(eps) - self.sisj) / eps
+        return np.linalg.solve(cov, dC.T).T
     
     def _solve_linearized_perturbation_tester(self, iStar, aStar):
         """
@@ -1547,6 +1716,7 @@ class IsingSpinReplacementFIM(Coupling):
         J : ndarray, None
         eps : float, 1e-7
         precompute : bool, True
+            Unused. Transitions are applied implicitly with spin_replace().
         n_cpus : int, None
         high_prec : bool, False
         """
@@ -1559,22 +1729,16 @@ class IsingSpinReplacementFIM(Coupling):
         self.n_cpus = n_cpus
         self.high_prec = high_prec
 
-        if high_prec: 
-            self.ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym_hp'%n)
-        else:
-            self.ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%n)
+        self.ising = ExactIsing(n)
         self.sisj = self.ising.calc_observables(self.hJ)
         self.p = self.ising.p(self.hJ)
         self.allStates = bin_states(n, True).astype(int)
         self.coarseUix, self.coarseInvix = np.unique(np.abs(self.allStates.sum(1)), return_inverse=True)
         
-        self.T = []
-        if precompute:
-            for i,a in product(range(n),range(n)):
-                if i!=a:
-                    self.T.append(self.pair_transition_matrix(i, a, eps))
+        # pairs (i,a) where spin i is made more like spin a in the order of the Hessian
+        self.pairs = np.array([(i,a) for i,a in product(range(n),range(n)) if i!=a])
         # just filler for compatibility with super class
-        self.dJ = [None for i in range(len(self.T))] 
+        self.dJ = [None for i in range(len(self.pairs))] 
 
     def observables_after_perturbation(self, i, a, eps=None):
         """Make spin index i more like spin a by eps. Perturb the corresponding mean and
@@ -1594,8 +1758,10 @@ class IsingSpinReplacementFIM(Coupling):
             Observables <si> and <sisj> after perturbation.
         """
         
+        if eps is None:
+            eps = self.eps
         return pair_corr(self.allStates,
-                         weights=self.pair_transition_matrix(i, a, eps).dot(self.p),
+                         weights=spin_replace(self.p, self.n, i, a, eps),
                          concat=True)
 
     def pair_transition_matrix(self, i, j, eps=None):
@@ -1609,6 +1775,9 @@ class IsingSpinReplacementFIM(Coupling):
         j : int
         eps : float, None
 
+        Only for inspection. Calculations apply the transitions implicitly with
+        spin_replace().
+
         Returns
         -------
         scipy.sparse.coo_matrix
@@ -1618,9 +1787,8 @@ class IsingSpinReplacementFIM(Coupling):
         if eps is None:
             eps = self.eps
         
-        # generate full transition matrix by iterating through all possible states
-        rows, cols, vals = jit_spin_replace_transition_matrix(self.n, i, j, eps) 
-        T = coo_matrix((vals, (rows,cols)))
+        rows, cols, vals = spin_replace_transition_matrix(self.n, i, j, eps) 
+        T = coo_matrix((vals, (rows,cols)), shape=(2**self.n,2**self.n))
         return T
 
     def _maj_curvature(self,
@@ -1663,73 +1831,50 @@ class IsingSpinReplacementFIM(Coupling):
         assert np.isclose(pk.sum(),1), pk.sum()
         if iprint:
             print('Done with preamble.')
-        if epsdJ is None:
-            eps = self.eps
-            T = self.T
-        elif epsdJ!=self.eps:
-            # convert T into one with appropriate eps
-            T = []
-            for i,t in enumerate(self.T):
-                T.append(t.copy())
-                T[-1].data[(t.data>=.1)&(t.data<1)] = 1-self.eps/2
-                T[-1].data[(t.data<.1)&(t.data>0)] = self.eps/2
-            eps = epsdJ
+        eps = epsdJ or self.eps
+        pairs = self.pairs
+        
+        def p2pk(q, invix=self.coarseInvix, uix=self.coarseUix):
+            # coarse grain a stack of distributions
+            return np.stack([q[:,invix==k].sum(1) for k in range(len(uix))], axis=1)
 
         # diagonal entries of hessian
-        def diag(args, p=self.p, pk=pk, p2pk=self.p2pk,
-                 uix=self.coarseUix, invix=self.coarseInvix,
-                 n=self.n, kStates=self.kStates):
-            i, T = args
-            num = (np.log2(pk) - np.log2(p2pk(T.dot(p),uix,invix))).dot(pk)
-            dd = num / eps**2 * 2
-            if iprint and np.isnan(dd):
-                print('nan for diag', i, eps)
+        def diag(p=self.p, pk=pk):
+            q = p2pk(spin_replace(p, n, pairs[:,0], pairs[:,1], eps))
+            dd = (np.log2(pk)[None,:] - np.log2(q)).dot(pk) / eps**2 * 2
+            if iprint and np.isnan(dd).any():
+                print('nan for diag', np.where(np.isnan(dd))[0], eps)
             return dd
 
-        # off-diagonal entries of hessian
-        def off_diag(args, p=self.p, pk=pk, p2pk=self.p2pk,
-                     uix=self.coarseUix, invix=self.coarseInvix,
-                     n=self.n, kStates=self.kStates):
-            (i, j), (Ti, Tj) = args
-            
+        # off-diagonal entries of hessian in col b, T_a.T_b.p for all a<b
+        def off_diag(b, p=self.p, pk=pk):
             eps_ = 2*eps
-            num = (np.log2(pk) - np.log2(p2pk(Ti.dot(Tj).dot(p),uix,invix))).dot(pk)
-            dd = num / eps_**2 * 2
-            if iprint and np.isnan(dd):
-                print('nan for off diag', args, eps_)
+            q = spin_replace(p, n, pairs[b,0], pairs[b,1], eps)
+            q = p2pk(spin_replace(q, n, pairs[:b,0], pairs[:b,1], eps))
+            dd = (np.log2(pk)[None,:] - np.log2(q)).dot(pk) / eps_**2 * 2
+            if iprint and np.isnan(dd).any():
+                print('nan for off diag', b, eps_)
             return dd
         
-        hess = np.zeros((len(T),len(T)))
-        if not 'pool' in self.__dict__.keys():
-            warn("Not using multiprocess can lead to excessive memory usage.")
-            if calc_diag:
-                for i in range(len(T)):
-                    hess[i,i] = diag((i,T[i]))
-                if iprint:
-                    print("Done with diag.")
-            if calc_off_diag:
-                for i,j in combinations(range(len(T)),2):
-                    hess[i,j] = off_diag(( (i,j), (T[i],T[j]) ))
-                    if iprint:
-                        print("Done with off diag (%d,%d)."%(i,j))
-                if iprint:
-                    print("Done with off diag.")
-        else:
-            if calc_diag:
-                hess[np.eye(len(T))==1] = self.pool.map(diag, zip(range(len(T)),T))
-                if iprint:
-                    print("Done with diag.")
-            if calc_off_diag:
-                hess[np.triu_indices_from(hess,k=1)] = self.pool.map(off_diag,
-                                                                     zip(combinations(range(len(T)),2),
-                                                                         combinations(T,2)))
-                if iprint:
-                    print("Done with off diag.")
+        hess = np.zeros((len(pairs),len(pairs)))
+        if calc_diag:
+            hess[np.eye(len(pairs))==1] = diag()
+            if iprint:
+                print("Done with diag.")
+        if calc_off_diag:
+            if not 'pool' in self.__dict__.keys():
+                cols = map(off_diag, range(1, len(pairs)))
+            else:
+                cols = self.pool.map(off_diag, range(1, len(pairs)))
+            for b, col in enumerate(cols, 1):
+                hess[:b,b] = col
+            if iprint:
+                print("Done with off diag.")
 
         if calc_off_diag:
             # fill in lower triangle
             hess += hess.T
-            hess[np.eye(len(T))==1] /= 2
+            hess[np.eye(len(pairs))==1] /= 2
 
         if check_stability:
             hess2 = self._maj_curvature(check_stability=False,
@@ -1757,9 +1902,6 @@ class IsingSpinReplacementFIM(Coupling):
         assert ~np.isnan(hess).any()
         assert ~np.isinf(hess).any()
 
-        errflag = None
-        err = None
-
         if not full_output:
             return hess
         return hess, errflag, err
@@ -1808,43 +1950,31 @@ class MVMIsingFIM(Magnetization):
         numerically since there aren't many terms to solve for.
         """
         
-        if not 'Jeps' in self.__dict__.keys():
-            Jeps = np.zeros((2,4))
-            Jeps[0] = mvm.couplings(self.n, self.observables_after_perturbation(0,1))
-            Jeps[1] = mvm.couplings(self.n, self.observables_after_perturbation(1,0))
-            self.Jeps = Jeps
-        else:
-            Jeps = self.Jeps
+        # solve for couplings at all missing multiples of eps at once starting from the
+        # unperturbed couplings
+        names = ['Jeps', 'J2eps', 'J3eps', 'J4eps'][:min(max(order,1),4)]
+        missing = [(m, name) for m, name in enumerate(names, 1) if not name in self.__dict__.keys()]
+        if missing:
+            sisj = np.array([self.observables_after_perturbation(i, j, m*self.eps)
+                             for m, name in missing
+                             for i, j in ((0,1),(1,0))])
+            J = mvm.couplings(self.n, sisj, J0=self.J, tol=1e-15).reshape(len(missing), 2, 4)
+            for (m, name), J_ in zip(missing, J):
+                setattr(self, name, J_)
+
+        Jeps = self.Jeps
         if order==1:
             return (Jeps-self.J)/self.eps
 
-        if not 'J2eps' in self.__dict__.keys():
-            J2eps = np.zeros((2,4))
-            J2eps[0] = mvm.couplings(self.n, self.observables_after_perturbation(0,1,2*self.eps))
-            J2eps[1] = mvm.couplings(self.n, self.observables_after_perturbation(1,0,2*self.eps))
-            self.J2eps = J2eps
-        else:
-            J2eps = self.J2eps
+        J2eps = self.J2eps
         if order==2:
             return (-1.5*self.J + 2*Jeps -.5*J2eps)/self.eps
 
-        if not 'J3eps' in self.__dict__.keys():
-            J3eps = np.zeros((2,4))
-            J3eps[0] = mvm.couplings(self.n, self.observables_after_perturbation(0,1,3*self.eps))
-            J3eps[1] = mvm.couplings(self.n, self.observables_after_perturbation(1,0,3*self.eps))
-            self.J3eps = J3eps
-        else:
-            J3eps = self.J3eps
+        J3eps = self.J3eps
         if order==3:
             return (-11/6*self.J + 3*Jeps -1.5*J2eps + J3eps/3)/self.eps
 
-        if not 'J4eps' in self.__dict__.keys():
-            J4eps = np.zeros((2,4))
-            J4eps[0] = mvm.couplings(self.n, self.observables_after_perturbation(0,1,4*self.eps))
-            J4eps[1] = mvm.couplings(self.n, self.observables_after_perturbation(1,0,4*self.eps))
-            self.J4eps = J4eps
-        else:
-            J4eps = self.J4eps
+        J4eps = self.J4eps
         return (-25/12*self.J + 4*Jeps -3*J2eps + 4/3*J3eps -.25*J4eps)/self.eps
 
     def observables_after_perturbation(self, i, j,
@@ -2048,9 +2178,11 @@ class MVMIsingFIM(Magnetization):
             # factor out linear dependence on eps
             try:
                 if self.high_prec:
-                    A = mp.matrix(A)
-                    C = mp.matrix(C)
-                    dJ = A**-1 * C / eps
+                    from .utils import refined_solve
+                    # perturbed observables are affine in eps, so the change per unit
+                    # eps is taken at eps=1 to avoid cancellation in C-sisj
+                    dC = self.observables_after_perturbation(iStar, eps=1)[0] - self.sisj
+                    dJ = refined_solve(A, dC)
                 else:
                     dJ = np.linalg.solve(A,C)/eps
             except np.linalg.LinAlgError:
@@ -2069,18 +2201,13 @@ class MVMIsingFIM(Magnetization):
                                                                       p=p,
                                                                       sisj=np.concatenate((si,sisj)))
             # print if relative change is more than .1% for any entry
-            if self.high_prec:
-                relerr = (list(map(mp.log10, np.abs(dJ-dJtwiceEps))) -
-                          np.array(list(map(mp.log10, np.abs(dJ)))))
-            else:
-                relerr = np.log10(np.abs(dJ-dJtwiceEps))-np.log10(np.abs(dJ))
+            relerr = np.log10(np.abs(dJ-dJtwiceEps))-np.log10(np.abs(dJ))
             if (relerr>-3).any():
                 print("Unstable solution. Recommend shrinking eps. %E"%(10**relerr.max()))
         else:
             relerr = None
                    
-        if ((self.high_prec and mp.norm(A)*mp.norm(A**-1)>1e15) or
-            (not self.high_prec and np.linalg.cond(A)>1e15)):
+        if np.linalg.cond(A)>1e15:
             warn("A is badly conditioned.")
             errflag = 1
         else:
@@ -2496,7 +2623,7 @@ class Coupling3(Coupling):
         iprint : bool, True
         """
         
-        from coniii.utils import xpotts_states
+        from .coarse_grain import PartitionIndex
 
         assert n>1 and 0<eps<1e-2
         assert (h[2*n:3*n]==0).all()
@@ -2509,17 +2636,11 @@ class Coupling3(Coupling):
         self.n_cpus = n_cpus
         self.iprint = iprint
 
-        self.ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_potts'%n)
+        self.ising = ExactPotts(n, self.kStates)
         self.sisj = self.ising.calc_observables(self.hJ)
         self.p = self.ising.p(self.hJ)
-        kVotes = list(map(lambda x:np.sort(np.bincount(x, minlength=3))[::-1],
-                          xpotts_states(n, self.kStates)))
-        #self.majdivisions, self.coarseInvix = np.unique(kVotes, return_inverse=True, axis=0)
-        #self.coarseUix, self.coarseInvix = np.unique(kVotes, return_inverse=True, axis=0)
-        kVotes = list(map(lambda x:np.sort(np.bincount(x, minlength=3))[::-1],
-                          xpotts_states(n, self.kStates)))
-        self.coarseUix, self.coarseInvix = np.unique(kVotes, return_inverse=True, axis=0)
-        self.coarseUix = np.unique(self.coarseInvix)
+        # determine p(k) from the breakdown of votes across states
+        self.coarseUix, self.coarseInvix = PartitionIndex(n, self.kStates).coarse_index()
         
         if precompute:
             # cache triplet and quartet products
@@ -2535,6 +2656,7 @@ class Coupling3(Coupling):
  
     def _triplets_and_quartets(self):
         from itertools import product
+        from coniii.utils import xpotts_states
 
         n = self.n
         kStates = self.kStates
@@ -2645,6 +2767,50 @@ class Coupling3(Coupling):
             jit_observables_after_perturbation_Coupling3(n, siNew, sisjNew, i_, a_, eps_)
 
         return np.concatenate((siNew, sisjNew)), True
+
+    def all_observables(self):
+        """Indicators of each Potts state and of pairs in the same state for every state in
+        the same order as the parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_states, n_parameters)
+        """
+        
+        from coniii.utils import xpotts_states
+
+        allStates = np.vstack(list(xpotts_states(self.n, self.kStates))).astype(int)
+        ix = np.triu_indices(self.n, k=1)
+        return np.hstack([allStates==c for c in range(self.kStates)] +
+                         [allStates[:,ix[0]]==allStates[:,ix[1]]]).astype(float)
+
+    def _pk_bins(self):
+        return self.coarseInvix, self.coarseUix.size
+
+    def observables_after_perturbation_batch(self, eps=None):
+        """Observables after each perturbation in perturbation_pairs(), all at once.
+        
+        Parameters
+        ----------
+        eps : float, None
+
+        Returns
+        -------
+        ndarray
+            (n_perturbations, n_observables)
+        """
+        
+        eps = eps or self.eps
+        n = self.n
+        k = self.kStates
+        pairs = self.perturbation_pairs()
+        M = corr_matrix(self.sisj[k*n:], n)
+        return observables_after_replacement(self.sisj, n, pairs[:,0],
+                                             self.sisj[pairs[:,1][:,None] + n*np.arange(k)[None,:]],
+                                             M[pairs[:,1]],
+                                             eps,
+                                             kStates=k)
    
     def _maj_curvature(self,
                        hJ=None,
@@ -2693,9 +2859,7 @@ class Coupling3(Coupling):
         n = self.n
         if hJ is None:
             hJ = self.hJ
-        E = calc_all_energies(n, self.kStates, hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats(hJ)
         p = np.exp(logsumEk - logZ)
         assert np.isclose(p.sum(),1), p.sum()
         if dJ is None:
@@ -2819,9 +2983,7 @@ class Coupling3(Coupling):
     def _test_maj_curvature(self):
         n = self.n
         hJ = self.hJ
-        E = calc_all_energies(n, self.kStates, hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats(hJ)
         p = np.exp(logsumEk - logZ)
         dJ = self.dJ
 
@@ -3130,6 +3292,32 @@ class TernaryMag(Coupling3):
             self._observables_after_perturbation(siNew, sisjNew, i_, k, eps_)
 
         return np.concatenate((siNew, sisjNew)), True
+
+    def observables_after_perturbation_batch(self, eps=None):
+        """Observables after each perturbation (i,k) in the same order as the rows of dJ,
+        all at once. Replacing spin i by state k with probability eps moves the means
+        towards the indicator of state k and the correlations with spin j towards the
+        probability that j is in state k.
+        
+        Parameters
+        ----------
+        eps : float, None
+
+        Returns
+        -------
+        ndarray
+            (n_perturbations, n_observables)
+        """
+        
+        eps = eps or self.eps
+        n = self.n
+        k = self.kStates
+        gamma, i = np.divmod(np.arange(k*n), n)
+        return observables_after_replacement(self.sisj, n, i,
+                                             np.eye(k)[gamma],
+                                             self.sisj[:k*n].reshape(k, n)[gamma],
+                                             eps,
+                                             kStates=k)
     
     def _solve_linearized_perturbation_tester(self, iStar, gamma):
         """
@@ -3409,26 +3597,161 @@ def calc_all_energies(n, k, params):
     else: raise NotImplementedError
     return e
 
-def jit_spin_replace_transition_matrix(n, i, j, eps):
-    rows = []
-    cols = []
-    vals = []
-    for ix in range(2**n):
-        s = bin(ix)[2:].zfill(n)
-        if s[i]!=s[j]:
-            rows.append(ix)
-            cols.append(ix)
-            vals.append(1-eps)
-            
-            if s[i]=='0':
-                s = s[:i]+'1'+s[i+1:]
-            else:
-                s = s[:i]+'0'+s[i+1:]
-            rows.append(int(s,2))
-            cols.append(ix)
-            vals.append(eps)
-        else:
-            rows.append(ix)
-            cols.append(ix)
-            vals.append(1.)
+def spin_replace(p, n, i, j, eps):
+    """Apply the transition matrix where fraction eps of voter i is replaced by voter j
+    to a probability distribution over all 2^n states in the order of bin_states(n).
+
+    The matrix is never formed. A state in which spins i and j disagree sends fraction
+    eps of its probability to the state with spin i flipped, which is the state index
+    XOR the bit mask of spin i.
+
+    Parameters
+    ----------
+    p : ndarray
+        Of length 2^n or a stack of distributions of dimensions (n_pairs, 2^n).
+    n : int
+    i : int or ndarray
+        Spin(s) being replaced.
+    j : int or ndarray
+        Spin(s) to copy from. Must be of the same length as i.
+    eps : float
+
+    Returns
+    -------
+    ndarray
+        Of length 2^n if i and j are ints and p is a single distribution. Otherwise, of
+        dimensions (n_pairs, 2^n) with one row for each pair (i,j).
+    """
+    
+    squeeze = np.isscalar(i) and np.ndim(p)==1
+    i = np.atleast_1d(i)[:,None]
+    j = np.atleast_1d(j)[:,None]
+    assert i.shape==j.shape and (i!=j).all()
+    
+    ix = np.arange(2**n)[None,:]
+    # spin 0 is the most significant bit
+    maski = 1<<(n-1-i)
+    disagree = ((ix>>(n-1-i)) ^ (ix>>(n-1-j))) & 1
+    dp = eps * disagree * p
+    q = p - dp + np.take_along_axis(dp, ix ^ maski, axis=1)
+    if squeeze:
+        return q[0]
+    return q
+
+def spin_replace_transition_matrix(n, i, j, eps):
+    """Sparse entries of the transition matrix applied by spin_replace().
+
+    Parameters
+    ----------
+    n : int
+    i : int
+    j : int
+    eps : float
+
+    Returns
+    -------
+    ndarray
+        Rows.
+    ndarray
+        Cols.
+    ndarray
+        Values.
+    """
+
+    ix = np.arange(2**n)
+    disagree = (((ix>>(n-1-i)) ^ (ix>>(n-1-j))) & 1)==1
+    rows = np.concatenate((ix, ix[disagree] ^ (1<<(n-1-i))))
+    cols = np.concatenate((ix, ix[disagree]))
+    vals = np.concatenate((np.where(disagree, 1-eps, 1.), np.zeros(disagree.sum())+eps))
     return rows, cols, vals
+
+def pair_index_table(n):
+    """Table of the index of each pair (i,j) in the vector of pairwise correlations,
+    ordered as np.triu_indices(n, k=1).
+
+    Parameters
+    ----------
+    n : int
+
+    Returns
+    -------
+    ndarray
+        (n,n) symmetric table of ints with -1 along the diagonal.
+    """
+
+    table = -np.ones((n,n), dtype=int)
+    ix = np.triu_indices(n, k=1)
+    table[ix] = np.arange(ix[0].size)
+    table[ix[::-1]] = table[ix]
+    return table
+
+def corr_matrix(sisj, n):
+    """Square matrix of pairwise correlations with ones along the diagonal.
+
+    Parameters
+    ----------
+    sisj : ndarray
+        Pairwise correlations ordered as np.triu_indices(n, k=1).
+    n : int
+
+    Returns
+    -------
+    ndarray
+        (n,n)
+    """
+
+    M = np.ones((n,n))
+    ix = np.triu_indices(n, k=1)
+    M[ix] = M[ix[::-1]] = sisj
+    return M
+
+def observables_after_replacement(sisj, n, i, mean_target, pair_target, eps, kStates=2):
+    """Observables after a batch of perturbations where with probability eps the state
+    of spin i[p] is replaced by a target, all computed at once.
+
+    Only the means of spin i[p] and its correlations with the other spins change. Each
+    moves linearly towards the corresponding value for the target,
+        <x>' = (1-eps) <x> + eps <x>_target.
+
+    Parameters
+    ----------
+    sisj : ndarray
+        Unperturbed means (kStates*n for Potts or n for Ising) followed by pairwise
+        correlations.
+    n : int
+    i : ndarray
+        Spin replaced in each perturbation.
+    mean_target : ndarray
+        (n_perturbations, kStates) or (n_perturbations, 1) for Ising. Means of spin
+        i[p] after full replacement.
+    pair_target : ndarray
+        (n_perturbations, n). Entry j is the correlation between spin i[p] and spin j
+        after full replacement. Entry i[p] is ignored.
+    eps : float
+    kStates : int, 2
+        Use 2 for Ising models (which only have n means).
+
+    Returns
+    -------
+    ndarray
+        (n_perturbations, n_observables)
+    """
+    
+    i = np.asarray(i)
+    nPerturbations = i.size
+    nMeans = n if kStates==2 else kStates*n
+    mean_target = np.asarray(mean_target).reshape(nPerturbations, -1)
+    rows = np.arange(nPerturbations)
+    C = np.tile(sisj, (nPerturbations,1))
+
+    # means
+    meanix = i[:,None] + n*np.arange(mean_target.shape[1])[None,:]
+    C[rows[:,None],meanix] = (1-eps) * sisj[meanix] + eps * mean_target
+
+    # pairs with every other spin j
+    j = np.tile(np.arange(n), (nPerturbations,1))
+    j = j[j!=i[:,None]].reshape(nPerturbations, n-1)
+    pairix = nMeans + pair_index_table(n)[i[:,None],j]
+    C[rows[:,None],pairix] = ((1-eps) * sisj[pairix] +
+                              eps * np.take_along_axis(pair_target, j, axis=1))
+    return C
@@ -8,7 +8,6 @@ from .utils import *
 from numba import njit, prange
 from coniii.enumerate import fast_logsumexp, mp_fast_logsumexp
 from multiprocess import Pool, cpu_count, set_start_method
-from scipy.sparse import coo_matrix
 from numba.typed import Dict as nDict
 from tempfile import mkdtemp
 from multiprocess import RawArray
@@ -566,6 +565,49 @@ class Magnetization():
             return hess, errflag, err
         return hess
 
+    def _all_energies(self, hJ):
+        """Energies of all sampled states."""
+        return calc_e(self.allStates, hJ)
+
+    def model_stats(self, hJ=None):
+        """Energies of all sampled states, the log partition function over them, and the
+        unnormalized log p(k) for the given parameters.
+
+        These are memoized on the model with a hash of the parameters and of the coarse
+        graining, so the many calls with the same parameters, e.g. from the step size
+        search in maj_curvature(), share a single calculation.
+
+        Parameters
+        ----------
+        hJ : ndarray, None
+            By default, the parameters of the model.
+
+        Returns
+        -------
+        ndarray
+            Energies of all states (read only).
+        float
+            logZ
+        ndarray
+            log p(k) + logZ (read only).
+        """
+        
+        from .utils import ParameterCache
+
+        if hJ is None:
+            hJ = self.hJ
+        hJ = np.asarray(hJ, dtype=np.float64)
+        if not '_statsCache' in self.__dict__.keys():
+            self._statsCache = ParameterCache()
+        
+        def calc(hJ=hJ):
+            E = self._all_energies(hJ)
+            logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+            E.flags.writeable = False
+            logsumEk.flags.writeable = False
+            return E, fast_logsumexp(-E)[0], logsumEk
+        return self._statsCache.get(calc, hJ, self.coarseInvix)
+
     def _maj_curvature(self,
                        hJ=None,
                        dJ=None,
@@ -613,9 +655,7 @@ class Magnetization():
         n = self.n
         if hJ is None:
             hJ = self.hJ
-        E = calc_e(self.allStates, hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats(hJ)
         p = np.exp(logsumEk - logZ)
         assert np.isclose(p.sum(),1), p.sum()
         if dJ is None:
@@ -940,6 +980,42 @@ class Magnetization():
             dJ = self.dJ
         return dJ.T.dot(eigvec)
 
+    def all_observables(self):
+        """Means and pairwise correlations of every sampled state in the same order as the
+        parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_states, n_parameters)
+        """
+        
+        ix = np.triu_indices(self.n, k=1)
+        return np.hstack((self.allStates, self.allStates[:,ix[0]]*self.allStates[:,ix[1]])).astype(float)
+
+    def minority_size(self, X=None):
+        """Number of spins k in the minority for each state such that p(k) can be binned
+        with np.bincount.
+
+        Parameters
+        ----------
+        X : ndarray, None
+            (n_samples, n) in {-1,1} basis. By default, self.allStates.
+
+        Returns
+        -------
+        ndarray
+            Values in 0, ..., n//2.
+        """
+        
+        if X is None:
+            X = self.allStates
+        return (self.n - np.abs(X.sum(1).astype(int))) // 2
+
+    def _pk_bins(self):
+        """Coarse-grained bin of each state for p(k) and the number of bins."""
+        return self.minority_size(), self.n//2+1
+
     def dlogpk(self, ds, eps=1e-4, ds_as_dJ=False):
         """Rate of change in log[p(k)] when moving along perturbation direction described
         by given vector.
@@ -948,7 +1024,8 @@ class Magnetization():
         ----------
         ds : ndarray
             Perturbation specification that will be mapped to change in underlying maxent
-            parameters, e.g. a col of the eigenmatrix.
+            parameters, e.g. a col of the eigenmatrix. Multiple directions can be given
+            as columns.
         eps : float, 1e-4
         ds_as_dJ : bool, False
             If True, simple perturbation of maxent model parameters is given.
@@ -962,37 +1039,55 @@ class Magnetization():
             Norm difference between gradient calculation with eps step and 2*eps step.
         """
 
-        # map change in correlation space to that in amxent parameter space
+        dlogp = self.dlogpk_batch(ds, eps, ds_as_dJ)
+        # check what derivative looks like for larger eps to check convergence
+        dlogpCoarse = self.dlogpk_batch(ds, eps * 2, ds_as_dJ)
+
+        return dlogp, np.linalg.norm(dlogpCoarse - dlogp)
+    
+    def dlogpk_batch(self, ds, eps=None, ds_as_dJ=False):
+        """Rate of change in log2 p(k) when moving along many perturbation directions at
+        once such as the columns of the FIM eigenmatrix. The change in energy of every
+        state is a single product with the observables, and p(k) is summed within bins
+        with a segmented reduction. See utils.directional_dlogpk.
+
+        Parameters
+        ----------
+        ds : ndarray
+            Perturbation directions as columns that will be mapped to the change in the
+            maxent parameters with self.dJ.
+        eps : float, None
+            If None, the analytic derivative is returned. Otherwise, the symmetric finite
+            difference with this step size.
+        ds_as_dJ : bool, False
+            If True, columns of ds are perturbations of the maxent parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_bins, n_directions). If ds is a vector, only the first dimension is
+            returned.
+        """
+        
+        from .utils import directional_dlogpk
+
+        ds = np.asarray(ds)
         if ds_as_dJ:
             dJ = ds
         else:
             dJ = self.dJ.T.dot(ds)
-
-        dlogp = self._dlogpk(dJ, eps)
-        # check what derivative looks like for larger eps to check convergence
-        dlogpCoarse = self._dlogpk(dJ, eps * 2)
-
-        return dlogp, np.linalg.norm(dlogpCoarse - dlogp)
         
-    def _dlogpk(self, dJ, eps):
-        from coniii.utils import define_ising_helper_functions
-        calc_e = define_ising_helper_functions()[0]
-
-        # calculate change in energy of each observed configuration as we induce
-        # perturbation in both pos and neg directions
-        dE = calc_e(self.allStates, dJ*eps)
-        E = np.log(self.p)
-        pplus = np.exp(E+dE - fast_logsumexp(E+dE)[0])  # modified probability distribution
-        pminus = np.exp(E-dE - fast_logsumexp(E-dE)[0])  # modified probability distribution
-
-        pkplusdE = np.zeros(n//2+1)
-        pkminusdE = np.zeros(n//2+1)
-        for k in range(n//2+1):
-            pkplusdE[k] = pplus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-            pkminusdE[k] = pminus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-        dlogp = (np.log2(pkplusdE) - np.log2(pkminusdE)) / (2*eps)
+        # change in log p of each state is the negative change in energy
+        dE = -self.all_observables().dot(dJ.reshape(dJ.shape[0], -1))
+        invix, nBins = self._pk_bins()
+        dlogp = directional_dlogpk(np.log(self.p), dE, invix, nBins, eps=eps)
+        if ds.ndim==1:
+            return dlogp[:,0]
         return dlogp
 
+    def _dlogpk(self, dJ, eps):
+        return self.dlogpk_batch(dJ, eps, ds_as_dJ=True)
+
     def component_subspace_dlogpk(self, hess, eps=1e-5):
         """Rate of change in log[p(k)] when moving along the principal mode of each
         component's subspace.
@@ -1003,6 +1098,7 @@ class Magnetization():
         ----------
         hess : ndarray
         eps : float, 1e-5
+            If None, the analytic derivative is returned.
 
         Returns
         -------
@@ -1012,29 +1108,15 @@ class Magnetization():
         """
         
         from .spectral import block_subspace_eig
-        from coniii.utils import define_ising_helper_functions
-        calc_e, calc_observables, _ = define_ising_helper_functions()
         n = self.n
-        dlogp = []
-        
-        for ix in range(n):
-            # iterate over components whose subspaces we explore
-            # subspace eigenvector
-            eigval, eigvec = block_subspace_eig(hess, n-1)
-
-            v = eigvec[ix][:,0].real  # take principal eigenvector
-            dE = calc_e(self.allStates.astype(np.int64), v.dot(self.dJ[ix*(n-1):(ix+1)*(n-1)])/(n-1))*eps
-            E = np.log(self.p)
-            pplus = np.exp(E+dE - fast_logsumexp(E+dE)[0])  # modified probability distribution
-            pminus = np.exp(E-dE - fast_logsumexp(E-dE)[0])  # modified probability distribution
-
-            pkplusdE = np.zeros(n//2+1)
-            pkminusdE = np.zeros(n//2+1)
-            for k in range(n//2+1):
-                pkplusdE[k] = pplus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-                pkminusdE[k] = pminus[np.abs(self.allStates.sum(1))==(n-k*2)].sum()
-            dlogp.append( (np.log2(pkplusdE) - np.log2(pkminusdE))/(2*eps) )
-        return dlogp
+        
+        # subspace eigenvectors
+        eigval, eigvec = block_subspace_eig(hess, n-1)
+        
+        # principal eigenvector of each component's subspace mapped to parameter space
+        dJ = np.vstack([eigvec[ix][:,0].real.dot(self.dJ[ix*(n-1):(ix+1)*(n-1)])/(n-1)
+                        for ix in range(n)]).T
+        return list(self.dlogpk_batch(dJ, eps=eps, ds_as_dJ=True).T)
 
     def __get_state__(self):
         # always close multiprocess pool when pickling
@@ -1502,6 +1584,8 @@ class Mag3(Coupling):
         sampler_kw : dict, {}
         """
 
+        from .coarse_grain import PartitionIndex
+
         assert isinstance(n, int) and n>1 and 0<eps<1e-2
         assert (h[2*n:3*n]==0).all()
         assert h.size==3*n and J.size==n*(n-1)//2
@@ -1519,10 +1603,7 @@ class Mag3(Coupling):
         self.p = self.ising.p
         self.allStates = self.ising.states.astype(np.int8)
         # determine p(k) as the number of votes in the plurality
-        kVotes = list(map(lambda x:np.sort(np.bincount(x, minlength=3))[::-1],
-                          self.allStates))
-        self.coarseUix, self.coarseInvix = np.unique(kVotes, return_inverse=True, axis=0)
-        self.coarseUix = np.unique(self.coarseInvix)
+        self.coarseUix, self.coarseInvix = PartitionIndex(n, self.kStates).coarse_index(self.allStates)
 
         if precompute:
             # cache triplet and quartet products
@@ -1652,9 +1733,51 @@ class Mag3(Coupling):
             
             for k_ in range(self.kStates):
                 sisj[ijix] += delta[k_] * self.sisj[k_ * n + j]
-        
+
         return np.concatenate((si, sisj))
-   
+
+    def observables_after_perturbation_batch(self, eps=None):
+        """Observables after each perturbation (i,k) in the same order as the rows of dJ,
+        all at once. See observables_after_perturbation().
+
+        Parameters
+        ----------
+        eps : float, None
+
+        Returns
+        -------
+        ndarray
+            (n_perturbations, n_observables)
+        """
+
+        from .utils import perturb_3_spin
+        from .fim import pair_index_table
+
+        eps = eps or self.eps
+        n = self.n
+        k = self.kStates
+        i, gamma = np.divmod(np.arange(n*k), k)
+        rows = np.arange(n*k)
+        C = np.tile(self.sisj, (n*k,1))
+
+        # means of spin i
+        meanix = i[:,None] + n*np.arange(k)[None,:]
+        delta = np.array([perturb_3_spin(self.sisj[ix], g, eps, return_delta=True)
+                          for ix, g in zip(meanix, gamma)])
+        C[rows[:,None],meanix] += delta
+
+        # pairs with every other spin j change by sum_k delta[k] * <s_j=k>
+        j = np.tile(np.arange(n), (n*k,1))
+        j = j[j!=i[:,None]].reshape(n*k, n-1)
+        pairix = k*n + pair_index_table(n)[i[:,None],j]
+        C[rows[:,None],pairix] += np.take_along_axis(delta.dot(self.sisj[:k*n].reshape(k, n)),
+                                                     j, axis=1)
+        return C
+
+    def _all_energies(self, hJ):
+        """Energies of all sampled states."""
+        return calc_all_energies(self.n, self.kStates, self.allStates, hJ)
+
     def _maj_curvature(self,
                        epsdJ=1e-7,
                        check_stability=False,
@@ -1701,9 +1824,7 @@ class Mag3(Coupling):
         """
         
         n = self.n
-        E = calc_all_energies(n, self.kStates, self.allStates, self.hJ)
-        logZ = fast_logsumexp(-E)[0]
-        logsumEk = self.logp2pk(E, self.coarseUix, self.coarseInvix)
+        E, logZ, logsumEk = self.model_stats()
         # check if calc_off_diag specifies calculating all entries or just specific ones
         if off_diag_ix:
             assert all([i<j for i,j in off_diag_ix])
@@ -2089,29 +2210,25 @@ class Mag3(Coupling):
             return dJ, errflag, (Aplus, Cplus)
         return dJ, errflag
 
-    def _dlogpk(self, dJ, eps):
+    def all_observables(self):
+        """Indicators of each Potts state and of pairs in the same state for every sampled
+        state in the same order as the parameters.
+
+        Returns
+        -------
+        ndarray
+            (n_states, n_parameters)
+        """
+        
+        ix = np.triu_indices(self.n, k=1)
+        return np.hstack([self.allStates==c for c in range(self.kStates)] +
+                         [self.allStates[:,ix[0]]==self.allStates[:,ix[1]]]).astype(float)
+
+    def _pk_bins(self):
         """Partitions are determined by unique ones found in the sample and referenced in
         self.coarseUix and self.coarseInvix.
         """
-
-        calc_e = self.ising.calc_e
-        n = self.n
-        
-        # calculate change in energy of each observed configuration as we induce
-        # perturbation in both pos and neg directions
-        dE = calc_e(self.allStates, dJ*eps)
-        E = np.log(self.p)
-        pplus = np.exp(E+dE - fast_logsumexp(E+dE)[0])  # modified probability distribution
-        pminus = np.exp(E-dE - fast_logsumexp(E-dE)[0])  # modified probability distribution
-        
-        choosek = self.coarseUix.size
-        pkplusdE = np.zeros(choosek)
-        pkminusdE = np.zeros(choosek)
-        for k in range(choosek):
-            pkplusdE[k] = pplus[self.coarseInvix==k].sum()
-            pkminusdE[k] = pminus[self.coarseInvix==k].sum()
-        dlogp = (np.log2(pkplusdE) - np.log2(pkminusdE)) / (2*eps)
-        return dlogp
+        return self.coarseInvix, self.coarseUix.size
 #end Mag3
 
 
@@ -2148,6 +2265,8 @@ class Coupling3(Mag3):
         sampler_kw : dict, {}
         """
 
+        from .coarse_grain import PartitionIndex
+
         assert n>1 and 0<eps<1e-2
         assert (h[2*n:3*n]==0).all()
         assert h.size==3*n and J.size==n*(n-1)//2
@@ -2165,10 +2284,7 @@ class Coupling3(Mag3):
         self.p = self.ising.p
         self.allStates = self.ising.states.astype(np.int8)
         # determine p(k) as the number of votes in the plurality
-        kVotes = list(map(lambda x:np.sort(np.bincount(x, minlength=3))[::-1],
-                          self.allStates))
-        self.coarseUix, self.coarseInvix = np.unique(kVotes, return_inverse=True, axis=0)
-        self.coarseUix = np.unique(self.coarseInvix)
+        self.coarseUix, self.coarseInvix = PartitionIndex(n, self.kStates).coarse_index(self.allStates)
     
         if precompute:
             # cache triplet and quartet products
@@ -2566,30 +2682,6 @@ def calc_all_energies(n, k, states, params):
     else: raise NotImplementedError
     return e
 
-def jit_spin_replace_transition_matrix(n, i, j, eps):
-    rows = []
-    cols = []
-    vals = []
-    for ix in range(2**n):
-        s = bin(ix)[2:].zfill(n)
-        if s[i]!=s[j]:
-            rows.append(ix)
-            cols.append(ix)
-            vals.append(1-eps)
-            
-            if s[i]=='0':
-                s = s[:i]+'1'+s[i+1:]
-            else:
-                s = s[:i]+'0'+s[i+1:]
-            rows.append(int(s,2))
-            cols.append(ix)
-            vals.append(eps)
-        else:
-            rows.append(ix)
-            cols.append(ix)
-            vals.append(1.)
-    return rows, cols, vals
-
 @njit(cache=True)
 def fast_sum(J,s):
     """Helper function for calculating energy in calc_e(). Iterates couplings J."""
@@ -6,6 +6,7 @@ from coniii.samplers import Metropolis, Potts3
 import coniii.utils as cutils
 import numpy as np
 from itertools import combinations
+from abc import ABC, abstractmethod
 from scipy.special import binom
 
 
@@ -188,3 +189,262 @@ class LargePotts3():
         self.states = states
         self.p = p
 #end LargePotts3
+
+
+class ExactEnumeration(ABC):
+    """Exact enumeration of a pairwise maxent model with k states per spin.
+
+    States are indexed in the same order as coniii's generated ising_eqn modules, i.e.
+    the first spin is the most significant digit of the base-k state index. To avoid
+    holding all k^n states in memory, the spins are split into a high block A and a low
+    block B. The energies of all states are assembled a chunk of rows of A at a time as
+    E_A[:,None] + E_B[None,:] plus the A-B couplings, which reduce to a matrix product.
+    Quantities summed over states are accumulated chunk by chunk with a log-sum-exp.
+    """
+    def __init__(self, n, k, chunk_size=2**20):
+        """
+        Parameters
+        ----------
+        n : int
+        k : int
+        chunk_size : int, 2**20
+            Number of states whose energies are held in memory at once.
+        """
+
+        assert n>1 and k>1
+        assert chunk_size>=k
+        self.n = n
+        self.kStates = k
+        self.chunk_size = chunk_size
+
+        # low block is as large as possible while fitting into a chunk
+        self.nB = min(n-1, max(1, int(np.log(chunk_size)//np.log(k))//2))
+        self.nA = n - self.nB
+        self.featuresA = self._features(self.nA)
+        self.featuresB = self._features(self.nB)
+        self.rowsPerChunk = max(1, chunk_size//k**self.nB)
+        self.pairix = np.triu_indices(n, k=1)
+
+    @abstractmethod
+    def _features(self, m):
+        """Spin features for all k^m states of m spins.
+
+        Parameters
+        ----------
+        m : int
+
+        Returns
+        -------
+        ndarray
+            Dimensions (k^m, n_features, m). The field term is the dot product of the
+            features with the fields, and the coupling between two spins is the dot
+            product of their features.
+        """
+    
+    def _states(self, m):
+        """Digits of all k^m states of m spins.
+
+        Parameters
+        ----------
+        m : int
+
+        Returns
+        -------
+        ndarray
+        """
+        
+        k = self.kStates
+        ix = np.arange(k**m)
+        return (ix[:,None] // k**np.arange(m-1,-1,-1)[None,:]) % k
+
+    def _split_parameters(self, hJ):
+        """Split parameters into fields of shape (n_features, n) and a strictly upper
+        triangular coupling matrix.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Returns
+        -------
+        ndarray
+            Fields.
+        ndarray
+            Couplings.
+        """
+        
+        n = self.n
+        d = self.featuresA.shape[1]
+        hJ = np.asarray(hJ, dtype=float)
+        assert hJ.size==d*n+n*(n-1)//2, "Wrong number of parameters."
+        
+        h = hJ[:d*n].reshape(d, n)
+        J = np.zeros((n,n))
+        J[self.pairix] = hJ[d*n:]
+        return h, J
+
+    def _block_energy(self, features, h, J):
+        """Negative energies of all states of a single block ignoring other blocks.
+        """
+
+        return (np.einsum('scn,cn->s', features, h) +
+                np.einsum('sci,ij,scj->s', features, J, features, optimize=True))
+
+    def _neg_energies(self, hJ):
+        """Generator of negative energies of all states, a chunk of rows of block A at a
+        time.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Yields
+        ------
+        slice
+            Rows of block A.
+        ndarray
+            Negative energies of dimensions (rows of A, states of B).
+        """
+        
+        nA = self.nA
+        h, J = self._split_parameters(hJ)
+        FA, FB = self.featuresA, self.featuresB
+        EA = self._block_energy(FA, h[:,:nA], J[:nA,:nA])
+        EB = self._block_energy(FB, h[:,nA:], J[nA:,nA:])
+        # couplings between blocks projected onto the states of block B
+        JFB = np.einsum('ij,scj->cis', J[:nA,nA:], FB)
+        
+        for i in range(0, len(FA), self.rowsPerChunk):
+            rows = slice(i, i+self.rowsPerChunk)
+            negE = EA[rows,None] + EB[None,:]
+            for c in range(FA.shape[1]):
+                negE += FA[rows,c].dot(JFB[c])
+            yield rows, negE
+
+    def logZ(self, hJ):
+        """Log partition function.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Returns
+        -------
+        float
+        """
+
+        maxE = -np.inf
+        s = 0.
+        for rows, negE in self._neg_energies(hJ):
+            m = negE.max()
+            if m>maxE:
+                s *= np.exp(maxE-m)
+                maxE = m
+            s += np.exp(negE-maxE).sum()
+        return maxE + np.log(s)
+
+    def logp(self, hJ):
+        """Log probability of every state.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Returns
+        -------
+        ndarray
+        """
+
+        logZ = self.logZ(hJ)
+        return np.concatenate([(negE-logZ).ravel() for rows, negE in self._neg_energies(hJ)])
+
+    def p(self, hJ):
+        """Probability of every state.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Returns
+        -------
+        ndarray
+        """
+
+        return np.exp(self.logp(hJ))
+
+    def calc_observables(self, hJ):
+        """Means and pairwise correlations in the same order as the parameters.
+
+        Parameters
+        ----------
+        hJ : ndarray
+
+        Returns
+        -------
+        ndarray
+        """
+
+        n, nA = self.n, self.nA
+        FA, FB = self.featuresA, self.featuresB
+        d = FA.shape[1]
+        logZ = self.logZ(hJ)
+        
+        pB = np.zeros(len(FB))
+        means = np.zeros((d,n))
+        pairs = np.zeros((n,n))
+        for rows, negE in self._neg_energies(hJ):
+            p = np.exp(negE-logZ)
+            pA = p.sum(1)
+            pB += p.sum(0)
+            for c in range(d):
+                means[c,:nA] += pA.dot(FA[rows,c])
+                pairs[:nA,:nA] += (FA[rows,c].T * pA).dot(FA[rows,c])
+                pairs[:nA,nA:] += FA[rows,c].T.dot(p).dot(FB[:,c])
+        for c in range(d):
+            means[c,nA:] = pB.dot(FB[:,c])
+            pairs[nA:,nA:] += (FB[:,c].T * pB).dot(FB[:,c])
+
+        return np.concatenate((means.ravel(), pairs[self.pairix]))
+#end ExactEnumeration
+
+
+class ExactIsing(ExactEnumeration):
+    """Exact enumeration of the pairwise Ising model in the {-1,1} basis. Drop-in
+    replacement for coniii.ising_eqn.ising_eqn_{n}_sym for n up to about 25.
+    """
+    def __init__(self, n, **kwargs):
+        """
+        Parameters
+        ----------
+        n : int
+        **kwargs
+            For ExactEnumeration.
+        """
+
+        super().__init__(n, 2, **kwargs)
+
+    def _features(self, m):
+        return (2.*self._states(m)-1)[:,None,:]
+#end ExactIsing
+
+
+class ExactPotts(ExactEnumeration):
+    """Exact enumeration of the pairwise Potts model where couplings act when two spins
+    are in the same state. Drop-in replacement for coniii.ising_eqn.ising_eqn_{n}_potts
+    for n up to about 15 with three states.
+    """
+    def __init__(self, n, k=3, **kwargs):
+        """
+        Parameters
+        ----------
+        n : int
+        k : int, 3
+        **kwargs
+            For ExactEnumeration.
+        """
+
+        super().__init__(n, k, **kwargs)
+
+    def _features(self, m):
+        return (self._states(m)[:,None,:]==np.arange(self.kStates)[None,:,None]).astype(float)
+#end ExactPotts
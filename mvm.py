@@ -10,44 +10,53 @@ import numpy as np
 from coniii.utils import *
 from coniii.enumerate import fast_logsumexp
 from scipy.special import binom, factorial, comb
-from scipy.optimize import minimize, root
+from functools import lru_cache
 
 
 
 def create_mvm_p(n, q):
     """Use a probability transition matrix formulation to generate the MVM probability
-    distribution. This can be quite expensive when generating p.
+    distribution starting from the uniform distribution.
+
+    The transition matrix is never formed. The Median is the first spin, the most
+    significant bit of the state index in the order of bin_states(n). With probability q,
+    a Median in the minority of the Ordinary voters flips into the majority, moving that
+    state to its partner at the state index XOR the bit mask of the Median.
 
     Parameters
     ----------
     n : int
-    q : float
+    q : float or ndarray
+        Many values of q can be given at once.
 
     Returns
     -------
     ndarray
-        Of length 2^n
+        Of length 2^n or of dimensions (len(q), 2^n) if q is an array.
     """
-
-    allStates = bin_states(n, True)
-    T = np.zeros((2**n,2**n))
-    for i,s in enumerate(allStates):
-        if s[1:].sum()!=0 and s[0]!=np.sign(s[1:].sum()):
-            T[i,i] = 1-q
-            snew = s.copy()
-            snew[0] *= -1
-            ix = np.where((allStates==snew).all(1))[0]
-            T[ix,i] = q
-        else:
-            T[i,i] = 1
-
-    p = np.ones(2**n)/2**n
-    pmvm = T.dot(p)
-    
-    if q==1:
+    
+    squeeze = np.ndim(q)==0
+    q = np.atleast_1d(q).astype(float)[:,None]
+
+    # no. of Ordinary voters voting +1 for every setting of the remaining n-1 bits
+    nUp = np.zeros(1, dtype=np.uint8)
+    for i in range(n-1):
+        nUp = np.concatenate((nUp, nUp+1))
+    ordinarySum = 2*nUp.astype(np.int16) - (n-1)
+    # states where the Median (-1 in the first half, +1 in the second) is in the minority
+    contraryDown = ordinarySum>0
+    contraryUp = ordinarySum<0
+    
+    # each half loses fraction q of its minority states to its partner in the other half
+    pDown = 1 - q*contraryDown + q*contraryUp
+    pUp = 1 - q*contraryUp + q*contraryDown
+    pmvm = np.hstack((pDown, pUp)) / 2**n
+    
+    if (q==1).any():
         # check that states with zero probability are now ones where the Median was in the minority
-        ix = allStates[pmvm>0][:,0]==np.sign(allStates[pmvm>0][:,1:].sum(1))
-        assert (np.sign(allStates[pmvm>0][ix==0][:,1:].sum(1))==0).all()
+        assert (pmvm[q[:,0]==1][:,np.concatenate((contraryDown, contraryUp))]==0).all()
+    if squeeze:
+        return pmvm[0]
     return pmvm
 
 def corr(n):
@@ -79,10 +88,11 @@ def couplings(n,
               data_corr=None,
               full_output=False,
               tol=1e-12,
-              return_as_full_vec=False):
-    """Find couplings corresponding to mvm pairwise correlations numerically. First, a
-    solution is found using scipy.minimize. Then an iterative, fixed point algorithm is
-    used to refine the solution.
+              return_as_full_vec=False,
+              J0=None,
+              q=1.):
+    """Find couplings corresponding to mvm pairwise correlations numerically with
+    newton_solve() on the terms of the maxent model of setup_maxent().
 
     Parameters
     ----------
@@ -90,56 +100,58 @@ def couplings(n,
     data_corr : ndarray, None
         Correlations to fit instead of taking MVM correlations.
         (smo, smop, soo, soop)
+        Many sets of correlations can be fit at once by stacking them into rows.
     full_output : bool, False
-        If True, return output from scipy.minimize.  
+        If True, return output from newton_solve().
     tol : float, 1e-12
-        Norm error allowed in fit to pairwise correlations.
+        Max error allowed in fit to pairwise correlations.
     return_as_full_vec : bool, False
         If True, return the couplings J as part of a full (h, J) vector that can be passed
         directly in to the coniii module.
+    J0 : ndarray, None
+        Initial guess, for example the solution for a neighboring n.
+    q : float or ndarray, 1.
+        Probability that the Median moves into the majority in the MVM. The correlation
+        between the Median and Ordinary voters is proportional to q. Many values of q are
+        solved at once if an array is given. Only used when data_corr is None.
 
     Returns
     -------
     ndarray
         [Jmo, Joo] or (h, J) vector that can be passed to ConIII.
     dict (optional)
-        From scipy.minimize.
+        From newton_solve().
     """
     
+    coeffs, offset, weights, kList, norm = maxent_terms(n)
+    offset = offset + np.log(weights)
+
     if data_corr is None:
         smo, soo = corr(n)
-        smo_fun, _, soo_fun, _, _ = setup_maxent(n)
-        def cost(params, as_vec=False):
-            Jmo, Joo = params
-            if as_vec:
-                return np.array([smo-smo_fun(Jmo, Jmo, Joo, Joo),
-                                 soo-soo_fun(Jmo, Jmo, Joo, Joo)])
-            return np.sqrt((smo-smo_fun(Jmo, Jmo, Joo, Joo))**2 +
-                           (soo-soo_fun(Jmo, Jmo, Joo, Joo))**2)
-        soln = minimize(cost, [0,0], tol=1e-10)
-        soln = root(lambda x:cost(x, as_vec=True), soln['x'])
+        smo = np.multiply(q, smo)
+        soo = np.zeros_like(smo) + soo
+        # O' is an ordinary voter, so its couplings are tied to the others
+        tie = np.array([[1,0],[1,0],[0,1],[0,1]])
+        tiedNorm = norm.dot(tie)
+        x, soln = newton_solve(coeffs.dot(tie), offset,
+                               (np.stack([smo, smo, soo, soo], -1) * norm).dot(tie) / tiedNorm,
+                               norm=tiedNorm,
+                               J0=J0,
+                               tol=tol,
+                               full_output=True)
     else:
-        smo, smop, soo, soop = data_corr
-        smo_fun, smop_fun, soo_fun, soop_fun, _ = setup_maxent(n)
-        def cost(params, as_vec=False):
-            if as_vec:
-                return np.array([smo - smo_fun(*params),
-                                 smop - smop_fun(*params),
-                                 soo - soo_fun(*params),
-                                 soop - soop_fun(*params)])
-            return np.sqrt((smo - smo_fun(*params))**2 +
-                           (smop - smop_fun(*params))**2 + 
-                           (soo - soo_fun(*params))**2 +
-                           (soop - soop_fun(*params))**2)
-        soln = minimize(cost, [.1,.1,0,0], tol=1e-10)
-        soln = root(lambda x:cost(x, as_vec=True), soln['x'])
+        x, soln = newton_solve(coeffs, offset, data_corr,
+                               norm=norm,
+                               J0=J0,
+                               tol=tol,
+                               full_output=True)
 
     if return_as_full_vec:
         params = np.zeros(n+n*(n-1)//2)
-        params[n:2*n-1] = soln['x'][0]
-        params[2*n-1:] = soln['x'][1]
+        params[n:2*n-1] = x[0]
+        params[2*n-1:] = x[1]
     else:
-        params = soln['x']
+        params = x
 
     if full_output:
         return params, soln
@@ -183,12 +195,115 @@ def setup_fast_mvm(n):
                      for k in range(n//2+1,n)]) + np.exp(-_E_with_maj(Jmo,Joo,n)))/Z(Jmo,Joo)
     return smo, soo, Z
 
+@lru_cache(maxsize=None)
+def maxent_terms(n):
+    """Terms of the partition function of the maxent model of setup_maxent() with
+    couplings J=(Jm, Jmp, Jo, Jop). The negative energy of each term is affine in the
+    couplings, and each of the four pairwise correlations is the average of the coupling
+    coefficients of the terms normalized by the number of pairs.
+
+    Terms run over k in the majority with the O' voter with the majority and with the
+    median, with the majority and against the median, against the majority and with the
+    median, and against the majority and against the median.
+
+    Parameters
+    ----------
+    n : int
+
+    Returns
+    -------
+    ndarray
+        Coupling coefficients of the negative energy of dimensions (n_terms, 4).
+    ndarray
+        Offset of the negative energy given by the log of the number of states.
+    ndarray
+        Fraction of states in each term.
+    ndarray
+        k voters in the majority for each term.
+    ndarray
+        Number of pairs normalizing each correlation.
+    """
+
+    def neg_energy(k):
+        """Coupling coefficients of each of the four terms for k in the majority."""
+        return np.stack([np.stack([2*k-n-2, np.ones_like(k),
+                                   binom(k-2,2)+binom(n-k,2)-(k-2)*(n-k), 2*k-n-2], -1),
+                         np.stack([2*k-n, -np.ones_like(k),
+                                   binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1), n-2*k], -1),
+                         np.stack([n-2*k-2, np.ones_like(k),
+                                   binom(n-k-2,2)+binom(k,2)-(n-k-2)*k, n-2*k-2], -1),
+                         np.stack([n-2*k, -np.ones_like(k),
+                                   binom(n-k-1,2)+binom(k-1,2)-(n-k-1)*(k-1), 2*k-n], -1)],
+                        -2).astype(float)
+
+    k = np.arange(n//2+1, n-1)
+    coeffs = np.vstack((neg_energy(k).reshape(-1, 4),
+                        neg_energy(np.array([n-1]))[0,[0,1,3]],
+                        neg_energy(np.array([n]))[0,:1]))
+    offset = np.concatenate((np.repeat(np.log(binom(n,k)), 4), np.zeros(3)+np.log(n), [0]))
+    weights = np.concatenate((np.stack([k * (k-1),
+                                        k * (n-k),
+                                        (n-k) * (n-k-1),
+                                        (n-k) * k], -1).ravel() / (n * (n-1)),
+                              [(n-2)/n, 1/n, 1/n, 1]))
+    kList = np.concatenate((np.repeat(k, 4), [n-1, n-1, n-1, n]))
+    norm = np.array([n-2, 1, binom(n-2,2), n-2])
+    
+    for x in (coeffs, offset, weights, kList, norm):
+        x.setflags(write=False)
+    return coeffs, offset, weights, kList, norm
+
+def setup_maxent_evaluator(n, cache_size=4):
+    """Single evaluator for the partition function, the pairwise correlations, and p(k)
+    of the maxent model of setup_maxent(). All quantities are computed together from one
+    vector of terms and memoized on the couplings, so asking for each correlation in turn
+    only evaluates the model once.
+
+    Parameters
+    ----------
+    n : int
+    cache_size : int, 4
+
+    Returns
+    -------
+    function
+        evaluate(Jm, Jmp, Jo, Jop) that returns logZ, the correlations (smo, smop, soo,
+        sop), and p(k) for k from n//2+1 to n.
+    """
+
+    from .utils import ParameterCache
+
+    coeffs, offset, weights, kList, norm = maxent_terms(n)
+    kix = kList - (n//2+1)
+    cache = ParameterCache(cache_size)
+
+    def _evaluate(J):
+        negE = coeffs.dot(J) + offset
+        mx = negE.max()
+        x = np.exp(negE - mx) * weights
+        Z = x.sum()
+        p = x / Z
+
+        sisj = p.dot(coeffs) / norm
+        pk = np.bincount(kix, weights=p, minlength=n-n//2)
+        sisj.setflags(write=False)
+        pk.setflags(write=False)
+        return np.log(Z) + mx, sisj, pk
+
+    def evaluate(*J):
+        J = np.array(J, dtype=float)
+        return cache.get(lambda: _evaluate(J), J)
+
+    return evaluate
+
 def setup_maxent(n):
     """Correlation functions of the Median Voter Model with special Ordinary voter O' that
     has special couplings with the Median and the remaining O voters. Using more stable
     formulation of logsumexp.
     
     Check formulation in SCOTUS II pg. 116.
+
+    All functions share a single memoized evaluator from setup_maxent_evaluator().
     
     Parameters
     ----------
@@ -209,340 +324,244 @@ def setup_maxent(n):
         Distribution of k votes in the majority.
     """
     
-    E_with_maj_with_median = lambda Jm,Jmp,Jo,Jop,k,n=n: -(Jm*(2*k-n-2) +
-                                          Jmp +
-                                          Jo*(binom(k-2,2)+binom(n-k,2)-(k-2)*(n-k)) +
-                                          Jop*(2*k-n-2))
-    E_with_maj_against_median = lambda Jm,Jmp,Jo,Jop,k,n=n: -(Jm*(2*k-n) -
-                                          Jmp +
-                                          Jo*(binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1)) +
-                                          Jop*(n-2*k))
-    E_not_with_maj_with_median = lambda Jm,Jmp,Jo,Jop,k,n=n: -(Jm*(n-2*k-2) +
-                                          Jmp +
-                                          Jo*(binom(n-k-2,2)+binom(k,2)-(n-k-2)*k) +
-                                          Jop*(n-2*k-2))
-    E_not_with_maj_against_median = lambda Jm,Jmp,Jo,Jop,k,n=n: -(Jm*(n-2*k) -
-                                          Jmp +
-                                          Jo*(binom(n-k-1,2)+binom(k-1,2)-(n-k-1)*(k-1)) +
-                                          Jop*(2*k-n))
+    evaluate = setup_maxent_evaluator(n)
    
-    def logZ(*J, n=n):
-        coeffs = []
-        exp = []
-        for k in range(n//2+1, n-1):
-            coeffs += [k * (k-1) / (n * (n-1)),
-                       k * (n-k) / (n * (n-1)),
-                       (n-k) * (n-k-1) / (n * (n-1)),
-                       (n-k) * k / (n * (n-1))]
-            exp += [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-        coeffs += [(n-2) / n, 1/n, 1/n, 1]
-        exp += [-E_with_maj_with_median(*J, n-1) + np.log(n),
-                -E_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_not_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_with_maj_with_median(*J, n)]
-        return fast_logsumexp(exp, coeffs)[0]
-
-    #Z = lambda Jm,Jmp,Jo,Jop,n=n:( sum([binom(n,k) * 
-    #       (k/n * ((k-1)/(n-1) * np.exp(-E_with_maj_with_median(Jm,Jmp,Jo,Jop,k)) +
-    #               (n-k)/(n-1) * np.exp(-E_with_maj_against_median(Jm,Jmp,Jo,Jop,k))) +
-    #       (n-k)/n * ((n-k-1)/(n-1) * np.exp(-E_not_with_maj_with_median(Jm,Jmp,Jo,Jop,k)) + 
-    #                  k/(n-1) * np.exp(-E_not_with_maj_against_median(Jm,Jmp,Jo,Jop,k))))
-    #                        for k in range(n//2+1,n-1)]) + 
-    #       n*((n-1)/n * ((n-2)/(n-1) * np.exp(-E_with_maj_with_median(Jm,Jmp,Jo,Jop,n-1)) +
-    #               1/(n-1) * np.exp(-E_with_maj_against_median(Jm,Jmp,Jo,Jop,n-1))) +
-    #               1/n * np.exp(-E_not_with_maj_against_median(Jm,Jmp,Jo,Jop,n-1))) + 
-    #       np.exp(-E_with_maj_with_median(Jm,Jmp,Jo,Jop,n)))
-    
     # <s_Median s_Ordinary>
-    def smo(*J, n=n):
-        coeffs = []
-        exp = []
-        for k in range(n//2+1, n-1):
-            coeffs += [k * (k-1) * (2*k-n-2) / (n * (n-1) * (n-2)),
-                       k * (n-k) * (2*k-n) / (n * (n-1) * (n-2)),
-                       (n-k) * (n-k-1) * (n-2*k-2) / (n * (n-1) * (n-2)),
-                       (n-k) * k * (n-2*k) / (n * (n-1) * (n-2))]
-            exp += [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-        coeffs += [(n-4)/n, 1/n, -1/n, 1]
-        exp += [-E_with_maj_with_median(*J, n-1) + np.log(n),
-                -E_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_not_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_with_maj_with_median(*J, n)]
-        num, sign = fast_logsumexp(exp, coeffs)
-        return sign * np.exp( num - logZ(*J) )
+    def smo(*J):
+        return evaluate(*J)[1][0]
 
     # <s_M s_O'>
-    def smop(*J, n=n):
-        coeffs = []
-        exp = []
-        for k in range(n//2+1, n-1):
-            coeffs += [k * (k-1) / (n * (n-1)),
-                       k * (k-n) / (n * (n-1)),
-                       (n-k) * (n-k-1) / (n * (n-1)),
-                       (n-k) * -k / (n * (n-1))]
-            exp += [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-        coeffs += [(n-2)/n, -1/n, -1/n, 1]
-        exp += [-E_with_maj_with_median(*J, n-1) + np.log(n),
-                -E_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_not_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_with_maj_with_median(*J, n)]
-        num, sign = fast_logsumexp(exp, coeffs)
-        return sign * np.exp( num - logZ(*J) )
+    def smop(*J):
+        return evaluate(*J)[1][1]
     
     # <s_O s_O''>
-    def soo(*J, n=n):
-        coeffs = []
-        exp = []
-        for k in range(n//2+1, n-1):
-            coeffs += [k * (k-1) * (binom(k-2,2)+binom(n-k,2)-(k-2)*(n-k)) / (n * (n-1) * binom(n-2,2)),
-                       k * (n-k) * (binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1)) / (n * (n-1) * binom(n-2,2)),
-                       (n-k) * (n-k-1) * (binom(n-k-2,2)+binom(k,2)-(n-k-2)*k) / (n * (n-1) * binom(n-2,2)),
-                       (n-k) * k * (binom(n-k-1,2)+binom(k-1,2)-(n-k-1)*(k-1)) / (n * (n-1) * binom(n-2,2))]
-            exp += [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-        coeffs += [(n-2) * (binom(n-3,2)-(n-3)) / (n * binom(n-2,2)), 1/n, 1/n, 1]
-        exp += [-E_with_maj_with_median(*J, n-1) + np.log(n),
-                -E_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_not_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_with_maj_with_median(*J, n)]
-        num, sign = fast_logsumexp(exp, coeffs)
-        return sign * np.exp( num - logZ(*J) )
+    def soo(*J):
+        return evaluate(*J)[1][2]
  
     # <s_O s_O'>
-    def sop(*J, n=n):
-        coeffs = []
-        exp = []
-        for k in range(n//2+1, n-1):
-            coeffs += [k * (k-1) * (2*k-n-2) / (n * (n-1) * (n-2)),
-                       k * (n-k) * (n-2*k) / (n * (n-1) * (n-2)),
-                       (n-k) * (n-k-1) * (n-2*k-2) / (n * (n-1) * (n-2)),
-                       (n-k) * k * (2*k-n) / (n * (n-1) * (n-2))]
-            exp += [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                    -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-        coeffs += [(n-4)/n, -1/n, 1/n, 1]
-        exp += [-E_with_maj_with_median(*J, n-1) + np.log(n),
-                -E_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_not_with_maj_against_median(*J, n-1) + np.log(n),
-                -E_with_maj_with_median(*J, n)]
-        num, sign = fast_logsumexp(exp, coeffs)
-        return sign * np.exp( num - logZ(*J) )
-
-    def pk(*J, n=n):
-        logpk = np.zeros(n-n//2)
-        counter = 0
-        for k in range(n//2+1, n-1):
-            coeffs = [k * (k-1) / (n * (n-1)),
-                      k * (n-k) / (n * (n-1)),
-                      (n-k) * (n-k-1) / (n * (n-1)),
-                      (n-k) * k / (n * (n-1))]
-            exp = [-E_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                   -E_with_maj_against_median(*J, k) + np.log(binom(n,k)),
-                   -E_not_with_maj_with_median(*J, k) + np.log(binom(n,k)),
-                   -E_not_with_maj_against_median(*J, k) + np.log(binom(n,k))]
-            logpk[counter] = fast_logsumexp(exp, coeffs)[0]
-            counter += 1
-        coeffs = [(n-2)/n, 1/n, 1/n]
-        exp = [-E_with_maj_with_median(*J, n-1) + np.log(n),
-               -E_with_maj_against_median(*J, n-1) + np.log(n),
-               -E_not_with_maj_against_median(*J, n-1) + np.log(n)]
-        logpk[counter] = fast_logsumexp(exp, coeffs)[0]
-        counter += 1
+    def sop(*J):
+        return evaluate(*J)[1][3]
 
-        logpk[counter] = -E_with_maj_with_median(*J, n)
-        return np.exp( logpk - logZ(*J) )
+    def pk(*J):
+        return evaluate(*J)[2].copy()
 
     return smo, smop, soo, sop, pk
 
+def _pair_sum(a, b):
+    """Sum of pairwise couplings within two blocs of a and b spins that agree within and
+    disagree across the blocs."""
+    return binom(a,2) + binom(b,2) - a*b
+
+@lru_cache(maxsize=None)
+def mo_perturbation_terms(n):
+    """Terms of the partition function of the M->O perturbation model of
+    setup_mo_perturbation() with couplings J=(Jmop, Jmo, Joop, Joo). The negative energy
+    of each term is affine in the couplings,
+        logPartitionList = coeffs.dot(J) + offset,
+    and each pairwise correlation is the average of the corresponding column of coeffs
+    divided by the number of pairs in norm.
+
+    Parameters
+    ----------
+    n : int
+
+    Returns
+    -------
+    ndarray
+        coeffs, of dimensions (n_terms, 4).
+    ndarray
+        offset, the log multiplicity of each term.
+    ndarray
+        norm
+    """
+    
+    k = np.arange(n//2+1, n)
+    one = np.ones_like(k)
+    # each term is determined by placement of median and Op voter in maj or min
+    coeffs = np.stack([np.stack([one, (k-2)-(n-k), (k-2)-(n-k), _pair_sum(k-2,n-k)], -1),
+                       np.stack([-one, (k-1)-(n-k-1), (n-k-1)-(k-1), _pair_sum(k-1,n-k-1)], -1),
+                       np.stack([-one, (n-k-1)-(k-1), (k-1)-(n-k-1), _pair_sum(k-1,n-k-1)], -1),
+                       np.stack([one, (n-k-2)-k, (n-k-2)-k, _pair_sum(n-k-2,k)], -1)], 1)
+    # fraction of ways of arranging spins in maj and min coalitions given n choose k
+    coeff = np.stack([k*(k-1), k*(n-k), k*(n-k), (n-k)*(n-k-1)], 1) / (n*(n-1))
+    keep = coeff>0
+    
+    # handle special case of k=n
+    coeffs = np.vstack((coeffs[keep], [1, n-2, n-2, binom(n-2,2)])).astype(float)
+    offset = np.append(np.log(coeff[keep]) + np.log(binom(n,np.broadcast_to(k[:,None], keep.shape)[keep])), 0)
+    norm = np.array([1, n-2, n-2, binom(n-2,2)])
+
+    for x in (coeffs, offset, norm):
+        x.setflags(write=False)
+    return coeffs, offset, norm
+
 def setup_mo_perturbation(n, Jmop, Jmo, Joop, Joo):
     """Perturbation of <sM sO>
     involves 4 couplings"""
     
-    logPartitionList = []
-    sMOpcoeffs = []
-    sMOcoeffs = []
-    sOOpcoeffs = []
-    sOOcoeffs = []
-
-    for k in range(n//2+1,n):
-            # energy term determined by placement of median or Op voter in maj or min
-            # consider median to be first spin
-            # 0 indicates vote in maj
-            # 1 indicates vote in min
-            # coeffs are fraction of ways of arranging spins in maj and min coalitions given n choose k
-            E = (-Jmop -Jmo*((k-2)-(n-k)) -Joop*((k-2)-(n-k))
-                 -Joo*(binom(k-2,2)+binom(n-k,2)-(k-2)*(n-k)))
-            coeff = k*(k-1) / (n*(n-1))
-            sMOpcoeffs.append(1)
-            sMOcoeffs.append(((k-2)-(n-k))/(n-2))
-            sOOpcoeffs.append(((k-2)-(n-k))/(n-2))
-            sOOcoeffs.append((binom(k-2,2)+binom(n-k,2)-(k-2)*(n-k))/binom(n-2,2))
-            logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-
-            E = (Jmop -Jmo*((k-1)-(n-k-1)) -Joop*((n-k-1)-(k-1))
-                 -Joo*(binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1)))
-            coeff = k*(n-k) / (n*(n-1))
-            sMOpcoeffs.append(-1)
-            sMOcoeffs.append(((k-1)-(n-k-1))/(n-2))
-            sOOpcoeffs.append(((n-k-1)-(k-1))/(n-2))
-            sOOcoeffs.append((binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1))/binom(n-2,2))
-            logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-
-            E = (Jmop -Jmo*((n-k-1)-(k-1)) -Joop*((k-1)-(n-k-1))
-                 -Joo*(binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1)))
-            coeff = k*(n-k) / (n*(n-1))
-            if coeff>0:
-                sMOpcoeffs.append(-1)
-                sMOcoeffs.append(((n-k-1)-(k-1))/(n-2))
-                sOOpcoeffs.append(((k-1)-(n-k-1))/(n-2))
-                sOOcoeffs.append((binom(k-1,2)+binom(n-k-1,2)-(k-1)*(n-k-1))/binom(n-2,2))
-                logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-
-            E = (-Jmop -Jmo*((n-k-2)-k) -Joop*((n-k-2)-k)
-                 -Joo*(binom(n-k-2,2)+binom(k,2)-(n-k-2)*k))
-            coeff = (n-k)*(n-k-1) / (n*(n-1))
-            if coeff>0:
-                sMOpcoeffs.append(1)
-                sMOcoeffs.append(((n-k-2)-k)/(n-2))
-                sOOpcoeffs.append(((n-k-2)-k)/(n-2))
-                sOOcoeffs.append((binom(n-k-2,2)+binom(k,2)-(n-k-2)*k)/binom(n-2,2))
-                logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-
-    # handle special case of k=n ====================================
-    E = -Jmop -Jmo*(n-2) -Joop*(n-2) -Joo*binom(n-2,2)
-    sMOpcoeffs.append(1)
-    sMOcoeffs.append(1)
-    sOOpcoeffs.append(1)
-    sOOcoeffs.append(1)
-    logPartitionList.append( -E )
-    
+    coeffs, offset, norm = mo_perturbation_terms(n)
+    logPartitionList = coeffs.dot([Jmop, Jmo, Joop, Joo]) + offset
+    sMOpcoeffs, sMOcoeffs, sOOpcoeffs, sOOcoeffs = (coeffs / norm).T
     return (logPartitionList,
             sMOpcoeffs,
             sMOcoeffs,
             sOOpcoeffs,
             sOOcoeffs)
 
+@lru_cache(maxsize=None)
+def oo_perturbation_terms(n):
+    """Terms of the partition function of the O->O perturbation model of
+    setup_oo_perturbation() with couplings J=(Jmop, Jmo, Jo1o2, Joop, Joo). See
+    mo_perturbation_terms().
+
+    Parameters
+    ----------
+    n : int
+
+    Returns
+    -------
+    ndarray
+        coeffs, of dimensions (n_terms, 5).
+    ndarray
+        offset, the log multiplicity of each term.
+    ndarray
+        norm
+    """
+    
+    k = np.arange(n//2+1, n)
+    zero = np.zeros_like(k)
+    one = np.ones_like(k)
+    # each term is determined by placement of the two Op voters in maj or min
+    coeffs = np.stack([np.stack([2*one, k-3-(n-k), one, 2*(k-3-(n-k)), _pair_sum(k-3,n-k)], -1),
+                       np.stack([zero, k-2-(n-k-1), -one, zero, _pair_sum(k-2,n-k-1)], -1),
+                       np.stack([-2*one, k-1-(n-k-2), one, 2*(n-k-2-(k-1)), _pair_sum(k-1,n-k-2)], -1),
+                       np.stack([-2*one, n-k-1-(k-2), one, 2*(k-2-(n-k-1)), _pair_sum(k-2,n-k-1)], -1),
+                       np.stack([zero, n-k-2-(k-1), -one, zero, _pair_sum(k-1,n-k-2)], -1),
+                       np.stack([2*one, n-k-3-k, one, 2*(n-k-3-k), _pair_sum(n-k-3,k)], -1)], 1)
+    # fraction of ways of arranging spins in maj and min coalitions given n choose k
+    coeff = np.stack([k*(k-1)*(k-2),
+                      2*k*(k-1)*(n-k),
+                      k*(n-k)*(n-k-1),
+                      k*(k-1)*(n-k),
+                      2*k*(n-k)*(n-k-1),
+                      (n-k)*(n-k-1)*(n-k-2)], 1) / (n*(n-1)*(n-2))
+    keep = coeff>0
+    
+    # handle special case of k=n
+    coeffs = np.vstack((coeffs[keep], [2, n-3, 1, 2*(n-3), binom(n-3,2)])).astype(float)
+    offset = np.append(np.log(coeff[keep]) + np.log(binom(n,np.broadcast_to(k[:,None], keep.shape)[keep])), 0)
+    norm = np.array([2, n-3, 1, 2*n-6, binom(n-3,2)])
+
+    for x in (coeffs, offset, norm):
+        x.setflags(write=False)
+    return coeffs, offset, norm
+
 def setup_oo_perturbation(n, Jmop, Jmo, Jo1o2, Joop, Joo):
     """Perturbation of <sO_1 sO_2>
     involves 5 couplings"""
     
-    logPartitionList = []
-    sMOpcoeffs = []
-    sMOcoeffs = []
-    sO1O2pcoeffs = []
-    sOOpcoeffs = []
-    sOOcoeffs = []
-
-    for k in range(n//2+1,n):
-        # energy term determined by placement of median or Op voter in maj or min
-        # consider median to be first spin
-        # 0 indicates vote in maj
-        # 1 indicates vote in min
-        # coeffs are fraction of ways of arranging spins in maj and min coalitions given n choose k
-        # 1
-        E = (-2*Jmop -Jmo*(k-3-(n-k)) -Jo1o2 -Joo*(binom(k-3,2)+binom(n-k,2)-(k-3)*(n-k))
-             -2*Joop*(k-3-(n-k)))
-        coeff = k*(k-1)*(k-2) / (n*(n-1)*(n-2))
-        sMOpcoeffs.append(1)
-        sMOcoeffs.append((k-3-(n-k))/(n-3))
-        sO1O2pcoeffs.append(1)
-        sOOcoeffs.append((binom(k-3,2)+binom(n-k,2)-(k-3)*(n-k))/binom(n-3,2))
-        sOOpcoeffs.append(2*(k-3-(n-k))/(2*n-6))
-        logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-        
-        # 2
-        E = (-Jmo*(k-2-(n-k-1)) +Jo1o2 -Joo*(binom(k-2,2)+binom(n-k-1,2)-(k-2)*(n-k-1))
-             -Joop*((k-2-(n-k-1)) + (n-k-1-(k-2))))
-        coeff = 2 * k*(k-1)*(n-k) / (n*(n-1)*(n-2))
-        sMOpcoeffs.append(0)
-        sMOcoeffs.append((k-2-(n-k-1))/(n-3))
-        sO1O2pcoeffs.append(-1)
-        sOOcoeffs.append((binom(k-2,2)+binom(n-k-1,2)-(k-2)*(n-k-1))/binom(n-3,2))
-        sOOpcoeffs.append(((k-2-(n-k-1)) + (n-k-1-(k-2)))/(2*n-6))
-        logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-
-        # 3
-        E = (2*Jmop -Jmo*(k-1-(n-k-2)) -Jo1o2 -Joo*(binom(k-1,2)+binom(n-k-2,2)-(k-1)*(n-k-2))
-             -Joop*(n-k-2-(k-1))*2)
-        coeff = k*(n-k)*(n-k-1) / (n*(n-1)*(n-2))
-        if coeff>0:
-            sMOpcoeffs.append(-1)
-            sMOcoeffs.append((k-1-(n-k-2))/(n-3))
-            sO1O2pcoeffs.append(1)
-            sOOcoeffs.append((binom(k-1,2)+binom(n-k-2,2)-(k-1)*(n-k-2))/binom(n-3,2))
-            sOOpcoeffs.append((n-k-2-(k-1))*2/(2*n-6))
-            logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-           
-        # 4
-        E = (2*Jmop -Jmo*(n-k-1-(k-2)) -Jo1o2 -Joo*(binom(k-2,2)+binom(n-k-1,2)-(k-2)*(n-k-1))
-             -Joop*(k-2-(n-k-1))*2)
-        coeff = k*(k-1)*(n-k) / (n*(n-1)*(n-2))
-        sMOpcoeffs.append(-1)
-        sMOcoeffs.append((n-k-1-(k-2))/(n-3))
-        sO1O2pcoeffs.append(1)
-        sOOcoeffs.append((binom(k-2,2)+binom(n-k-1,2)-(k-2)*(n-k-1))/binom(n-3,2))
-        sOOpcoeffs.append((k-2-(n-k-1))*2/(2*n-6))
-        logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-        
-        # 5
-        E = (-Jmo*(n-k-2-(k-1)) +Jo1o2 -Joo*(binom(k-1,2)+binom(n-k-2,2)-(k-1)*(n-k-2))
-             -Joop*((k-1-(n-k-2)) + (n-k-2-(k-1))))
-        coeff = 2 * k*(n-k)*(n-k-1) / (n*(n-1)*(n-2))
-        if coeff>0:
-            sMOpcoeffs.append(0)
-            sMOcoeffs.append((n-k-2-(k-1))/(n-3))
-            sO1O2pcoeffs.append(-1)
-            sOOcoeffs.append((binom(k-1,2)+binom(n-k-2,2)-(k-1)*(n-k-2))/binom(n-3,2))
-            sOOpcoeffs.append(((k-1-(n-k-2)) + (n-k-2-(k-1)))/(2*n-6))
-            logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-        
-        # 6
-        E = (-2*Jmop -Jmo*(n-k-3-k) -Jo1o2 -Joo*(binom(n-k-3,2)+binom(k,2)-k*(n-k-3))
-             -Joop*(n-k-3-k)*2)
-        coeff = (n-k)*(n-k-1)*(n-k-2) / (n*(n-1)*(n-2))
-        if coeff>0:
-            sMOpcoeffs.append(1)
-            sMOcoeffs.append((n-k-3-k)/(n-3))
-            sO1O2pcoeffs.append(1)
-            sOOcoeffs.append((binom(n-k-3,2)+binom(k,2)-k*(n-k-3))/binom(n-3,2))
-            sOOpcoeffs.append((n-k-3-k)*2/(2*n-6))
-            logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-        
-    # handle special case of k=n ====================================
-    E = -2*Jmop -Jmo*(n-3) -Jo1o2 -Joo*binom(n-3,2) -2*Joop*(n-3)
-    sMOpcoeffs.append(1)
-    sMOcoeffs.append(1)
-    sO1O2pcoeffs.append(1)
-    sOOpcoeffs.append(1)
-    sOOcoeffs.append(1)
-    logPartitionList.append( -E )
-    
+    coeffs, offset, norm = oo_perturbation_terms(n)
+    logPartitionList = coeffs.dot([Jmop, Jmo, Jo1o2, Joop, Joo]) + offset
+    sMOpcoeffs, sMOcoeffs, sO1O2pcoeffs, sOOpcoeffs, sOOcoeffs = (coeffs / norm).T
     return logPartitionList, sMOpcoeffs, sMOcoeffs, sO1O2pcoeffs, sOOpcoeffs, sOOcoeffs
 
+@lru_cache(maxsize=None)
+def perturbation_coefficients(n):
+    """Coefficients of the full perturbation model as detailed on SCOTUS II pg. 124. These
+    only depend on n, so they are computed once and cached. The log of each term in the
+    partition function is affine in the 12 couplings J,
+        logPartitionList = coeffs.dot(J) + offset.
+
+    Consider the median to be the first spin and the Op voters to be the next four. Rows
+    run over k in the majority and then over the configuration of these five spins (0
+    for a vote in the majority and 1 for the minority) in the order of bin_states(5).
+    Configurations that cannot be realized for a given k are dropped. The last row is the
+    special case of k=n.
+    
+    Parameters
+    ----------
+    n : int
+    
+    Returns
+    -------
+    ndarray
+        coeffs, of dimensions (n_terms, 12).
+    ndarray
+        offset, the log multiplicity of each term.
+    ndarray
+        k voters in the majority for each term.
+    ndarray
+        Coefficients of partition function necessary for calculating pairwise
+        correlations, of dimensions (12, n_terms).
+    """
+
+    config = bin_states(5)[None,:,:]
+    k = np.arange(n//2+1, n)[:,None]
+    nmin = config.sum(2)  # no. of these five spins in the min.
+    nmaj = 5 - nmin
+    # remaining spins in maj and min
+    nmajRest = k - nmaj
+    nminRest = n - k - nmin
+    dmaj = nmajRest - nminRest
+    
+    same = lambda a, b: config[...,a]==config[...,b]
+    couplingsCoeff = np.zeros((k.size, config.shape[1], 12))
+    couplingsCoeff[...,0] = np.where(same(0,1), 1, -1)
+    couplingsCoeff[...,1] = np.where(same(0,2), 1, -1)
+    couplingsCoeff[...,2] = np.where(config[...,1]==0, dmaj, -dmaj)
+    couplingsCoeff[...,3] = np.where(config[...,2]==0, dmaj, -dmaj)
+    # terms with the last two Op voters only contribute when they agree
+    couplingsCoeff[...,4] = np.where(same(3,4), np.where(same(1,3), 2, -2), 0)
+    couplingsCoeff[...,5] = np.where(same(3,4), np.where(same(2,3), 2, -2), 0)
+    couplingsCoeff[...,6] = np.where(same(3,4), 1, -1)
+    couplingsCoeff[...,7] = np.where(same(3,4), np.where(config[...,3]==0, 2*dmaj, -2*dmaj), 0)
+    couplingsCoeff[...,8] = binom(nmajRest,2) + binom(nminRest,2) - nmajRest*nminRest
+    couplingsCoeff[...,9] = np.where(config[...,0]==0, dmaj, -dmaj)
+    couplingsCoeff[...,10] = np.where(same(3,4), np.where(same(0,3), 2, -2), 0)
+    couplingsCoeff[...,11] = np.where(same(1,2), 1, -1)
+
+    # coefficient term in front of exponential counting multiplicity of state, the fraction
+    # of ways of arranging spins in maj and min coalitions given n choose k
+    coeff = np.ones(couplingsCoeff.shape[:2])
+    for i in range(5):
+        coeff *= np.where(i<nmin, n-k-i, 1) * np.where(i<nmaj, k-i, 1)
+    coeff /= n*(n-1)*(n-2)*(n-3)*(n-4)
+    keep = coeff>0
+    
+    # handle special case of k=n
+    couplingsCoeffN = np.ones(12)
+    couplingsCoeffN[[2,3,9]] = n-5
+    couplingsCoeffN[[4,5,10]] = 2
+    couplingsCoeffN[7] = 2*(n-5)
+    couplingsCoeffN[8] = binom(n-5,2)
+    
+    coeffs = np.vstack((couplingsCoeff[keep], couplingsCoeffN))
+    kList = np.broadcast_to(k, keep.shape)[keep]
+    offset = np.append(np.log(coeff[keep]) + np.log(binom(n,kList)), 0)
+    kList = np.append(kList, n)
+    norm = np.array([1, 1, n-5, n-5, 2, 2, 1, 2*(n-5), binom(n-5,2), n-5, 2, 1])
+    sisjCoeffs = np.hstack((couplingsCoeff[keep].T / norm[:,None], np.ones((12,1))))
+    
+    for x in (coeffs, offset, kList, sisjCoeffs):
+        x.setflags(write=False)
+    return coeffs, offset, kList, sisjCoeffs
+
 def setup_perturbation(J, n):
     """Full perturbation model as detailed on SCOTUS II pg. 124.
+
+    The log terms of the partition function are a single product with the cached
+    coefficients from perturbation_coefficients().
     
     Parameters
     ----------
     J : ndarray
-        12 couplings specifying all perturbations possible for MVM.
+        12 couplings specifying all perturbations possible for MVM. A stack of couplings
+        of dimensions (n_samples, 12) returns one row of log terms for each.
     n : int
     
     Returns
     -------
-    list
+    ndarray
         Log of terms in partition function.
     list
         k voters in the majority for each term in partition list.
@@ -550,168 +569,131 @@ def setup_perturbation(J, n):
         Coefficients of partition function necessary for calculating pairwise correlations.
     """
     
-    logPartitionList = []
-    kList = []
-    sisjCoeffs = [[] for i in range(12)]
-    
-    for k in range(n//2+1,n):
-        thiskCoeffSum = 0
-        # energy term determined by placement of median or Op voter in maj or min
-        # consider median to be first spin
-        # 0 indicates vote in maj
-        # 1 indicates vote in min
-        # coeffs are fraction of ways of arranging spins in maj and min coalitions given n choose k
-        # 1
-        for config in bin_states(5):
-            nmin = config.sum()  # no. of these five spins in the min.
-            nmaj = 5 - nmin
-#             if nmin<=(n-k):  # why is this condition unnecessary? because of nans
-            # calculate coefficients for each coupling term
-            couplingsCoeff = np.zeros(12)-1
-            if config[0]==config[1]:
-                couplingsCoeff[0] = 1.
-            if config[0]==config[2]:
-                couplingsCoeff[1] = 1.
-            if config[1]==0:
-                couplingsCoeff[2] = (k-nmaj) -(n-k-nmin)
-            else:
-                couplingsCoeff[2] = (n-k-nmin) -(k-nmaj)
-            if config[2]==0:
-                couplingsCoeff[3] = (k-nmaj) -(n-k-nmin)
-            else:
-                couplingsCoeff[3] = (n-k-nmin) -(k-nmaj)
-            if config[1]==config[2]:
-                couplingsCoeff[11] = 1
-
-            if config[3]==config[4]:
-                if config[1]==config[3]:
-                    couplingsCoeff[4] = 2
-                else:
-                    couplingsCoeff[4] = -2
-                if config[2]==config[3]:
-                    couplingsCoeff[5] = 2
-                else:
-                    couplingsCoeff[5] = -2
-                couplingsCoeff[6] = 1
-
-                if config[3]==0:
-                    couplingsCoeff[7] = 2 * (k-nmaj -(n-k-nmin))
-                else:
-                    couplingsCoeff[7] = -2 * (k-nmaj -(n-k-nmin))
-                if config[0]==config[3]:
-                    couplingsCoeff[10] = 2
-                else:
-                    couplingsCoeff[10] = -2
-            else:
-                couplingsCoeff[4] = 0
-                couplingsCoeff[5] = 0
-                couplingsCoeff[7] = 0
-                couplingsCoeff[10] = 0
-            couplingsCoeff[8] = binom(k-nmaj,2) + binom(n-k-nmin,2) -(k-nmaj)*(n-k-nmin)
-            if config[0]==0:
-                couplingsCoeff[9] = (k-nmaj) -(n-k-nmin)
-            else:
-                couplingsCoeff[9] = (n-k-nmin) -(k-nmaj)
-            E = -J.dot(couplingsCoeff)
-            
-            # coefficient term in front of exponential counting multiplicity of state
-            coeff = 1.
-            majCounter = 0
-            minCounter = 0
-            for i in range(config.sum()):
-                coeff *= n-k-minCounter
-                minCounter += 1
-            for i in range(config.sum(),5):
-                coeff *= k-majCounter
-                majCounter += 1
-            coeff /= n*(n-1)*(n-2)*(n-3)*(n-4)
-
-            if coeff>0:
-                thiskCoeffSum += coeff
-                kList.append(k)
-                sisjCoeffs[0].append(couplingsCoeff[0])
-                sisjCoeffs[1].append(couplingsCoeff[1])
-                sisjCoeffs[2].append(couplingsCoeff[2]/(n-5))
-                sisjCoeffs[3].append(couplingsCoeff[3]/(n-5))
-                sisjCoeffs[4].append(couplingsCoeff[4]/2)
-                sisjCoeffs[5].append(couplingsCoeff[5]/2)
-                sisjCoeffs[6].append(couplingsCoeff[6])
-                sisjCoeffs[7].append(couplingsCoeff[7]/2/(n-5))
-                sisjCoeffs[8].append(couplingsCoeff[8]/binom(n-5,2))
-                sisjCoeffs[9].append(couplingsCoeff[9]/(n-5))
-                sisjCoeffs[10].append(couplingsCoeff[10]/2)
-                sisjCoeffs[11].append(couplingsCoeff[11])
-                # making this exact makes no difference
-                #logPartitionList.append( -E +np.log(coeff) +np.log(comb(n,k,exact=True)) )
-                logPartitionList.append( -E +np.log(coeff) +np.log(binom(n,k)) )
-        # this should be 1
-        # assert np.isclose( thiskCoeffSum, 1 )
-        
-    # handle special case of k=n ====================================
-    couplingsCoeff = np.ones(12)
-    couplingsCoeff[[2,3,9]] = n-5
-    couplingsCoeff[[4,5,10]] = 2
-    couplingsCoeff[7] = 2*(n-5)
-    couplingsCoeff[8] = binom(n-5,2)
-    E = -couplingsCoeff.dot(J)
-    for i in sisjCoeffs:
-        i.append(1)
-    logPartitionList.append(-E)
-    kList.append(n)
-    sisjCoeffs = [np.array(coeffs) for coeffs in sisjCoeffs]
-    
-    return logPartitionList, kList, sisjCoeffs
-
-def refine_perturbation(cost, J, refine_max_iter, refine_multiplier, tol):
-    """This is useless.
-    
-    Simple iterative refinement of perturbation solution for couplings. This just
-    increases the coupling if the pairwise correlation is too large and decreases it if
-    the pairwise correlation is too small, multiplying the error by the refine_multiplier
-    factor to change the coupling. When the error is already small, this can converge
-    well.
+    coeffs, offset, kList, sisjCoeffs = perturbation_coefficients(n)
+    logPartitionList = np.asarray(J).dot(coeffs.T) + offset
+    return logPartitionList, kList.tolist(), list(sisjCoeffs)
+
+def _warn_refine_deprecated(refine, refine_multiplier):
+    """Solutions are always found with newton_solve(), so the old refinement options have
+    no effect."""
+
+    if not (refine is None and refine_multiplier is None):
+        from warnings import warn
+        warn("refine and refine_multiplier are deprecated and have no effect.",
+             DeprecationWarning, stacklevel=3)
+
+def newton_solve(coeffs, offset, target,
+                 norm=None,
+                 J0=None,
+                 tol=1e-15,
+                 max_iter=100,
+                 max_step=.5,
+                 full_output=False):
+    """Solve for the couplings of a model whose log terms in the partition function are
+    affine in the couplings,
+        logPartitionList = coeffs.dot(J) + offset,
+    such that the pairwise correlations (coeffs averaged over the terms divided by norm)
+    match the target.
+
+    The Jacobian of the correlations is the covariance of the coefficients, so this is a
+    Newton solver with exact Jacobians and Levenberg-Marquardt damping that shrinks once
+    steps succeed. The problem is convex, so it typically converges in a handful of
+    iterations. Many targets are solved at once by passing a 2d array.
 
     Parameters
     ----------
-    cost : function
-        Returns vector indicating the errors on the current parameter estimate.
-    J : ndarray
-    refine_max_iter : int
-    refine_multiplier : float
-    tol : float
-        Norm2 error for stopping iteration.
+    coeffs : ndarray
+        (n_terms, n_couplings)
+    offset : ndarray
+        (n_terms,)
+    target : ndarray
+        Correlations to fit, of dimensions (n_couplings,) or (n_targets, n_couplings).
+    norm : ndarray, None
+        Normalization of each correlation. Default is ones.
+    J0 : ndarray, None
+        Initial guess. Default is zeros.
+    tol : float, 1e-15
+        Max absolute error allowed in the fit to the correlations.
+    max_iter : int, 100
+    max_step : float, .5
+        Max change in any coupling per iteration.
+    full_output : bool, False
 
     Returns
     -------
     ndarray
-        Couplings.
-    int
-        Error flag. 0 is good, 1 means not converged.
-    list
-        History of errors (to make sure that errors are decaying and not growing or
-        oscillating).
+        Couplings of the same dimensions as target.
+    dict (optional)
+        With keys 'x', 'fun' (errors on correlations), 'success', and 'nit'.
     """
     
-    J = J.copy()
-    dJ = np.ones_like(J)
+    squeeze = np.ndim(target)==1
+    target = np.atleast_2d(target).astype(float)
+    norm = np.ones(coeffs.shape[1]) if norm is None else np.asarray(norm, dtype=float)
+    if J0 is None:
+        J = np.zeros_like(target)
+    else:
+        J = np.broadcast_to(J0, target.shape).astype(float)
+
+    def stats(J, target):
+        negE = J.dot(coeffs.T) + offset
+        mx = negE.max(1)
+        p = np.exp(negE - mx[:,None])
+        Z = p.sum(1)
+        p /= Z[:,None]
+        mean = p.dot(coeffs)
+        # convex objective whose gradient is the error on the correlations
+        f = np.log(Z) + mx - (J * target * norm).sum(1)
+        return p, mean, mean/norm - target, f
+    
+    p, mean, err, f = stats(J, target)
+    errNorm = np.abs(err).max(1)
+    lam = np.zeros(len(J)) + 1e-3
     counter = 0
-    errHistory = [1]
-    while counter<refine_max_iter and errHistory[-1]>tol:
-        dJ = -cost(J, True)
-        errHistory.append(np.linalg.norm(dJ))
-        J += dJ*refine_multiplier
+    # stop iterating on a target once it has converged or damping can no longer reduce the
+    # error because we are at the limits of numerical precision
+    active = (errNorm>tol)
+    while active.any() and counter<max_iter:
+        ix = np.where(active)[0]
+        cov = (np.einsum('bt,ti,tj->bij', p[ix], coeffs, coeffs) -
+               mean[ix][:,:,None] * mean[ix][:,None,:])
+        dampedCov = cov + lam[ix][:,None,None] * (cov * np.eye(cov.shape[1]))
+        dJ = -np.linalg.solve(dampedCov, (err[ix]*norm)[...,None])[...,0]
+        # limit step size so that early steps do not overshoot into saturated regions
+        # where the covariance is nearly singular
+        dJ *= np.minimum(1, max_step / np.abs(dJ).max(1))[:,None]
+        
+        pNew, meanNew, errNew, fNew = stats(J[ix]+dJ, target[ix])
+        errNormNew = np.abs(errNew).max(1)
+        # the error is not monotonic along Newton steps, so also accept any step that
+        # decreases the objective
+        accept = (fNew<f[ix]) | (errNormNew<errNorm[ix])
+        
+        acceptix = ix[accept]
+        J[acceptix] += dJ[accept]
+        p[acceptix] = pNew[accept]
+        mean[acceptix] = meanNew[accept]
+        err[acceptix] = errNew[accept]
+        f[acceptix] = fNew[accept]
+        errNorm[acceptix] = errNormNew[accept]
+        lam[acceptix] /= 10
+        lam[ix[~accept]] *= 10
+
+        active = (errNorm>tol) & (lam<1e10)
         counter += 1
-    if np.linalg.norm(dJ)<tol:
-        errflag = 0
-    else:
-        errflag = 1
-    errHistory.pop(0)
-    return J, errflag, errHistory
+
+    if squeeze:
+        J = J[0]
+        err = err[0]
+    if full_output:
+        return J, {'x':J, 'fun':err, 'success':(errNorm<=tol), 'nit':counter}
+    return J
 
 def solve_mo_perturbation(n, J0,
                           eps=1e-4,
-                          refine=True,
-                          refine_multiplier=.2,
+                          q=1.,
+                          refine=None,
+                          refine_multiplier=None,
                           refine_max_iter=1000,
                           tol=1e-15,
                           full_output=False):
@@ -723,46 +705,40 @@ def solve_mo_perturbation(n, J0,
     J0 : ndarray
         Initial guess.
     eps : float, 1e-4
-    refine : bool, True
-    refine_multiplier : float, .2
-    refine_max_iter : int, 10_000
+    q : float, 1.
+        Probability that the Median moves into the majority in the MVM. The correlation
+        between the Median and Ordinary voters is proportional to q.
+    refine : bool, None
+        Deprecated. Solutions are always found with newton_solve().
+    refine_multiplier : float, None
+        Deprecated.
+    refine_max_iter : int, 1000
+        Max number of Newton iterations.
     tol : float, 1e-15
+        Max absolute error on the fit to the perturbed correlations.
     full_output : bool, False
     
     Returns
     -------
     ndarray
         Estimate of derivative.
-    dict from scipy.optimize.minimize (optional)
-    list
-        Error history for iterative algorithm.
+    dict from newton_solve() (optional)
     """
     
-    smoExact = sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
-                    for k in range((n-1)//2,n)])
+    _warn_refine_deprecated(refine, refine_multiplier)
+    smoExact = q * sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
+                        for k in range((n-1)//2,n)])
     sooExact = 0.
     smopExact = smoExact*(1-eps) + eps
     smoExact = smoExact*(1-eps)
     
-    def cost(params, as_vec=False):
-        logPartitionList, smopC, smoC, soopC, sooC = setup_mo_perturbation(n, *params)
-        smop = coeffs_to_corr(smopC, logPartitionList)
-        smo = coeffs_to_corr(smoC, logPartitionList)
-        soop = coeffs_to_corr(soopC, logPartitionList)
-        soo = coeffs_to_corr(sooC, logPartitionList)
-        if as_vec:
-            return np.array([smop-smopExact,
-                             smo-smoExact,
-                             soop-sooExact,
-                             soo-sooExact])
-        return ((smop-smopExact)**2 + 
-                (smo-smoExact)**2 + 
-                (soop-sooExact)**2 +
-                (soo-sooExact)**2)
-
-    soln = minimize(cost, J0)
-    if refine:
-        soln = root(lambda x: cost(x, True), soln['x'])
+    soln = newton_solve(*mo_perturbation_terms(n)[:2],
+                        [smopExact, smoExact, sooExact, sooExact],
+                        norm=mo_perturbation_terms(n)[2],
+                        J0=J0,
+                        tol=tol,
+                        max_iter=refine_max_iter,
+                        full_output=True)[1]
 
     if full_output:
         return (soln['x']-J0)/eps, soln
@@ -770,8 +746,9 @@ def solve_mo_perturbation(n, J0,
 
 def solve_oo_perturbation(n, J0,
                           eps=1e-4,
-                          refine=True,
-                          refine_multiplier=.2,
+                          q=1.,
+                          refine=None,
+                          refine_multiplier=None,
                           refine_max_iter=1000,
                           tol=1e-15,
                           full_output=False):
@@ -783,48 +760,39 @@ def solve_oo_perturbation(n, J0,
     J0 : ndarray
         Initial guess.
     eps : float, 1e-4
-    refine : bool, True
-    refine_multiplier : float, .2
-    refine_max_iter : int, 10_000
-    tol : float, 1e-5
+    q : float, 1.
+        Probability that the Median moves into the majority in the MVM. The correlation
+        between the Median and Ordinary voters is proportional to q.
+    refine : bool, None
+        Deprecated. Solutions are always found with newton_solve().
+    refine_multiplier : float, None
+        Deprecated.
+    refine_max_iter : int, 1000
+        Max number of Newton iterations.
+    tol : float, 1e-15
+        Max absolute error on the fit to the perturbed correlations.
     full_output : bool, False
     
     Returns
     -------
     ndarray
         Estimate of derivative.
-    dict from scipy.optimize.minimize (optional)
-    list
-        Error history for iterative algorithm.
+    dict from newton_solve() (optional)
     """
     
-    smoExact = sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
-                    for k in range((n-1)//2,n)])
+    _warn_refine_deprecated(refine, refine_multiplier)
+    smoExact = q * sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
+                        for k in range((n-1)//2,n)])
     sooExact = 0.
     so1o2Exact = eps
     
-    def cost(params, as_vec=False):
-        logPartitionList, smopC, smoC, so1o2C, soopC, sooC = setup_oo_perturbation(n, *params)
-        smop = coeffs_to_corr(smopC, logPartitionList)
-        smo = coeffs_to_corr(smoC, logPartitionList)
-        so1o2 = coeffs_to_corr(so1o2C, logPartitionList)
-        soop = coeffs_to_corr(soopC, logPartitionList)
-        soo = coeffs_to_corr(sooC, logPartitionList)
-        if as_vec:
-            return np.array([smop-smoExact,
-                             smo-smoExact,
-                             so1o2-so1o2Exact,
-                             soop-sooExact,
-                             soo-sooExact])
-        return np.sqrt((smop-smoExact)**2 + 
-                       (smo-smoExact)**2 + 
-                       (so1o2-so1o2Exact)**2 +
-                       (soop-sooExact)**2 +
-                       (soo-sooExact)**2)
-
-    soln = minimize(cost, J0)     
-    if refine:
-        soln = root(lambda x: cost(x, True), soln['x'])
+    soln = newton_solve(*oo_perturbation_terms(n)[:2],
+                        [smoExact, smoExact, so1o2Exact, sooExact, sooExact],
+                        norm=oo_perturbation_terms(n)[2],
+                        J0=J0,
+                        tol=tol,
+                        max_iter=refine_max_iter,
+                        full_output=True)[1]
     
     if full_output:
         return (soln['x']-J0)/eps, soln
@@ -832,8 +800,9 @@ def solve_oo_perturbation(n, J0,
 
 def solve_om_perturbation(n, J0,
                           eps=1e-4,
-                          refine=True,
-                          refine_multiplier=.2,
+                          q=1.,
+                          refine=None,
+                          refine_multiplier=None,
                           refine_max_iter=1000,
                           tol=1e-15,
                           full_output=False):
@@ -845,52 +814,46 @@ def solve_om_perturbation(n, J0,
     J0 : ndarray
         Initial guess.
     eps : float, 1e-4
-    refine : bool, True
-    refine_multiplier : float, .2
-    refine_max_iter : int, 10_000
-    tol : float, 1e-5
+    q : float, 1.
+        Probability that the Median moves into the majority in the MVM. The correlation
+        between the Median and Ordinary voters is proportional to q.
+    refine : bool, None
+        Deprecated. Solutions are always found with newton_solve().
+    refine_multiplier : float, None
+        Deprecated.
+    refine_max_iter : int, 1000
+        Max number of Newton iterations.
+    tol : float, 1e-15
+        Max absolute error on the fit to the perturbed correlations.
     full_output : bool, False
     
     Returns
     -------
     ndarray
         Estimate of derivative.
-    dict from scipy.optimize.minimize (optional)
-    list
-        Error history for iterative algorithm.
+    dict from newton_solve() (optional)
     """
     
-    smoExact = sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
-                    for k in range((n-1)//2,n)])
+    _warn_refine_deprecated(refine, refine_multiplier)
+    smoExact = q * sum([(k/(n-1) - (n-1-k)/(n-1)) * binom(n-1,k)/2**(n-2)
+                        for k in range((n-1)//2,n)])
     sooExact = 0.
     smopExact = smoExact*(1-eps) + eps
     soopExact = smoExact*eps
     
-    def cost(params, as_vec=False):
-        logPartitionList, smopC, smoC, soopC, sooC = setup_mo_perturbation(n, *params)
-        smop = coeffs_to_corr(smopC, logPartitionList)
-        smo = coeffs_to_corr(smoC, logPartitionList)
-        soop = coeffs_to_corr(soopC, logPartitionList)
-        soo = coeffs_to_corr(sooC, logPartitionList)
-        if as_vec:
-            return np.array([smop-smopExact,
-                             smo-smoExact,
-                             soop-soopExact,
-                             soo-sooExact])
-        return np.sqrt((smop-smopExact)**2 + 
-                       (smo-smoExact)**2 + 
-                       (soop-soopExact)**2 +
-                       (soo-sooExact)**2)
-
-    soln = minimize(cost, J0)
-    if refine:
-        soln = root(lambda x: cost(x, True), soln['x'])
+    soln = newton_solve(*mo_perturbation_terms(n)[:2],
+                        [smopExact, smoExact, soopExact, sooExact],
+                        norm=mo_perturbation_terms(n)[2],
+                        J0=J0,
+                        tol=tol,
+                        max_iter=refine_max_iter,
+                        full_output=True)[1]
  
     if full_output:
         return (soln['x']-J0)/eps, soln
     return (soln['x']-J0)/eps
 
-def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000):
+def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000, q=1.):
     """
     Parameters
     ----------
@@ -898,6 +861,9 @@ def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000):
     Jpair : ndarray
         Couplings between (M,O) and (O,O) for MVM.
     epsdJ : float, 1e-3
+    refine_max_iter : int, 10_000
+    q : float, 1.
+        Probability that the Median moves into the majority in the MVM.
 
     Returns
     -------
@@ -928,6 +894,7 @@ def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000):
         """
 
         dJ = solve_mo_perturbation(n, [Jpair[0],Jpair[0],Jpair[1],Jpair[1]],
+                                   q=q,
                                    refine_max_iter=refine_max_iter)
         J_ = J.copy()
         J_[0] += dJ[0]*epsdJ
@@ -963,6 +930,7 @@ def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000):
         """
 
         dJ = solve_om_perturbation(n, [Jpair[0],Jpair[0],Jpair[1],Jpair[1]],
+                                   q=q,
                                    refine_max_iter=refine_max_iter)
         J_ = J.copy()
         J_[0] += dJ[0]*epsdJ
@@ -998,6 +966,7 @@ def setup_coupling_perturbations(n, Jpair, epsdJ=1e-3, refine_max_iter=10_000):
         """
 
         dJ = solve_oo_perturbation(n, [Jpair[0],Jpair[0],Jpair[1],Jpair[1],Jpair[1]],
+                                   q=q,
                                    refine_max_iter=refine_max_iter)
         J_ = J.copy()
         J_[10] += dJ[0]*epsdJ
@@ -1184,13 +1153,17 @@ def _fim(n):
     eigvec = eigvec[:,sortix].real
     return fim, eigval, eigvec
 
-def fim(n, epsdJ=1e-5):
+def fim(n, epsdJ=1e-5, q=1., Jpair=None):
     """FIM for the MVM.
 
     Parameters
     ----------
     n : int
     epsdJ : float, 1e-5
+    q : float, 1.
+        Probability that the Median moves into the majority in the MVM.
+    Jpair : ndarray, None
+        Couplings (Jmo, Joo) of the MVM if they have already been solved for.
 
     Returns
     -------
@@ -1200,12 +1173,16 @@ def fim(n, epsdJ=1e-5):
         The two eigenvalues sorted.
     ndarray
         Eigvectors sorted.
+    ndarray
+        p(k)
     """
     
     # setup solution
     # Couplings for MVM.
-    Jpair = couplings(n)
-    _perturb_m_to_o, _perturb_o_to_m, _perturb_o_to_o = setup_coupling_perturbations(n, Jpair, epsdJ)
+    if Jpair is None:
+        Jpair = couplings(n, q=q)
+    _perturb_m_to_o, _perturb_o_to_m, _perturb_o_to_o = setup_coupling_perturbations(n, Jpair, epsdJ,
+                                                                                     q=q)
 
     # map the couplings to the full perturbation scheme
     J = np.zeros(12)
@@ -1240,3 +1217,63 @@ def fim(n, epsdJ=1e-5):
     eigvec = eigvec[:,sortix].real
 
     return smallfim, eigval, eigvec, pk
+
+def fim_sweep(nRange, q=1., epsdJ=1e-5, n_cpus=None):
+    """FIM for the MVM over many system sizes and values of q.
+
+    Couplings are solved for all q at once for each n, in order of increasing n, each
+    starting from the solution for the previous n. The FIM for each (n,q) is then
+    calculated in parallel.
+
+    Parameters
+    ----------
+    nRange : list of int
+    q : float or ndarray, 1.
+    epsdJ : float, 1e-5
+    n_cpus : int, None
+        Default is to use all cpus.
+
+    Returns
+    -------
+    ndarray
+        Compressed FIMs of dimensions (len(nRange), len(q), 3, 3). The q dimension is
+        dropped if q is a float.
+    ndarray
+        The two largest eigenvalues of the full FIM of dimensions (len(nRange), len(q), 2).
+    list of ndarray
+        p(k) for each n of dimensions (len(q), n-n//2).
+    """
+    
+    from multiprocess import Pool, cpu_count
+    from threadpoolctl import threadpool_limits
+
+    squeeze = np.ndim(q)==0
+    q = np.atleast_1d(q).astype(float)
+    nRange = list(nRange)
+
+    # warm start each solution from the previous n
+    Jpair = {}
+    J0 = None
+    for n in sorted(set(nRange)):
+        Jpair[n] = couplings(n, q=q, J0=J0, tol=1e-15)
+        J0 = Jpair[n]
+
+    def solve(args):
+        n, i = args
+        smallfim, eigval, eigvec, pk = fim(n, epsdJ, q=q[i], Jpair=Jpair[n][i])
+        return smallfim, eigval, pk
+    
+    args = [(n, i) for n in nRange for i in range(q.size)]
+    if n_cpus==1 or len(args)==1:
+        output = list(map(solve, args))
+    else:
+        with threadpool_limits(limits=1, user_api='blas'):
+            with Pool(min(n_cpus or cpu_count(), len(args))) as pool:
+                output = pool.map(solve, args)
+    
+    smallfim = np.array([o[0] for o in output]).reshape(len(nRange), q.size, 3, 3)
+    eigval = np.array([o[1] for o in output]).reshape(len(nRange), q.size, 2)
+    pk = [np.array([o[2] for o in output[i*q.size:(i+1)*q.size]]) for i in range(len(nRange))]
+    if squeeze:
+        return smallfim[:,0], eigval[:,0], [pk_[0] for pk_ in pk]
+    return smallfim, eigval, pk
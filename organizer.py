@@ -11,8 +11,263 @@ from .spectral import sorted_eigh
 
 
 
+class Catalog():
+    """Index of the pickles in a cache directory.
+
+    For each pickled dict, the index records the file's size, modification time and
+    checksum along with the shapes of the arrays that it contains. Arrays are extracted
+    once into .npy files such that they can be memory mapped afterwards instead of
+    unpickling the whole file every time a single array is needed. Files are only
+    indexed the first time they are requested, and they are reindexed when their size or
+    modification time changes.
+
+    The index is stored in DR/catalog.p and the arrays in DR/catalog/. Updates to the
+    index are serialized across processes with a lock on DR/catalog.lock.
+    """
+    INDEX_F = 'catalog.p'
+    LOCK_F = 'catalog.lock'
+    ARRAY_DR = 'catalog'
+    
+    def __init__(self, dr):
+        """
+        Parameters
+        ----------
+        dr : str
+            Cache directory.
+        """
+        
+        from threading import Lock
+        self.dr = dr
+        self.index = {}
+        self._lock = Lock()  # guards the index and the dict of per-file locks
+        self._fileLocks = {}
+        if os.path.isfile(f'{dr}/{self.INDEX_F}'):
+            self.index = pickle.load(open(f'{dr}/{self.INDEX_F}', 'rb'))
+
+    def files(self):
+        """Names of all pickles in the cache directory. Only the directory listing is read.
+
+        Returns
+        -------
+        list of str
+        """
+
+        return [f.name for f in os.scandir(self.dr)
+                if f.is_file() and f.name.endswith('.p') and f.name!=self.INDEX_F]
+
+    def __contains__(self, fname):
+        return os.path.isfile(f'{self.dr}/{fname}')
+
+    def entry(self, fname):
+        """Index entry for given file, which is (re)indexed if it is new or has changed.
+
+        Parameters
+        ----------
+        fname : str
+
+        Returns
+        -------
+        dict
+            With keys 'size', 'mtime', 'checksum', 'arrays' (shape and dtype of each
+            array), 'values' (small non-array items), and 'other' (names of items that can
+            only be read by unpickling the file).
+        """
+        
+        if not fname in self:
+            raise Exception(f"File {fname} does not exist in {self.dr}.")
+        stat = os.stat(f'{self.dr}/{fname}')
+        entry = self.index.get(fname, None)
+        if self._stale(entry, stat):
+            # only threads requesting the same file wait on each other
+            with self._file_lock(fname):
+                stat = os.stat(f'{self.dr}/{fname}')
+                entry = self.index.get(fname, None)
+                if self._stale(entry, stat):
+                    entry = self._index_file(fname, stat)
+        return entry
+
+    def _stale(self, entry, stat):
+        return entry is None or entry['size']!=stat.st_size or entry['mtime']!=stat.st_mtime_ns
+
+    def _file_lock(self, fname):
+        from threading import Lock
+        with self._lock:
+            if not fname in self._fileLocks:
+                self._fileLocks[fname] = Lock()
+            return self._fileLocks[fname]
+
+    def _index_file(self, fname, stat):
+        """Unpickle file once to index its contents and extract its arrays. Only merging
+        the new entry into the index is done under the shared lock."""
+
+        indata = pickle.load(open(f'{self.dr}/{fname}', 'rb'))
+        assert isinstance(indata, dict), "Only pickled dicts can be indexed."
+        os.makedirs(f'{self.dr}/{self.ARRAY_DR}', exist_ok=True)
+
+        entry = {'size':stat.st_size,
+                 'mtime':stat.st_mtime_ns,
+                 'checksum':checksum(f'{self.dr}/{fname}'),
+                 'arrays':{},
+                 'values':{},
+                 'other':[]}
+        for key, val in indata.items():
+            if isinstance(val, np.ndarray) and val.dtype!=object:
+                atomic_save(self._array_f(fname, key), lambda f, val=val: np.save(f, val))
+                entry['arrays'][key] = (val.shape, val.dtype.str)
+            elif isinstance(val, (int, float, str, bool, np.number, type(None))):
+                entry['values'][key] = val
+            else:
+                entry['other'].append(key)
+
+        # read-merge-save is locked against other threads and other processes that are
+        # indexing files in the same directory
+        import fcntl
+        with self._lock, open(f'{self.dr}/{self.LOCK_F}', 'ab') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                if os.path.isfile(f'{self.dr}/{self.INDEX_F}'):
+                    self.index.update(pickle.load(open(f'{self.dr}/{self.INDEX_F}', 'rb')))
+                self.index[fname] = entry
+                atomic_save(f'{self.dr}/{self.INDEX_F}',
+                            lambda f: pickle.dump(self.index, f, -1))
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+        return entry
+
+    def _array_f(self, fname, key):
+        return f'{self.dr}/{self.ARRAY_DR}/{fname[:-2]}.{key}.npy'
+
+    def keys(self, fname):
+        entry = self.entry(fname)
+        return list(entry['arrays']) + list(entry['values']) + entry['other']
+
+    def shape(self, fname, key):
+        """Shape of array without loading it.
+
+        Parameters
+        ----------
+        fname : str
+        key : str
+
+        Returns
+        -------
+        tuple
+        """
+        
+        return self.entry(fname)['arrays'][key][0]
+
+    def checksum(self, fname):
+        return self.entry(fname)['checksum']
+
+    def load(self, fname, key, mmap=True):
+        """Load a single item from a cached pickle.
+
+        Parameters
+        ----------
+        fname : str
+        key : str
+        mmap : bool, True
+            If True, arrays are returned as read-only memory maps.
+
+        Returns
+        -------
+        object
+        """
+
+        entry = self.entry(fname)
+        if key in entry['arrays']:
+            return np.load(self._array_f(fname, key), mmap_mode='r' if mmap else None)
+        if key in entry['values']:
+            return entry['values'][key]
+        if key in entry['other']:
+            return pickle.load(open(f'{self.dr}/{fname}', 'rb'))[key]
+        raise KeyError(key)
+#end Catalog
+
+
+def catalog(dr, _catalogs={}):
+    """Catalog for given cache directory that is shared across all instances of
+    MESolution in this process.
+
+    Parameters
+    ----------
+    dr : str
+
+    Returns
+    -------
+    Catalog
+    """
+
+    if not dr in _catalogs:
+        _catalogs[dr] = Catalog(dr)
+    return _catalogs[dr]
+
+def checksum(fname, chunk_size=2**20):
+    """SHA1 checksum of file read in chunks.
+
+    Parameters
+    ----------
+    fname : str
+    chunk_size : int, 2**20
+
+    Returns
+    -------
+    str
+    """
+
+    import hashlib
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def atomic_save(fname, write):
+    """Write to a temporary file in the same directory and then move it into place such
+    that readers never see a partially written file.
+
+    Parameters
+    ----------
+    fname : str
+    write : function
+        Takes an open binary file handle and writes the contents.
+    """
+
+    from tempfile import NamedTemporaryFile
+    with NamedTemporaryFile(dir=os.path.dirname(fname) or '.', delete=False) as f:
+        try:
+            write(f)
+        except Exception:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, fname)
+
+def roman2int(s):
+    """Convert lower case Roman numeral used to index MC samples to an int.
+
+    Parameters
+    ----------
+    s : str
+
+    Returns
+    -------
+    int
+    """
+
+    values = {'i':1, 'v':5, 'x':10, 'l':50, 'c':100}
+    total = 0
+    for i, c in enumerate(s):
+        if i+1<len(s) and values[c]<values[s[i+1]]:
+            total -= values[c]
+        else:
+            total += values[c]
+    return total
+
+
+
 class MESolution():
     DEFAULT_DR = 'cache/c_elegans'  # default dr where pickles are stored
+    EIG_DR = 'eig'  # subdirectory for cached eigendecompositions of FIMs
     # seconodary directory when using laptop setup, but hard drive must be connected
     if not os.path.isdir(DEFAULT_DR):
         DEFAULT_DR = "/Volumes/Eddie's SSD/Research/scotus4/py/cache/c_elegans"
@@ -49,7 +304,8 @@ class MESolution():
         self.mc_ix = mc_ix
         self.ix = (subset_ix, str(data_ix), soln_ix, mc_ix)
         
-        files = os.listdir(self.DEFAULT_DR)
+        self.catalog = catalog(self.DEFAULT_DR)
+        files = self.catalog.files()
 
         # look for maxent soln results
         if not self.soln_f() in files:
@@ -57,12 +313,11 @@ class MESolution():
             if not self.model_f() in files:
                 raise Exception("Neither maxent nor model file found.")
             else:
-                self.n = pickle.load(open(self.model_f(), 'rb'))['n']
+                self.n = self.catalog.load(self.model_f(), 'n')
                 self.exists_model = True
             self._me = False
         else:
-            fname = f'{self.DEFAULT_DR}/{self.soln_f()}'
-            self.n = pickle.load(open(fname, 'rb'))['X'].shape[1]
+            self.n = self.catalog.shape(self.soln_f(), 'X')[1]
             if not self.model_f() in files:
                 if iprint: print("Model file not found.")
                 self.exists_model = False
@@ -98,9 +353,8 @@ class MESolution():
             fname = self.soln_f()
         else:
             fname = self.model_f()
-        indata = pickle.load(open(f'{self.DEFAULT_DR}/{fname}', 'rb'))
         
-        return indata['neuronix']
+        return self.catalog.load(fname, 'neuronix', mmap=False)
 
     def parameters(self):
         """Get maxent solution for specified data set.
@@ -117,7 +371,8 @@ class MESolution():
             fname = self.soln_f()
         else:
             fname = self.model_f()
-        indata = pickle.load(open(f'{self.DEFAULT_DR}/{fname}', 'rb'))
+        indata = {key:self.catalog.load(fname, key, mmap=False)
+                  for key in ('h', 'J', 'hJ') if key in self.catalog.keys(fname)}
 
         if 'h' in indata.keys() and 'J' in indata.keys():
             if indata['h'].size==2*self.n:
@@ -161,13 +416,12 @@ class MESolution():
         Returns
         -------
         ndarray
-            Dimensions of (n_samples, n_neurons).
+            Read-only memory map with dimensions of (n_samples, n_neurons).
         """
 
-        fname = f'{self.DEFAULT_DR}/{self.soln_f()}'
-        if os.path.isfile(fname):
-            return pickle.load(open(fname, 'rb'))['X']
-        raise Exception(f"Solution file {fname} does not exist.")
+        if self.soln_f() in self.catalog:
+            return self.catalog.load(self.soln_f(), 'X')
+        raise Exception(f"Solution file {self.DEFAULT_DR}/{self.soln_f()} does not exist.")
 
     def model(self):
         if not self.exists_model:
@@ -205,26 +459,90 @@ class MESolution():
         return sisj[:150], sisj[150:]
 
     def fim(self):
-        """Return FIM from cache, else calculated it by calling spectral.sorted_eigh().
+        """Return FIM from cache.
 
         Returns
         -------
         ndarray
+            Read-only memory map.
         """
 
-        fname = self.fim_f()
-        indata = pickle.load(open(f'{self.DEFAULT_DR}/{fname}', 'rb'))
-        fim = indata['fim']
+        return self.catalog.load(self.fim_f(), 'fim')
 
-        # automatically cache eigenvalues and eigenvectors for this fim
-        if not 'eigvec' in indata.keys():
-            indata['eigval'], indata['eigvec'] = sorted_eigh(fim)
-            pickle.dump(indata, open(f'{self.DEFAULT_DR}/{fname}', 'wb'), -1)
+    def eig_f(self, top_k=None):
+        """Sidecar file names for the cached eigendecomposition. The names contain the
+        checksum of the FIM file such that the cache is invalidated whenever the FIM
+        changes.
 
-        return fim
+        Parameters
+        ----------
+        top_k : int, None
+            Number of leading eigenvalues. If None, the full spectrum.
+
+        Returns
+        -------
+        str
+            Eigenvalue file.
+        str
+            Eigenvector file.
+        """
+
+        prefix = f"{self.EIG_DR}/{self._eig_prefix()}"
+        k = 'all' if top_k is None else str(top_k)
+        return f'{prefix}{k}.eigval.npy', f'{prefix}{k}.eigvec.npy'
+
+    def _eig_prefix(self):
+        return f"{self.fim_f()[:-2]}.{self.catalog.checksum(self.fim_f())[:16]}.k"
+
+    def _cached_eig(self, top_k=None):
+        """Smallest cached eigendecomposition that contains the top_k leading modes.
+
+        Parameters
+        ----------
+        top_k : int, None
 
-    def eig(self):
+        Returns
+        -------
+        tuple of ndarray or None
         """
+
+        dr = f'{self.DEFAULT_DR}/{self.EIG_DR}'
+        if not os.path.isdir(dr):
+            return None
+        
+        prefix = self._eig_prefix()
+        available = []
+        for f in os.listdir(dr):
+            # eigval file is written last so it marks a complete cache
+            if f.startswith(prefix) and f.endswith('.eigval.npy'):
+                k = f[len(prefix):-len('.eigval.npy')]
+                k = np.inf if k=='all' else int(k)
+                if top_k is None and k==np.inf or top_k is not None and k>=top_k:
+                    available.append(k)
+        if not available:
+            return None
+
+        k = min(available)
+        valf, vecf = self.eig_f(None if k==np.inf else k)
+        val = np.load(f'{self.DEFAULT_DR}/{valf}', mmap_mode='r')
+        vec = np.load(f'{self.DEFAULT_DR}/{vecf}', mmap_mode='r')
+        if top_k is None:
+            return val, vec
+        return val[:top_k], vec[:,:top_k]
+
+    def eig(self, top_k=None):
+        """Eigendecomposition of FIM sorted by descending eigenvalue.
+
+        Results are cached in sidecar files in DR/eig that are keyed by the FIM
+        checksum and the number of modes such that the FIM pickle is never rewritten.
+        Files are written atomically so concurrent readers never see partial results.
+        Eigenvalues already stored in older FIM pickles are used directly.
+
+        Parameters
+        ----------
+        top_k : int, None
+            If given, only the leading top_k modes are calculated.
+
         Returns
         -------
         ndarray
@@ -233,73 +551,154 @@ class MESolution():
             Eigenvectors.
         """
         
-        try:
-            fname = self.fim_f()
-            indata = pickle.load(open(f'{self.DEFAULT_DR}/{fname}', 'rb'))
-            return indata['eigval'], indata['eigvec']
-        except KeyError:
-            self.fim()
-            return self.eig()
-
-    def avg_eigvals(self):
+        fname = self.fim_f()
+        if 'eigvec' in self.catalog.keys(fname):
+            val, vec = self.catalog.load(fname, 'eigval'), self.catalog.load(fname, 'eigvec')
+            if top_k is None:
+                return val, vec
+            return val[:top_k], vec[:,:top_k]
+        
+        cached = self._cached_eig(top_k)
+        if not cached is None:
+            return cached
+        
+        fim = self.fim()
+        if top_k is None:
+            val, vec = sorted_eigh(fim)
+        else:
+            from scipy.linalg import eigh
+            val, vec = eigh(fim, subset_by_index=[len(fim)-top_k, len(fim)-1])
+            val, vec = val[::-1], vec[:,::-1]
+        
+        os.makedirs(f'{self.DEFAULT_DR}/{self.EIG_DR}', exist_ok=True)
+        valf, vecf = self.eig_f(top_k)
+        atomic_save(f'{self.DEFAULT_DR}/{vecf}', lambda f: np.save(f, vec))
+        atomic_save(f'{self.DEFAULT_DR}/{valf}', lambda f: np.save(f, val))
+        return val, vec
+
+    def mc_replicates(self):
+        """MC sample indices for which an FIM is available in the cache directory.
+
+        Returns
+        -------
+        list of str
+            Sorted by the value of the Roman numeral index.
+        """
+
+        prefix = f"{self.name}_fim{''.join(self.ix[:-1])}"
+        mcix = [f[len(prefix):-2] for f in self.catalog.files() if f.startswith(prefix)]
+        mcix = [ix for ix in mcix if ix and set(ix)<=set('ivxlc')]
+        return sorted(mcix, key=roman2int)
+
+    def _replicate(self, mc_ix):
+        return self.__class__(self.name, self.data_ix,
+                              soln_ix=self.soln_ix,
+                              mc_ix=mc_ix,
+                              subset_ix=self.subset_ix,
+                              iprint=False)
+
+    def replicate_eigvals(self, top_k=None, n_threads=None):
+        """Sorted eigenvalue spectra of FIMs for all available MC samples loaded
+        concurrently.
+
+        Parameters
+        ----------
+        top_k : int, None
+            Passed to self.eig.
+        n_threads : int, None
+            Number of threads for loading. Default is set by ThreadPoolExecutor.
+
+        Returns
+        -------
+        ndarray
+            Eigenvalues for each MC sample by row.
+        list of str
+            MC sample indices.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+        mcix = self.mc_replicates()
+        if not mcix:
+            raise Exception("No FIM found for any MC sample.")
+
+        with ThreadPoolExecutor(n_threads) as pool:
+            vals = list(pool.map(lambda ix: np.array(self._replicate(ix).eig(top_k)[0]), mcix))
+        return np.vstack(vals), mcix
+
+    def replicate_fim(self, out=None, n_threads=None):
+        """Stack of FIMs for all available MC samples loaded concurrently.
+
+        Parameters
+        ----------
+        out : str, None
+            If given, the stack is written into a .npy file at this path that is returned
+            as a memory map such that the stack does not have to fit into memory.
+        n_threads : int, None
+            Number of threads for loading. Default is set by ThreadPoolExecutor.
+
+        Returns
+        -------
+        ndarray
+            FIMs with dimensions (n_mc_samples, P, P).
+        list of str
+            MC sample indices.
+        """
+        
+        from concurrent.futures import ThreadPoolExecutor
+        mcix = self.mc_replicates()
+        if not mcix:
+            raise Exception("No FIM found for any MC sample.")
+
+        solns = [self._replicate(ix) for ix in mcix]
+        shape = self.catalog.shape(solns[0].fim_f(), 'fim')
+        assert all([self.catalog.shape(s.fim_f(), 'fim')==shape for s in solns])
+        
+        if out is None:
+            fim = np.zeros((len(mcix),)+shape)
+        else:
+            fim = np.lib.format.open_memmap(out, mode='w+', shape=(len(mcix),)+shape)
+        
+        def load(i):
+            fim[i] = solns[i].fim()
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(pool.map(load, range(len(solns))))
+        if out is not None:
+            fim.flush()
+        return fim, mcix
+
+    def avg_eigvals(self, **kwargs):
         """Rank-ordered eigenvalue spectrum averaged over MC samples used to calculate FIM.
 
+        Parameters
+        ----------
+        **kwargs
+            Passed to self.replicate_eigvals.
+
         Returns
         -------
         ndarray
             Average of sorted eigenvalue spectrum.
-        ndarray
-            Log standard deviation.
         ndarray
             All sorted eigenvalues by row.
         """
         
-        #TODO: this is hard-coded, but should be flexible?
-        rnumerals = ['i','ii','iii','iv','v','vi','vii','viii','ix','x']
-        vals = []
-
-        # iterate through all available MC samples assuming that they are ordered consecutively
-        for num in rnumerals:
-            try:
-                soln = self.__class__(self.name, self.data_ix,
-                                      soln_ix=self.soln_ix, 
-                                      mc_ix=num,
-                                      subset_ix=self.subset_ix, 
-                                      iprint=False)
-                if soln._fim:
-                    vals.append(soln.eig()[0])
-            except Exception:
-                pass
-
-        vals = np.vstack(vals)
+        vals = self.replicate_eigvals(**kwargs)[0]
         return vals.mean(0), vals
 
-    def all_fim(self):
+    def all_fim(self, **kwargs):
         """List of all FIM across MC samples.
 
+        Parameters
+        ----------
+        **kwargs
+            Passed to self.replicate_fim.
+
         Returns
         -------
         list of ndarray
         """
         
-        #TODO: this is hard-coded, but should be flexible
-        rnumerals = ['i','ii','iii','iv','v','vi','vii','viii','ix','x']
-        fim = []
-
-        # iterate through all available MC samples assuming that they are ordered consecutively
-        for num in rnumerals:
-            try:
-                soln = MESolution(self.name, self.data_ix,
-                                  soln_ix=self.soln_ix, 
-                                  mc_ix=num,
-                                  subset_ix=self.subset_ix, 
-                                  iprint=False)
-                if soln._fim:
-                    fim.append(soln.fim())
-            except Exception:
-                pass
-
-        return fim
+        return list(self.replicate_fim(**kwargs)[0])
 #end MESolution
 
 
@@ -448,37 +847,82 @@ class FIM():
         self.fim = fim
         # perhaps include option to store fim on disk to save memory
 
-    def _sample_subset_eigval(self, n_comp, n_sample):
-        """
+    def _unique_subsets(self, n_comp, n_sample, rng=None):
+        """Draw distinct subsets of components.
+
         Parameters
         ----------
         n_comp : int
-            Number of components to sample.
+            Number of components in each subset.
         n_sample : int
-            Number of subsets to try.
+            Number of subsets to draw.
+        rng : np.random.RandomState or np.random.Generator, None
 
         Returns
         -------
         ndarray
+            Sorted component indices of each subset as a row.
         """
         
-        from .influence import subspace_eig
         from scipy.special import binom
+        rng = rng or np.random
+        nSubsets = int(binom(self.n, n_comp))
+        assert n_sample <= nSubsets
+
+        # when many of the subsets are requested, enumerating all of them is cheap
+        if n_sample > nSubsets//2:
+            allSubsets = np.array(list(combinations(range(self.n), n_comp)))
+            return allSubsets[np.sort(rng.choice(nSubsets, size=n_sample, replace=False))]
+
+        subsets = set()
+        while len(subsets) < n_sample:
+            subsets.add(tuple(np.sort(rng.choice(self.n, size=n_comp, replace=False))))
+        return np.array(sorted(subsets))
+
+    def _sample_subset_eigval(self, n_comp, n_sample,
+                              rng=None,
+                              method='auto',
+                              max_elements=2**25):
+        """
+        Parameters
+        ----------
+        n_comp : int
+            Number of components to sample.
+        n_sample : int
+            Number of distinct subsets to try.
+        rng : np.random.RandomState or np.random.Generator, None
+        method : str, 'auto'
+            Passed to spectral.top_eigval.
+        max_elements : int, 2**25
+            Max number of elements in a stack of subspace matrices. This determines how
+            many subsets are processed at once.
 
-        # check that given number of samples does not exceed max number of possible subsets
-        assert n_sample <= int(binom(self.n, n_comp))
+        Returns
+        -------
+        ndarray
+        """
+        
+        from .spectral import top_eigval
+        
+        k = self.fim.shape[0]//self.n
+        assert k*self.n==self.fim.shape[0]
+        subsets = self._unique_subsets(n_comp, n_sample, rng)
 
+        # rows of FIM belonging to each subset
+        ix = (subsets[:,:,None]*k + np.arange(k)[None,None,:]).reshape(n_sample, n_comp*k)
+        
         topval = np.zeros(n_sample)
-
-        for i in range(n_sample):
-            val, vec = subspace_eig(self.fim, np.random.choice(range(self.n),
-                                                               size=n_comp,
-                                                               replace=False))
-            topval[i] = val[0]
+        batchSize = max(1, max_elements//ix.shape[1]**2)
+        for i in range(0, n_sample, batchSize):
+            bix = ix[i:i+batchSize]
+            topval[i:i+batchSize] = top_eigval(self.fim[bix[:,:,None],bix[:,None,:]], method=method)
 
         return topval
     
-    def sample_subset_eigval(self, n_subset_range=None, max_subset_size=None):
+    def sample_subset_eigval(self, n_subset_range=None, max_subset_size=None,
+                             n_cpus=None,
+                             seed=None,
+                             **kwargs):
         """Calculate eigenvalue spectrum for subspace spanned by random groups of
         n_comp components.
         
@@ -486,25 +930,45 @@ class FIM():
         ----------
         n_subset_range : ndarray, None
         max_subset_size : int, 50
+        n_cpus : int, None
+            Subset sizes are run in parallel. If 1, run serially.
+        seed : int or np.random.SeedSequence, None
+            Each subset size gets its own random stream spawned from this seed.
+        **kwargs
+            Passed to self._sample_subset_eigval.
         
         Returns
         -------
         list of ndarray
-            Each ndarray contains top eigenvalue from multiple random subsets. Subsets might repeat.
-            TODO: do not repeat subsets
+            Each ndarray contains top eigenvalue from multiple distinct random subsets.
         """
         
+        from multiprocess import Pool, cpu_count
         max_subset_size = max_subset_size or self.n
         assert max_subset_size>0
         
-        sampleVal = []
         if n_subset_range is None:  # default range
             n_subset_range = list(range(1, self.n+1, 5))
         if type(n_subset_range) is int:  # space range out automatically
             n_subset_range = list(range(1, self.n+1, n_subset_range))
-
-        for nComp in n_subset_range:
-            sampleVal.append( self._sample_subset_eigval(nComp, min(int(binom(self.n,nComp)),max_subset_size)) )
+        
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        streams = seed.spawn(len(n_subset_range))
+
+        def wrapper(args):
+            nComp, stream = args
+            return self._sample_subset_eigval(nComp,
+                                              min(int(binom(self.n,nComp)),max_subset_size),
+                                              rng=np.random.default_rng(stream),
+                                              **kwargs)
+        
+        if n_cpus==1 or len(n_subset_range)==1:
+            sampleVal = [wrapper(args) for args in zip(n_subset_range, streams)]
+        else:
+            with threadpool_limits(limits=1, user_api='blas'):
+                with Pool(min(n_cpus or cpu_count(), len(n_subset_range))) as pool:
+                    sampleVal = pool.map(wrapper, zip(n_subset_range, streams))
         
         return sampleVal
 
@@ -570,7 +1034,8 @@ class MESolutionLargeComponent(MESolution):
         self.mc_ix = mc_ix
         self.ix = (subset_ix, str(data_ix), soln_ix, mc_ix)
         
-        files = os.listdir(self.DEFAULT_DR)
+        self.catalog = catalog(self.DEFAULT_DR)
+        files = self.catalog.files()
 
         # look for maxent soln results
         if not f'{name}_soln{"".join(self.ix[:-1])}.p' in files:
@@ -578,12 +1043,11 @@ class MESolutionLargeComponent(MESolution):
             if not f'{name}_model{"".join(self.ix)}.p' in files:
                 raise Exception("Neither maxent nor model file found.")
             else:
-                self.n = pickle.load(open(f'{self.DEFAULT_DR}/{name}_model{"".join(self.ix)}.p', 'rb'))['n']
+                self.n = self.catalog.load(f'{name}_model{"".join(self.ix)}.p', 'n')
                 self.exists_model = True
             self._me = False
         else:
-            fname = f'{self.DEFAULT_DR}/{name}_soln{"".join(self.ix[:-1])}.p'
-            self.n = pickle.load(open(fname, 'rb'))['X'].shape[1]
+            self.n = self.catalog.shape(f'{name}_soln{"".join(self.ix[:-1])}.p', 'X')[1]
             if not '%s_model%s.p'%(name, ''.join(self.ix)) in files:
                 if iprint: print("Model file not found.")
                 self.exists_model = False
@@ -623,7 +1087,8 @@ class MESolutionLargeComponent(MESolution):
             fname = '%s_soln%s.p'%(self.name, ''.join(self.ix[:-1]))
         else:
             fname = '%s_model%s.p'%(self.name, ''.join(self.ix[:-1]))
-        indata = pickle.load(open('%s/%s'%(self.DEFAULT_DR, fname), 'rb'))
+        indata = {key:self.catalog.load(fname, key, mmap=False)
+                  for key in ('h', 'J', 'hJ') if key in self.catalog.keys(fname)}
 
         if 'h' in indata.keys() and 'J' in indata.keys():
             if indata['h'].size==2*self.fulln:
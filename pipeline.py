@@ -11,7 +11,158 @@ from .fim import *
 
 
 
-def pivotal_blocs(X, component_names=None, solve_inverse_kw={}):
+class ResultStore():
+    """Append-only store of results with one record per key.
+
+    Arrays in a record are saved as separate .npy files that can be memory mapped and
+    other objects are dilled into their own files. Small metadata (None, numbers, and
+    strings) and the file listing for each record are appended to a journal,
+    index.log, only after all of the record's files have been atomically moved into
+    place. Thus, a crash never leaves a partially written record in the index, completed
+    keys can be skipped on restart, and loading one key never deserializes the others.
+    """
+    INDEX_F = 'index.log'
+
+    def __init__(self, dr):
+        """
+        Parameters
+        ----------
+        dr : str
+            Directory for store, which is created if it does not exist.
+        """
+
+        self.dr = dr
+        os.makedirs(dr, exist_ok=True)
+        self.index = {}
+        self._end = 0  # position in journal after last complete record
+        self.refresh()
+
+    def refresh(self):
+        """Read new records from the journal, which may have been appended to by another
+        process. An incomplete record left at the end of the journal by an interrupted
+        write is truncated.
+        """
+
+        import fcntl
+        fname = f'{self.dr}/{self.INDEX_F}'
+        if not os.path.isfile(fname):
+            return
+        with open(fname, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._read(f)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, f):
+        """Read records from open journal starting from the last complete record. Must
+        hold lock on journal."""
+
+        f.seek(self._end)
+        while True:
+            try:
+                key, record = dill.load(f)
+            except Exception:
+                # end of file or incomplete final record from an interrupted write
+                break
+            self.index[key] = record
+            self._end = f.tell()
+        
+        # no other writer holds the lock, so anything after the last complete record is
+        # left over from a write that was interrupted
+        if f.seek(0, os.SEEK_END)>self._end:
+            f.truncate(self._end)
+            f.seek(self._end)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def _prefix(self, key):
+        import hashlib
+        return f"{self.dr}/{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"
+
+    def save(self, key, record, inline=()):
+        """Add a record.
+
+        Parameters
+        ----------
+        key : object
+            Any key with a unique repr.
+        record : dict
+            Named items to store.
+        inline : tuple, ()
+            Names of small items that are kept in the index itself such that they can be
+            read from self.index without opening any other files.
+        """
+        
+        from .organizer import atomic_save
+        prefix = self._prefix(key)
+        entry = {}
+        for name, val in record.items():
+            if name in inline:
+                entry[name] = ('value', val)
+            elif isinstance(val, np.ndarray) and val.dtype!=object:
+                atomic_save(f'{prefix}.{name}.npy', lambda f, val=val: np.save(f, val))
+                entry[name] = ('array', f'{os.path.basename(prefix)}.{name}.npy')
+            elif isinstance(val, (int, float, str, bool, np.number, type(None))):
+                entry[name] = ('value', val)
+            else:
+                atomic_save(f'{prefix}.{name}.p', lambda f, val=val: dill.dump(val, f, -1))
+                entry[name] = ('object', f'{os.path.basename(prefix)}.{name}.p')
+        
+        # a single write of the whole record to the journal after discarding any
+        # incomplete record left at its end, locked against other processes writing to
+        # the same store
+        import fcntl
+        with open(f'{self.dr}/{self.INDEX_F}', 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._read(f)
+                f.write(dill.dumps((key, entry), -1))
+                f.flush()
+                os.fsync(f.fileno())
+                self._end = f.tell()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.index[key] = entry
+
+    def load(self, key, names=None, mmap=True):
+        """Load a record.
+
+        Parameters
+        ----------
+        key : object
+        names : list of str, None
+            Items to load. By default, all of them.
+        mmap : bool, True
+            If True, arrays are returned as read-only memory maps.
+
+        Returns
+        -------
+        dict
+        """
+
+        entry = self.index[key]
+        record = {}
+        for name in (names or entry.keys()):
+            kind, val = entry[name]
+            if kind=='array':
+                record[name] = np.load(f'{self.dr}/{val}', mmap_mode='r' if mmap else None)
+            elif kind=='object':
+                record[name] = dill.load(open(f'{self.dr}/{val}', 'rb'))
+            else:
+                record[name] = val
+        return record
+#end ResultStore
+
+
+
+def pivotal_blocs(X, component_names=None,
+                  cache_dr='cache/maxent_solutions',
+                  solve_inverse_kw={}):
     """Solve pairwise maxent model and calculate Fisher information matrix and pivotal
     bloc analysis as in paper.
     
@@ -20,6 +171,11 @@ def pivotal_blocs(X, component_names=None, solve_inverse_kw={}):
     X : ndarray
         Each row is a sample from the system.
     component_names : list of strings, None
+    cache_dr : str, 'cache/maxent_solutions'
+        Cache of maxent solutions passed to solve_inverse_on_data such that a restarted
+        analysis does not solve the same data again. If None, caching is off.
+    solve_inverse_kw : dict, {}
+        Passed to solve_inverse_on_data.
     
     Returns
     -------
@@ -43,7 +199,7 @@ def pivotal_blocs(X, component_names=None, solve_inverse_kw={}):
 
     data = {'example':[component_names, X]}
 
-    pipe.solve_inverse_on_data(data, **solve_inverse_kw)
+    pipe.solve_inverse_on_data(data, **{'cache_dr':cache_dr, **solve_inverse_kw})
     if np.linalg.norm(data['example'][-1]['fun'])>1e-3:
         warn("Large numerical error in maxent solution.")
 
@@ -138,7 +294,7 @@ def check_corr(system, method, orders=range(2,9,2), prefix='cache'):
         Correlation coefficient of model estimate of correlation by data.
     """
     
-    import importlib
+    from .models import ExactIsing
 
     path = 'cache/%s/%s'%(system,method)
 
@@ -152,13 +308,183 @@ def check_corr(system, method, orders=range(2,9,2), prefix='cache'):
             if len(data[k])>2 and (not data[k][-1] is None) and data[k][-1]['success']:
                 X, hJ = data[k][1:3]
                 assert (X.mean(0)==0).all()
-                ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%X.shape[1])
+                ising = ExactIsing(X.shape[1])
                 p = ising.p(hJ)
                 
                 errs[i], corr[i] = check_correlations(X, p, orders)
     return errs, corr
 
-def solve_inverse_on_data(data, n_cpus=4, potts=False, force_krylov=False):
+def sufficient_stats(X, potts=False):
+    """Means and pairwise correlations that the maxent model is fit to.
+
+    Parameters
+    ----------
+    X : ndarray
+    potts : bool, False
+
+    Returns
+    -------
+    ndarray
+    """
+
+    from coniii.utils import pair_corr
+    if potts:
+        from data_sets.neuron.data import potts_pair_corr
+        assert np.array_equal(np.unique(X), [0,1,2])
+        return potts_pair_corr(X, k=3, concat=True)
+    return pair_corr(X, concat=True)
+
+def solve_inverse(X, name='',
+                  potts=False,
+                  force_krylov=False,
+                  initial_guess=None):
+    """Solve inverse problem on a single data set with Enumerate, falling back on Pseudo
+    to find a better starting point if Enumerate does not converge.
+
+    Parameters
+    ----------
+    X : ndarray
+        Each row is a sample from the system.
+    name : str, ''
+        For printing progress.
+    potts: bool, False
+    force_krylov : bool, False
+    initial_guess : ndarray, None
+        Starting point for the first call to Enumerate.
+
+    Returns
+    -------
+    ndarray
+        hJ
+    dict
+        Solution report from scipy.optimize. None if the second attempt with Enumerate
+        failed.
+    """
+    
+    from coniii.utils import define_ising_helper_functions, define_pseudo_ising_helper_functions
+    from coniii.solvers import Enumerate, Pseudo
+    from .models import ExactIsing, ExactPotts
+    
+    _, calc_observables, _ = define_ising_helper_functions()
+    n = X.shape[1]
+    print("Solving %s."%name)
+    sisj = sufficient_stats(X, potts)
+    if potts:
+        ising = ExactPotts(n)
+    else:
+        ising = ExactIsing(n)
+    enumSolver = Enumerate(n, calc_observables_multipliers=ising.calc_observables)
+
+    hJ, soln = enumSolver.solve(sisj,
+                                initial_guess=initial_guess,
+                                max_param_value=50*n/9,
+                                full_output=True,
+                                scipy_solver_kwargs={'method':'hybr'})
+    if not potts and np.linalg.norm(soln['fun'])>1e-3:
+        # try Pseudo (non-ergodic?)
+        print("Entering pseudo %s."%name)
+        get_multipliers_r, calc_observables_r = define_pseudo_ising_helper_functions(n)
+        pseudoSolver = Pseudo(n,
+                              calc_observables=calc_observables,
+                              calc_observables_r=calc_observables_r,
+                              get_multipliers_r=get_multipliers_r)
+        hJ = pseudoSolver.solve(X, np.zeros(n+n*(n-1)//2))
+
+        # try again
+        try:
+            if force_krylov:
+                kwargs = {'method':'krylov'}
+            else:
+                kwargs = {'method':'hybr'}
+            hJ, soln = enumSolver.solve(sisj,
+                                        initial_guess=hJ,
+                                        max_param_value=50*n/9,
+                                        scipy_solver_kwargs=kwargs,
+                                        full_output=True)
+        # this occurs when Jacobian inverse returns zero vector
+        except ValueError:
+            soln = None
+    elif potts and np.linalg.norm(soln['fun'])>1e-3:
+        hJ, soln = enumSolver.solve(sisj,
+                                    max_param_value=50*n/9,
+                                    full_output=True,
+                                    scipy_solver_kwargs={'method':'krylov'})
+
+    print("Done with %s."%name)
+    if potts:
+        hJ[:n*3] -= np.tile(hJ[:n],3)
+    return hJ, soln
+
+def cached_solve_inverse(X, name='',
+                         potts=False,
+                         force_krylov=False,
+                         cache_dr=None,
+                         warm_start_tol=1e-2):
+    """Wrapper for solve_inverse that looks up solutions in a persistent cache.
+
+    Solutions are stored in a ResultStore keyed by a hash of the sufficient statistics
+    (rounded to 12 decimal places) and the solver settings, so the same data always maps
+    to the same key regardless of how the samples are ordered. If there is no entry for
+    the data, the cached solution with the closest statistics (within warm_start_tol by
+    max absolute difference) is used as the initial guess for the solver. The statistics
+    are kept in the store's index so that this search does not read any other files. Only
+    successful solutions are saved so that failed solves are retried.
+
+    Parameters
+    ----------
+    X : ndarray
+    name : str, ''
+    potts : bool, False
+    force_krylov : bool, False
+    cache_dr : str, None
+        Directory of cache. If None, caching is off and solve_inverse is called directly.
+    warm_start_tol : float, 1e-2
+
+    Returns
+    -------
+    ndarray
+        hJ
+    dict
+        Solution report.
+    """
+
+    import hashlib
+    if cache_dr is None:
+        return solve_inverse(X, name, potts=potts, force_krylov=force_krylov)
+
+    sisj = sufficient_stats(X, potts)
+    settings = repr((X.shape[1], bool(potts), bool(force_krylov)))
+    h = hashlib.sha1(settings.encode())
+    h.update(np.ascontiguousarray(np.round(sisj, 12)).tobytes())
+    key = h.hexdigest()
+    
+    store = ResultStore(cache_dr)
+    if key in store:
+        rec = store.load(key, mmap=False)
+        return rec['hJ'], rec['soln']
+    
+    # warm start from the solution with the most similar statistics
+    initialGuess = None
+    minDist = warm_start_tol
+    for k in store.keys():
+        entry = store.index[k]
+        if entry['settings'][1]==settings and entry['sisj'][0]=='value':
+            dist = np.abs(entry['sisj'][1] - sisj).max()
+            if dist<minDist:
+                minDist = dist
+                initialGuess = store.load(k, ['hJ'], mmap=False)['hJ']
+    
+    hJ, soln = solve_inverse(X, name,
+                             potts=potts,
+                             force_krylov=force_krylov,
+                             initial_guess=initialGuess)
+    if (not soln is None) and soln['success']:
+        store.save(key, {'sisj':sisj, 'hJ':hJ, 'soln':soln, 'settings':settings},
+                   inline=('sisj',))
+    return hJ, soln
+
+def solve_inverse_on_data(data, n_cpus=4, potts=False, force_krylov=False,
+                          cache_dr='cache/maxent_solutions'):
     """Automate solution of inverse problem on data dictionary. Only run on tuples in dict
     that only have two entries (the others presumably have already been solved and the
     solutions saved).
@@ -176,70 +502,24 @@ def solve_inverse_on_data(data, n_cpus=4, potts=False, force_krylov=False):
     n_cpus : int, 4
     potts: bool, False
     force_krylov : bool, False
+    cache_dr : str, 'cache/maxent_solutions'
+        Solutions are looked up in and saved to this cache with cached_solve_inverse. If
+        None, caching is off and every data set is solved.
 
     Returns
     -------
     None
     """
     
-    from coniii.utils import pair_corr, define_ising_helper_functions, define_pseudo_ising_helper_functions
-    from data_sets.neuron.data import potts_pair_corr
-    from coniii.solvers import Enumerate, Pseudo
-    import importlib
     from multiprocess import Pool, cpu_count
     
-    _, calc_observables, _ = define_ising_helper_functions()
-
     def single_solution_wrapper(item):
-        name = item[0]
-        X = item[1][1]
-        n = X.shape[1]
-        print("Solving %s."%name)
-        if potts:
-            assert np.array_equal(np.unique(X), [0,1,2])
-            sisj = potts_pair_corr(X, k=3, concat=True)
-            ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_potts'%n)
-        else:
-            sisj = pair_corr(X, concat=True)
-            ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%n)
-        enumSolver = Enumerate(n, calc_observables_multipliers=ising.calc_observables)
-
-        hJ, soln = enumSolver.solve(sisj,
-                                    max_param_value=50*n/9,
-                                    full_output=True,
-                                    scipy_solver_kwargs={'method':'hybr'})
-        if not potts and np.linalg.norm(soln['fun'])>1e-3:
-            # try Pseudo (non-ergodic?)
-            print("Entering pseudo %s."%name)
-            get_multipliers_r, calc_observables_r = define_pseudo_ising_helper_functions(n)
-            pseudoSolver = Pseudo(n,
-                                  calc_observables=calc_observables,
-                                  calc_observables_r=calc_observables_r,
-                                  get_multipliers_r=get_multipliers_r)
-            hJ = pseudoSolver.solve(X, np.zeros(n+n*(n-1)//2))
-
-            # try again
-            try:
-                if force_krylov:
-                    kwargs = {'method':'krylov'}
-                else:
-                    kwargs = {'method':'hybr'}
-                hJ, soln = enumSolver.solve(sisj,
-                                            initial_guess=hJ,
-                                            max_param_value=50*n/9,
-                                            scipy_solver_kwargs=kwargs,
-                                            full_output=True)
-            # this occurs when Jacobian inverse returns zero vector
-            except ValueError:
-                soln = None
-        elif potts and np.linalg.norm(soln['fun'])>1e-3:
-            hJ, soln = enumSolver.solve(sisj,
-                                        max_param_value=50*n/9,
-                                        full_output=True,
-                                        scipy_solver_kwargs={'method':'krylov'})
-
-        print("Done with %s."%name)
-        return hJ, soln
+        if cache_dr is None:
+            return solve_inverse(item[1][1], item[0], potts=potts, force_krylov=force_krylov)
+        return cached_solve_inverse(item[1][1], item[0],
+                                    potts=potts,
+                                    force_krylov=force_krylov,
+                                    cache_dr=cache_dr)
     
     if n_cpus>1:
         pool = Pool(cpu_count()//4)
@@ -257,9 +537,6 @@ def solve_inverse_on_data(data, n_cpus=4, potts=False, force_krylov=False):
     # update data dict
     keys = [i[0] for i in data.items() if len(i[1])==2]
     for i,k in enumerate(keys):
-        n = len(data[k][0])
-        if potts:
-            hJ[i][:n*3] -= np.tile(hJ[i][:n],3)
         data[k].append(hJ[i])
         data[k].append(soln[i])
     assert all([len(i)==4 for i in data.values()])
@@ -269,7 +546,7 @@ def calculate_fisher_on_pk(data,
                            method='',
                            computed_results=None,
                            eps=1e-6,
-                           high_prec_dps=30,
+                           high_prec_dps=None,
                            save=True,
                            save_every_loop=True,
                            fi_method=2,
@@ -282,9 +559,13 @@ def calculate_fisher_on_pk(data,
     method : str, ''
     computed_results: dict, None
         If given, results will be appended onto this.
-    high_prec_dps : int, 30
+    high_prec_dps : int, None
+        Deprecated and has no effect. High precision calculations use double-double
+        arithmetic.
     save : bool, True
-        Save to pickle.
+        Save each key into a ResultStore in
+        cache/Method{fi_method}/{system}/{method}/fisherResultMaj. Keys that are already
+        in the store are loaded as LazyFisherResult instead of being computed again.
     save_every_loop : bool, True
         If False, only save at very end after loops.
     fi_method : int, 2
@@ -296,17 +577,25 @@ def calculate_fisher_on_pk(data,
     dict
     """
     
-    import importlib
-    
-    # fname is only used if save is True
-    fname = 'cache/Method%s/%s/%s/fisherResultMaj.p'%(str(fi_method),system,method)
-    if not os.path.isdir('cache/Method%s/%s/%s'%(str(fi_method),system,method)):
-        os.makedirs('cache/Method%s/%s/%s'%(str(fi_method),system,method))
+    if not high_prec_dps is None:
+        from warnings import warn
+        warn("high_prec_dps is deprecated and has no effect.", DeprecationWarning, stacklevel=2)
+
+    # results are only stored if save is True
+    dr = 'cache/Method%s/%s/%s/fisherResultMaj'%(str(fi_method),system,method)
     
     if computed_results is None:
         fisherResultMaj = {}
     else:
         fisherResultMaj = computed_results
+    
+    if save:
+        # resume from results that were already computed
+        store = ResultStore(dr)
+        for k in data.keys():
+            if k in store and not k in fisherResultMaj.keys():
+                fisherResultMaj[k] = LazyFisherResult(store, k)
+    toSave = []
 
     for k in [kp for kp in data.keys() if not kp in fisherResultMaj.keys()]:
         if (data[k][-1] is None or
@@ -316,50 +605,415 @@ def calculate_fisher_on_pk(data,
             hJ = data[k][2]
             
             try:
-                if str(fi_method)=='1':
-                    isingdkl = IsingFisherCurvatureMethod1(n, h=hJ[:n], J=hJ[n:], eps=eps, high_prec=high_prec)
-                elif fi_method=='1a':
-                    isingdkl = IsingFisherCurvatureMethod1a(n, h=hJ[:n], J=hJ[n:], eps=eps)
-                elif str(fi_method)=='2':
-                    isingdkl = IsingFisherCurvatureMethod2(n, h=hJ[:n], J=hJ[n:], eps=eps)
-                elif str(fi_method)=='2b':
-                    isingdkl = IsingSpinReplacementFIM(n, h=hJ[:n], J=hJ[n:], eps=eps)
-                elif str(fi_method)=='3':
-                    isingdkl = IsingFisherCurvatureMethod3(n, h=hJ[:n], J=hJ[n:], eps=eps)
-                elif str(fi_method)=='4':
-                    isingdkl = IsingFisherCurvatureMethod4(n, 3, h=hJ[:n*3], J=hJ[3*n:], eps=eps)
-                elif fi_method=='4a':
-                    isingdkl = IsingFisherCurvatureMethod4a(n, 3, h=hJ[:n*3], J=hJ[3*n:], eps=eps)
-                else:
-                    raise Exception("Invalid method.")
-                if fi_method=='2b':
-                    hess, errflag, err = isingdkl.maj_curvature(full_output=True,
-                                                                epsdJ=isingdkl.eps,
-                                                                iprint=False)
-                else:
-                    epsdJ = min(1/np.abs(isingdkl.dJ).max()/10, 1e-4)
-                    hess, errflag, err = isingdkl.maj_curvature(full_output=True,
-                                                                epsdJ=epsdJ,
-                                                                iprint=False)
+                isingdkl = fisher_model(n, hJ, fi_method, eps=eps, high_prec=high_prec)
+                hess, errflag, err = fisher_hessian(isingdkl, fi_method)
 
                 eigval, eigvec = isingdkl.hess_eig(hess)
                 
                 fisherResultMaj[k] = [isingdkl, (hess, errflag, err), eigval, eigvec]
+                toSave.append(k)
             
                 if save and save_every_loop:
-                    print("Saving into %s"%fname)
-                    with open(fname, 'wb') as f:
-                        dill.dump({'fisherResultMaj':fisherResultMaj}, f, -1)
+                    print("Saving %s into %s"%(k, dr))
+                    store.save(k, fisher_result_to_record(fisherResultMaj[k]))
+                    toSave.pop()
             except AssertionError as e:
                 print("AssertionError for key %s"%k)
                 print(e)
 
-    if save and not save_every_loop:
-        print("Saving into %s"%fname)
-        with open(fname, 'wb') as f:
-            dill.dump({'fisherResultMaj':fisherResultMaj}, f, -1)
+    if save and toSave:
+        print("Saving into %s"%dr)
+        for k in toSave:
+            store.save(k, fisher_result_to_record(fisherResultMaj[k]))
     return fisherResultMaj
 
+def fisher_model(n, hJ, fi_method, eps=1e-6, high_prec=False, **kwargs):
+    """Set up FIM calculation for given maxent solution.
+
+    Parameters
+    ----------
+    n : int
+    hJ : ndarray
+    fi_method : str or int
+    eps : float, 1e-6
+    high_prec : bool, False
+    **kwargs
+        Passed to FIM class constructor.
+
+    Returns
+    -------
+    Magnetization
+        FIM class from fim.py for specified method.
+    """
+
+    if str(fi_method)=='1':
+        return IsingFisherCurvatureMethod1(n, h=hJ[:n], J=hJ[n:], eps=eps, high_prec=high_prec, **kwargs)
+    elif fi_method=='1a':
+        return IsingFisherCurvatureMethod1a(n, h=hJ[:n], J=hJ[n:], eps=eps, **kwargs)
+    elif str(fi_method)=='2':
+        return IsingFisherCurvatureMethod2(n, h=hJ[:n], J=hJ[n:], eps=eps, **kwargs)
+    elif str(fi_method)=='2b':
+        return IsingSpinReplacementFIM(n, h=hJ[:n], J=hJ[n:], eps=eps, **kwargs)
+    elif str(fi_method)=='3':
+        return IsingFisherCurvatureMethod3(n, h=hJ[:n], J=hJ[n:], eps=eps, **kwargs)
+    elif str(fi_method)=='4':
+        return IsingFisherCurvatureMethod4(n, 3, h=hJ[:n*3], J=hJ[3*n:], eps=eps, **kwargs)
+    elif fi_method=='4a':
+        return IsingFisherCurvatureMethod4a(n, 3, h=hJ[:n*3], J=hJ[3*n:], eps=eps, **kwargs)
+    raise Exception("Invalid method.")
+
+def fisher_hessian(isingdkl, fi_method):
+    """Calculate FIM with step size appropriate for method.
+
+    Parameters
+    ----------
+    isingdkl : Magnetization
+    fi_method : str or int
+
+    Returns
+    -------
+    ndarray
+        Hessian.
+    bool
+        Error flag.
+    ndarray
+        Error estimate.
+    """
+
+    if fi_method=='2b':
+        return isingdkl.maj_curvature(full_output=True,
+                                      epsdJ=isingdkl.eps,
+                                      iprint=False)
+    epsdJ = min(1/np.abs(isingdkl.dJ).max()/10, 1e-4)
+    return isingdkl.maj_curvature(full_output=True,
+                                  epsdJ=epsdJ,
+                                  iprint=False)
+
+def fisher_result_to_record(fisherResultValue):
+    """Convert value of fisherResultMaj dict into a record for ResultStore.
+
+    Parameters
+    ----------
+    fisherResultValue : list
+        [isingdkl, (hess, errflag, err), eigval, eigvec]
+
+    Returns
+    -------
+    dict
+    """
+
+    isingdkl, (hess, errflag, err), eigval, eigvec = fisherResultValue
+    return {'isingdkl':isingdkl,
+            'hess':hess,
+            'errflag':errflag,
+            'err':err,
+            'eigval':eigval,
+            'eigvec':eigvec}
+
+def fisher_result_from_record(record):
+    """Inverse of fisher_result_to_record.
+
+    Parameters
+    ----------
+    record : dict
+
+    Returns
+    -------
+    list
+        [isingdkl, (hess, errflag, err), eigval, eigvec]
+    """
+
+    return [record['isingdkl'],
+            (record['hess'], record['errflag'], record['err']),
+            record['eigval'],
+            record['eigvec']]
+
+class LazyFisherResult(list):
+    """Value of fisherResultMaj, [isingdkl, (hess, errflag, err), eigval, eigvec], read
+    from a ResultStore. Arrays are memory mapped and isingdkl, which is expensive to
+    deserialize, is only loaded when it is first accessed.
+    """
+    def __init__(self, store, key):
+        """
+        Parameters
+        ----------
+        store : ResultStore
+        key : object
+        """
+
+        rec = store.load(key, ['hess', 'errflag', 'err', 'eigval', 'eigvec'])
+        super().__init__([None,
+                          (rec['hess'], rec['errflag'], rec['err']),
+                          rec['eigval'],
+                          rec['eigvec']])
+        self._store = store
+        self._key = key
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            list.__setitem__(self, 0, self._store.load(self._key, ['isingdkl'])['isingdkl'])
+            self._loaded = True
+
+    def __getitem__(self, i):
+        if isinstance(i, slice) or i in (0, -len(self)):
+            self._load()
+        return super().__getitem__(i)
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+#end LazyFisherResult
+
+
+
+class BatchRunner():
+    """Run the pivotal component pipeline on many data sets at once.
+
+    Each data set is a chain of stages, solve -> dJ -> hessian -> eigen -> summaries, and
+    a stage is scheduled as soon as the previous stage for that data set finishes. Thus,
+    stages of different data sets overlap on a single shared pool of workers instead of
+    running one stage at a time across all data sets with a separate pool for each. BLAS
+    threads are limited within each task such that the total number of threads stays
+    within the budget of n_cpus.
+
+    The output of each stage is stored in a ResultStore under DR/{stage} (FIM results in
+    the same format as calculate_fisher_on_pk) so that a restarted run resumes from the
+    last completed stage for each data set. Wall clock time spent on each stage is
+    recorded in self.timings, and stages that raised an exception are recorded in
+    self.failures.
+    """
+    STAGES = ('solve', 'dJ', 'hessian', 'eigen', 'summaries')
+
+    def __init__(self, data, dr,
+                 fi_method='2b',
+                 eps=1e-6,
+                 potts=False,
+                 force_krylov=False,
+                 n_cpus=None,
+                 blas_threads=1,
+                 summary_f=None):
+        """
+        Parameters
+        ----------
+        data : dict
+            As in solve_inverse_on_data. Values are lists starting with component names
+            and the data sample.
+        dr : str
+            Directory in which to store results.
+        fi_method : str, '2b'
+            See fisher_model.
+        eps : float, 1e-6
+        potts : bool, False
+        force_krylov : bool, False
+        n_cpus : int, None
+            Total budget of cpus. Default is all of them.
+        blas_threads : int, 1
+            BLAS threads given to each task. Number of workers is n_cpus//blas_threads.
+        summary_f : function, None
+            Takes (isingdkl, hess, eigval, eigvec) and returns a dict of summaries. Default
+            is fisher_summaries.
+        """
+        
+        from multiprocess import cpu_count
+        self.data = data
+        self.dr = dr
+        self.fi_method = fi_method
+        self.eps = eps
+        self.potts = potts
+        self.force_krylov = force_krylov
+        self.n_cpus = n_cpus or cpu_count()
+        self.blas_threads = blas_threads
+        self.summary_f = summary_f or fisher_summaries
+        assert self.n_cpus>=blas_threads>0
+
+        self.stores = {'solve':ResultStore(f'{dr}/solve'),
+                       'dJ':ResultStore(f'{dr}/model'),
+                       'eigen':ResultStore(f'{dr}/fisherResultMaj'),
+                       'summaries':ResultStore(f'{dr}/summaries')}
+        self.timings = {}
+        self.failures = {}
+
+    def _first_stage(self, k):
+        """First stage that has not been completed for given key along with the stored
+        inputs for that stage.
+        """
+
+        if k in self.stores['summaries']:
+            return None, None
+        if k in self.stores['eigen']:
+            rec = self.stores['eigen'].load(k, mmap=False)
+            return 'summaries', (rec['isingdkl'], rec['hess'], rec['eigval'], rec['eigvec'])
+        if k in self.stores['dJ']:
+            return 'hessian', (self.stores['dJ'].load(k)['isingdkl'],)
+        if k in self.stores['solve']:
+            rec = self.stores['solve'].load(k, mmap=False)
+            return 'dJ', (rec['hJ'],)
+        return 'solve', ()
+
+    def _task(self, k, stage, inputs):
+        """Function and arguments for running stage."""
+        
+        from functools import partial
+        if stage=='solve':
+            return solve_inverse, (self.data[k][1], str(k), self.potts, self.force_krylov)
+        if stage=='dJ':
+            # no pools in worker processes
+            return (partial(fisher_model, n_cpus=1),
+                    (self.data[k][1].shape[1], inputs[0], self.fi_method, self.eps))
+        if stage=='hessian':
+            return _hessian_stage, (inputs[0], self.fi_method)
+        if stage=='eigen':
+            return _eigen_stage, inputs
+        return self.summary_f, inputs
+
+    def _store(self, k, stage, inputs, output):
+        """Save output of stage and return inputs to next stage."""
+
+        if stage=='solve':
+            hJ, soln = output
+            self.stores['solve'].save(k, {'hJ':hJ, 'soln':soln})
+            return (hJ,)
+        if stage=='dJ':
+            self.stores['dJ'].save(k, {'isingdkl':output})
+            return (output,)
+        if stage=='hessian':
+            return (inputs[0], output)
+        if stage=='eigen':
+            isingdkl, (hess, errflag, err) = inputs
+            eigval, eigvec = output
+            self.stores['eigen'].save(k, fisher_result_to_record([isingdkl, (hess, errflag, err), eigval, eigvec]))
+            return (isingdkl, hess, eigval, eigvec)
+        self.stores['summaries'].save(k, output)
+        return None
+
+    def run(self, keys=None, iprint=True):
+        """Run all remaining stages for all data sets.
+
+        Parameters
+        ----------
+        keys : list, None
+            Data sets to run. Default is all of them.
+        iprint : bool, True
+
+        Returns
+        -------
+        dict
+            Summaries for each data set.
+
+        Raises
+        ------
+        RuntimeError
+            If any stage failed, after all other data sets have been run. Failures are
+            kept in self.failures as key:(stage, exception) and completed stages are
+            stored such that run() can be called again to retry.
+        """
+        
+        from multiprocess import Pool
+        from queue import Queue
+        import traceback
+        keys = list(self.data.keys()) if keys is None else keys
+        for k in keys:
+            self.failures.pop(k, None)
+        done = Queue()
+        nPending = 0
+        
+        with Pool(self.n_cpus//self.blas_threads) as pool:
+            def submit(k, stage, inputs):
+                f, args = self._task(k, stage, inputs)
+                pool.apply_async(_run_stage, (f, args, self.blas_threads),
+                                 callback=lambda out: done.put((k, stage, inputs, out, None)),
+                                 error_callback=lambda e: done.put((k, stage, inputs, None, e)))
+            
+            for k in keys:
+                stage, inputs = self._first_stage(k)
+                if not stage is None:
+                    submit(k, stage, inputs)
+                    nPending += 1
+
+            while nPending:
+                k, stage, inputs, out, error = done.get()
+                nPending -= 1
+                if not error is None:
+                    self.failures[k] = (stage, error)
+                    print("Stage %s failed for key %s."%(stage, k))
+                    print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                    continue
+                
+                output, dt = out
+                self.timings.setdefault(k, {})[stage] = dt
+                if iprint: print("Done with %s for %s in %.1f s."%(stage, k, dt))
+                inputs = self._store(k, stage, inputs, output)
+                
+                if stage!='summaries':
+                    submit(k, self.STAGES[self.STAGES.index(stage)+1], inputs)
+                    nPending += 1
+
+        failed = [k for k in keys if k in self.failures]
+        if failed:
+            raise RuntimeError("Stages failed for %d keys: %s"%(len(failed),
+                ', '.join(["%s (%s)"%(k, self.failures[k][0]) for k in failed])))
+        return {k:self.stores['summaries'].load(k) for k in keys if k in self.stores['summaries']}
+
+    def stage_timings(self):
+        """Total and mean wall clock time per stage for the stages run by this instance.
+
+        Returns
+        -------
+        dict
+            Keys are stages and values are (total, mean) in seconds.
+        """
+
+        timings = {}
+        for stage in self.STAGES:
+            t = [v[stage] for v in self.timings.values() if stage in v]
+            if t:
+                timings[stage] = (sum(t), sum(t)/len(t))
+        return timings
+#end BatchRunner
+
+
+def _run_stage(f, args, blas_threads):
+    """Run stage function with limited BLAS threads and time it."""
+
+    from time import perf_counter
+    t0 = perf_counter()
+    with threadpool_limits(limits=blas_threads, user_api='blas'):
+        output = f(*args)
+    return output, perf_counter()-t0
+
+def _hessian_stage(isingdkl, fi_method):
+    return fisher_hessian(isingdkl, fi_method)
+
+def _eigen_stage(isingdkl, hessResult):
+    return isingdkl.hess_eig(hessResult[0])
+
+def fisher_summaries(isingdkl, hess, eigval, eigvec):
+    """Default summaries for BatchRunner.
+
+    Parameters
+    ----------
+    isingdkl : Magnetization
+    hess : ndarray
+    eigval : ndarray
+    eigvec : ndarray
+
+    Returns
+    -------
+    dict
+        'eigval' for the top 10 eigenvalues. For pairwise perturbations, 'voter_eigval'
+        with the top eigenvalue of each component's subspace and 'asymmetry' of the
+        principal mode per component.
+    """
+
+    from .spectral import block_subspace_eig, pair_asymmetry
+    n = isingdkl.n
+    summaries = {'eigval':np.array(eigval[:10]).real}
+    if hess.shape[0]==n*(n-1):
+        summaries['voter_eigval'] = np.array([v[0] for v in block_subspace_eig(hess)[0]])
+        summaries['asymmetry'] = pair_asymmetry(np.array(eigvec).real, rank=0, by_voter=True)
+    return summaries
+
 def extract_voter_subspace(fisherResult,
                            return_n_voters=3,
                            remove_n_modes=0):
@@ -34,7 +34,7 @@ def uniformity(eigvec, axis=0):
         mats.append( vec2mat(eigvec[:,i]) )
     return np.array([(m.sum(axis)**2).sum() for m in mats])
 
-def block_mean(n, X):
+def block_mean(n, X, **kwargs):
     """Coarse grain matrix by taking averages of blocks that correspond to perturbations
     focused on particular receiver and target pairs.
     
@@ -42,6 +42,8 @@ def block_mean(n, X):
     ----------
     n : int
     X : ndarray
+    **kwargs
+        Passed to block_reduce_fim.
     
     Returns
     -------
@@ -49,20 +51,9 @@ def block_mean(n, X):
         Coarse-grained X.
     """
     
-    assert n==(X.shape[0]/(n-1))
-    coarseX = np.zeros((n,n))
-    
-    # coarse-grain diagonal
-    for i in range(n):
-        coarseX[i,i] = X[i*(n-1):(i+1)*(n-1),i*(n-1):(i+1)*(n-1)].mean()
-    # coarse grain off-diagonal elements
-    for i in range(n-1):
-        for j in range(i+1, n):
-            coarseX[i,j] = coarseX[j,i] = X[i*(n-1):(i+1)*(n-1),j*(n-1):(j+1)*(n-1)].mean()
-            
-    return coarseX
+    return block_reduce_fim(n, X, 'mean', **kwargs)
 
-def block_sum(n, X):
+def block_sum(n, X, **kwargs):
     """Coarse grain matrix by taking sums of blocks that correspond to perturbations
     focused on particular receiver and target pairs.
     
@@ -70,6 +61,8 @@ def block_sum(n, X):
     ----------
     n : int
     X : ndarray
+    **kwargs
+        Passed to block_reduce_fim.
     
     Returns
     -------
@@ -77,20 +70,123 @@ def block_sum(n, X):
         Coarse-grained X.
     """
     
-    assert n==(X.shape[0]/(n-1))
-    coarseX = np.zeros((n,n))
+    return block_reduce_fim(n, X, 'sum', **kwargs)
+
+def _shuffle_segments(n):
+    """Segment boundaries and block labels for reducing the flattened upper triangle of a
+    FIM with pairwise perturbation blocks without materializing the full matrix.
+
+    Entries of np.triu_indices(n*(n-1), k=1) are ordered row by row, so each row splits
+    into contiguous runs that fall into the same (row block, col block) pair.
     
-    # coarse-grain diagonal
-    for i in range(n):
-        coarseX[i,i] = X[i*(n-1):(i+1)*(n-1),i*(n-1):(i+1)*(n-1)].sum()
-    # coarse grain off-diagonal elements
-    for i in range(n-1):
-        for j in range(i+1, n):
-            coarseX[i,j] = coarseX[j,i] = X[i*(n-1):(i+1)*(n-1),j*(n-1):(j+1)*(n-1)].sum()
-            
-    return coarseX
+    Parameters
+    ----------
+    n : int
+        Number of spins.
 
-def shuffled_entropy(fim, n_iters, n=50):
+    Returns
+    -------
+    ndarray
+        Start index of each contiguous segment in the flattened upper triangle.
+    ndarray
+        Label bi*n+bj of the block that each segment falls into.
+    """
+    
+    k = n-1
+    P = n*k
+    starts = []
+    labels = []
+    offset = 0
+
+    for r in range(P-1):
+        br = r//k
+        cols = [r+1] + list(range((br+1)*k, P, k))
+        if cols[1:] and cols[1]==cols[0]:
+            cols.pop(0)
+        starts.extend([offset + c - r - 1 for c in cols])
+        labels.extend([br*n + c//k for c in cols])
+        offset += P-1-r
+
+    return np.array(starts, dtype=np.int64), np.array(labels, dtype=np.int64)
+
+def shuffled_block_fim(fim, n, n_iters,
+                       reducer='mean',
+                       n_cpus=None,
+                       batch_size=50,
+                       seed=None):
+    """Coarse-grained FIMs after shuffling the diagonal and off-diagonal entries.
+    
+    Shuffling is done directly in block-reduced form. Permuted upper triangle entries
+    are summed into the n x n blocks with a single reduceat on precomputed segments,
+    so the full shuffled FIM is never constructed. Samples are generated in batches
+    that are farmed out to workers, each with its own RNG stream spawned from the same
+    SeedSequence. For a fixed seed and batch_size, the result does not depend on the
+    number of cpus.
+
+    Parameters
+    ----------
+    fim : ndarray
+    n : int
+        Number of spins.
+    n_iters : int
+        Number of shuffled samples.
+    reducer : str, 'mean'
+        'mean' or 'sum' to coarse grain like block_mean or block_sum.
+    n_cpus : int, None
+        If None, all cpus are used. If 1, run serially.
+    batch_size : int, 50
+        Number of samples generated per task.
+    seed : int or np.random.SeedSequence, None
+    
+    Returns
+    -------
+    ndarray
+        Coarse-grained shuffled FIMs of dimensions (n_iters, n, n).
+    """
+    
+    assert n==(fim.shape[0]/(n-1))
+    assert reducer in ('mean', 'sum')
+    from multiprocess import Pool, cpu_count
+    from threadpoolctl import threadpool_limits
+    k = n-1
+
+    diag = fim.diagonal().copy()
+    offdiag = fim[np.triu_indices_from(fim, k=1)]
+    starts, labels = _shuffle_segments(n)
+    # diagonal blocks receive each off-diagonal entry twice from symmetry
+    diagblock = np.arange(n)*(n+1)
+    
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    batches = [min(batch_size, n_iters-i) for i in range(0, n_iters, batch_size)]
+    streams = seed.spawn(len(batches))
+
+    def sample(args):
+        stream, n_samples = args
+        rng = np.random.default_rng(stream)
+        coarse = np.zeros((n_samples, n, n))
+
+        for i in range(n_samples):
+            c = np.bincount(labels,
+                            weights=np.add.reduceat(rng.permutation(offdiag), starts),
+                            minlength=n*n)
+            c[diagblock] *= 2
+            c[diagblock] += rng.permutation(diag).reshape(n, k).sum(1)
+            c = c.reshape(n, n)
+            coarse[i] = np.triu(c) + np.triu(c, 1).T
+        if reducer=='mean':
+            coarse /= k*k
+        return coarse
+    
+    if n_cpus==1 or len(batches)==1:
+        coarse = [sample(args) for args in zip(streams, batches)]
+    else:
+        with threadpool_limits(limits=1, user_api='blas'):
+            with Pool(min(n_cpus or cpu_count(), len(batches))) as pool:
+                coarse = pool.map(sample, zip(streams, batches))
+    return np.concatenate(coarse)
+
+def shuffled_entropy(fim, n_iters, n=50, **kwargs):
     """Shuffle FIM entries and calculate block-averaged entropy.
     
     This serves as null for the pivotal neuron structure.
@@ -101,31 +197,23 @@ def shuffled_entropy(fim, n_iters, n=50):
     n_iters : int
     n : int, 50 
         Number of spins.
+    **kwargs
+        Passed to shuffled_block_fim, e.g. n_cpus, batch_size, seed.
     
     Returns
     -------
     list of ndarray of length n_iters
     """
     
-    S = []
-    diag = fim.diagonal()
-    offdiag = fim[np.triu_indices_from(fim, k=1)]
-    
-    for i in range(n_iters):
-        mixedfim = np.zeros_like(fim)
-        mixedfim[np.triu_indices_from(fim, k=1)] = np.random.permutation(offdiag)
-        mixedfim += mixedfim.T
-        mixedfim[np.diag_indices_from(fim)] = np.random.permutation(diag)
-        
-        val, vec = sorted_eigh(block_mean(n, mixedfim))
-
-        p = vec**2
-        S.append(-(p * np.log2(p)).sum(0))
+    val, vec = sorted_eigh(shuffled_block_fim(fim, n, n_iters, **kwargs))
 
-    return S
+    p = vec**2
+    return list(-(p * np.log2(p)).sum(1))
 
 def sorted_eigh(X):
-    """
+    """Eigendecomposition sorted by descending eigenvalue. A stack of matrices with
+    dimensions (..., m, m) is decomposed in a single batched call.
+
     Parameters
     ----------
     X : ndarray
@@ -137,10 +225,67 @@ def sorted_eigh(X):
     """
 
     val, vec = np.linalg.eigh(X)
-    sortix = np.argsort(val)[::-1]
-    return val[sortix], vec[:,sortix]
+    sortix = np.argsort(val, axis=-1)[...,::-1]
+    val = np.take_along_axis(val, sortix, -1)
+    vec = np.take_along_axis(vec, sortix[...,None,:], -1)
+    return val, vec
 
-def cfim_entropy(fim, n=50, n_iters=100):
+def top_eigval(X, method='auto', tol=1e-10, max_iter=10_000):
+    """Largest eigenvalue of each symmetric matrix in a stack.
+    
+    Parameters
+    ----------
+    X : ndarray
+        Stack of symmetric matrices of dimensions (b, m, m).
+    method : str, 'auto'
+        'eigvalsh' for a batched call to np.linalg.eigvalsh or 'power' for batched
+        power iteration, which only makes sense for positive semidefinite matrices like
+        the FIM. 'auto' chooses power iteration for m>500.
+    tol : float, 1e-10
+        Relative tolerance for convergence of power iteration.
+    max_iter : int, 10_000
+        
+    Returns
+    -------
+    ndarray
+    """
+    
+    assert X.ndim==3 and X.shape[1]==X.shape[2]
+    if method=='auto':
+        method = 'power' if X.shape[1]>500 else 'eigvalsh'
+
+    if method=='eigvalsh':
+        return np.linalg.eigvalsh(X)[:,-1]
+    if method!='power':
+        raise Exception("Unrecognized method.")
+
+    v = np.random.RandomState(0).rand(*X.shape[:2])
+    v /= np.linalg.norm(v, axis=1)[:,None]
+    val = np.zeros(X.shape[0])
+    # only iterate on the matrices that have not converged, which are compacted into a
+    # contiguous stack only when one of them converges instead of on every iteration
+    ix = np.arange(X.shape[0])
+    activeX, activeVal = X, val.copy()
+    counter = 0
+    while ix.size and counter<max_iter:
+        w = np.einsum('bij,bj->bi', activeX, v)
+        # Rayleigh quotient converges faster than the norm of w
+        newval = (w*v).sum(1)
+        converged = np.abs(newval-activeVal) <= tol*np.abs(newval)
+        activeVal = newval
+        v = w / np.linalg.norm(w, axis=1)[:,None]
+        counter += 1
+        
+        if converged.any():
+            val[ix[converged]] = activeVal[converged]
+            keep = ~converged
+            ix, activeX, activeVal, v = ix[keep], activeX[keep], activeVal[keep], v[keep]
+    if ix.size:
+        val[ix] = activeVal
+        warn("Power iteration did not converge for %d matrices."%ix.size)
+    return val
+
+def cfim_entropy(fim, n=50, n_iters=100, **kwargs):
     """Calculate entropy of the eigenvectors of block-summed FIMs for each specified
     solution.
     
@@ -153,6 +298,8 @@ def cfim_entropy(fim, n=50, n_iters=100):
         Number of spins.
     n_iters : int, 100
         Number of random samples to iterate over.
+    **kwargs
+        Passed to shuffled_block_fim for generating the null samples.
         
     Returns
     -------
@@ -167,7 +314,7 @@ def cfim_entropy(fim, n=50, n_iters=100):
 
     p = vec**2
     S = -(p * np.log2(p)).sum(0)
-    mixedS = shuffled_entropy(fim, n_iters)
+    mixedS = shuffled_entropy(fim, n_iters, n, **kwargs)
     
     return S, mixedS
 
@@ -331,6 +478,9 @@ def pair_asymmetry(eigvec, rank=0, by_voter=False, eigval=None):
         Asymmetry measure.
     """
     
+    # module-level name may be coniii's vec2mat from the circular import with utils
+    from .utils import vec2mat
+
     if eigval is None:
         v = vec2mat(eigvec[:,rank])
         if by_voter:
@@ -3,6 +3,7 @@
 # Author : Eddie Lee, edlee@santafe.edu
 # ============================================================================================ # 
 from .coarse_grain import *
+from itertools import product
 
 
 
@@ -28,3 +29,45 @@ def test_enumerate_unique_splits():
 
         assert (np.diff(splits, axis=1)<=0).all()
         print(f"Test passed {i}: Preceding groups are always larger than the next.")
+
+def test_p_k(n=6, rng=np.random.RandomState(0)):
+    X = rng.randint(3, size=(1000,n))
+    weights = rng.rand(1000)
+    p, bins = p_k(X, weights)
+    
+    # compare with direct calculation from sorted counts of each sample
+    counts = np.sort(np.vstack([(X==k).sum(1) for k in range(3)]).T, axis=1)[:,::-1]
+    assert np.array_equal(bins, np.unique(counts, axis=0))
+    for p_, b in zip(p, bins):
+        assert np.isclose(p_, weights[(counts==b).all(1)].sum() / weights.sum())
+    print("Test passed: weighted p(k) agrees with direct calculation.")
+
+    pChunk, binsChunk = p_k(X, weights, chunk_size=123)
+    assert np.array_equal(bins, binsChunk) and np.allclose(p, pChunk)
+    pmaj, binsmaj = p_maj(X, weights)
+    pmajChunk, binsmajChunk = p_maj(X, weights, chunk_size=123)
+    assert np.array_equal(binsmaj, binsmajChunk) and np.allclose(pmaj, pmajChunk)
+    assert np.array_equal(binsmaj, np.unique(counts[:,0]))
+    print("Test passed: streaming in chunks gives the same distribution.")
+
+def test_PartitionIndex(n=7, rng=np.random.RandomState(0)):
+    for K in (2, 3, 4):
+        index = PartitionIndex(n, K)
+        splits = index.splits()
+        assert len(index)==len(splits)==count_unique_splits(n, K)
+        # independent count of unique sorted bincounts over all K^n states
+        allStates = np.array(list(product(range(K), repeat=n)))
+        bruteSplits = np.unique(np.sort(np.vstack([(allStates==k).sum(1) for k in range(K)]).T,
+                                        axis=1)[:,::-1], axis=0)
+        assert len(index)==len(bruteSplits)
+        assert set(map(tuple, splits))==set(map(tuple, bruteSplits))
+        assert np.array_equal(index.rank(splits), np.arange(len(index)))
+        assert np.array_equal(index.unrank(np.arange(len(index))), splits)
+        print(f"Test passed K={K}: rank and unrank are inverses.")
+
+        X = rng.randint(K, size=(200,n))
+        counts = np.sort(np.vstack([(X==k).sum(1) for k in range(K)]).T, axis=1)[:,::-1]
+        uniq, invix = np.unique(counts, axis=0, return_inverse=True)
+        assert np.array_equal(index.unrank(index.state_index(X)), counts)
+        assert np.array_equal(index.coarse_index(X)[1], invix.ravel())
+        print(f"Test passed K={K}: coarse index agrees with np.unique on sorted counts.")
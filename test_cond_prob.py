@@ -0,0 +1,117 @@
+# ====================================================================================== #
+# Test module for cond_prob.py
+# Author : Eddie Lee, edlee@santafe.edu
+# ====================================================================================== #
+from .cond_prob import *
+from .cond_prob import _exact_cond_dist, _append_checkpoint, _read_checkpoint
+from .models import ExactIsing
+from coniii.utils import bin_states, define_ising_helper_functions
+from tempfile import mkdtemp
+
+
+def test_pack_states(n=10, rng=np.random.RandomState(0)):
+    X = rng.choice([-1,1], size=(100,n))
+    assert np.array_equal(unpack_states(pack_states(X), n), X)
+    assert np.array_equal(pack_states(bin_states(n, True)), np.arange(2**n))
+    print("Test passed: packed states round trip and follow ordering of bin_states.")
+
+def test_exact_cond_dist(n=6, rng=np.random.RandomState(0)):
+    class Sampler():
+        calc_e = define_ising_helper_functions()[0]
+        theta = rng.normal(scale=.3, size=n+n*(n-1)//2)
+    ising = ExactIsing(n)
+    p = ising.p(Sampler.theta)
+    allStates = bin_states(n, True)
+
+    s = np.array([1,0,-1,0,0,1])
+    keys, condp = _exact_cond_dist(s, Sampler)
+    agree = (allStates[:,s!=0]==s[s!=0]).all(1)
+    assert np.array_equal(np.sort(keys), np.where(agree)[0])
+    assert np.allclose(condp, p[keys] / p[agree].sum())
+    print("Test passed: exact conditional distribution agrees with brute force.")
+
+def test_read_checkpoint():
+    fname = '%s/checkpoint.p'%mkdtemp()
+    records = [(i, np.arange(i+1), np.ones(i+1)/(i+1)) for i in range(3)]
+    with open(fname, 'wb') as f:
+        pickle.dump(('header', 'abc'), f, -1)
+        for r in records:
+            _append_checkpoint(f, r)
+    size = os.path.getsize(fname)
+
+    # tear final record
+    with open(fname, 'ab') as f:
+        f.write(pickle.dumps(records[0], -1)[:-5])
+    header, results = _read_checkpoint(fname)
+    assert header=='abc'
+    assert sorted(results.keys())==[0,1,2]
+    for i, keys, condp in records:
+        assert np.array_equal(results[i][0], keys) and np.array_equal(results[i][1], condp)
+    assert os.path.getsize(fname)==size
+    print("Test passed: complete records are recovered and torn record is truncated.")
+
+def test_calc_p_S_given_case(n=7, rng=np.random.RandomState(0)):
+    calc_e = define_ising_helper_functions()[0]
+    theta = rng.normal(scale=.3, size=n+n*(n-1)//2)
+
+    class Sampler():
+        # samples exactly from the conditional distribution
+        def __init__(self):
+            self.calc_e, self.theta = calc_e, theta
+            self.rng = np.random.RandomState()
+            self.counter = 0
+        def generate_cond_samples(self, size, fixed, burn_in=0, parallel=False):
+            self.counter += 1
+            s = np.zeros(n, dtype=int)
+            for i, si in fixed:
+                s[i] = si
+            keys, condp = _exact_cond_dist(s, self)
+            self.samples = unpack_states(keys[self.rng.choice(len(keys), size=size, p=condp)], n)
+    class Solver():
+        sampler = Sampler()
+
+    X = rng.choice([-1,0,1], size=(40,n), p=[.4,.2,.4])
+    X[0] = 0
+    issueTable = rng.randint(2, size=40)
+    issueTable[0] = 1
+    dr = mkdtemp()
+    
+    # exact branch never samples and agrees with the sampled branch
+    p, states = calc_p_S_given_case(X, 1, issueTable, Solver, checkpoint=f'{dr}/exact.p')
+    assert Solver.sampler.counter==0 and np.isclose(p.sum(), 1)
+    assert np.array_equal(states, unpack_states(np.unique(pack_states(states)), n))
+    ps, statess = calc_p_S_given_case(X, 1, issueTable, Solver,
+                                      sample_size=100_000,
+                                      exact_max_free=-1,
+                                      n_cpus=1,
+                                      seed=0,
+                                      checkpoint=f'{dr}/sampled.p')
+    nConditions = Solver.sampler.counter
+    assert np.array_equal(states, statess) and np.abs(p-ps).max()<1e-2
+    print("Test passed: sampled conditional probabilities agree with exact calculation.")
+
+    kw = {'sample_size':1000, 'exact_max_free':-1, 'seed':1}
+    p1 = calc_p_S_given_case(X, 1, issueTable, Solver, n_cpus=1, checkpoint=f'{dr}/1.p', **kw)
+    p2 = calc_p_S_given_case(X, 1, issueTable, Solver, n_cpus=2, checkpoint=f'{dr}/2.p', **kw)
+    assert np.array_equal(p1[0], p2[0]) and np.array_equal(p1[1], p2[1])
+    print("Test passed: result does not depend on the number of cpus.")
+
+    # resume from checkpoint missing the last three conditions
+    header, results = _read_checkpoint(f'{dr}/1.p')
+    with open(f'{dr}/1.p', 'wb') as f:
+        pickle.dump(('header', header), f, -1)
+        for i in sorted(results)[:-3]:
+            _append_checkpoint(f, (i, *results[i]))
+    counter = Solver.sampler.counter
+    p3 = calc_p_S_given_case(X, 1, issueTable, Solver, n_cpus=1, checkpoint=f'{dr}/1.p', **kw)
+    assert Solver.sampler.counter-counter==3 and len(results)==nConditions
+    assert np.array_equal(p1[0], p3[0]) and np.array_equal(p1[1], p3[1])
+    print("Test passed: resuming from checkpoint only calculates unfinished conditions.")
+
+    kw['seed'] = 2
+    try:
+        calc_p_S_given_case(X, 1, issueTable, Solver, n_cpus=1, checkpoint=f'{dr}/1.p', **kw)
+        raise Exception("Checkpoint for different inputs was not refused.")
+    except AssertionError:
+        pass
+    print("Test passed: checkpoint for different inputs is refused.")
@@ -133,6 +133,77 @@ def test_Coupling(n=5, disp=True, time=False):
         print(np.sort(np.abs((hessNdt-hessToCheck)/hessToCheck).ravel())[::-1][:20])
     assert (np.abs((hessNdt-hessToCheck)/hessToCheck)<1e-6).all()
 
+def test_observables_after_perturbation_batch(n=4):
+    rng = np.random.RandomState(0)
+    hJ = rng.normal(scale=.1, size=n*(n-1)//2+n)
+    isingdkl = Coupling(n, h=hJ[:n], J=hJ[n:], eps=1e-4)
+
+    C = isingdkl.observables_after_perturbation_batch()
+    for (i,a), c in zip(isingdkl.perturbation_pairs(), C):
+        assert np.allclose(c, isingdkl.observables_after_perturbation(i, a))
+    assert np.allclose(isingdkl.compute_dJ(batch=True), isingdkl.dJ, atol=1e-8)
+    print("Test passed: batched perturbations agree with one at a time for Ising model.")
+
+    h = rng.normal(scale=.1, size=3*n)
+    h[2*n:] = 0
+    pottsdkl = Coupling3(n, h=h, J=hJ[n:], eps=1e-4, precompute=False)
+    C = pottsdkl.observables_after_perturbation_batch()
+    for (i,a), c in zip(pottsdkl.perturbation_pairs(), C):
+        assert np.allclose(c, pottsdkl.observables_after_perturbation(i, a)[0])
+    print("Test passed: batched perturbations agree with one at a time for Potts model.")
+
+    ternarydkl = TernaryMag(n, h=h, J=hJ[n:], eps=1e-4, precompute=False)
+    ternarydkl._triplets_and_quartets()
+    C = ternarydkl.observables_after_perturbation_batch()
+    for ix, c in enumerate(C):
+        gamma, i = divmod(ix, n)
+        assert np.allclose(c, ternarydkl.observables_after_perturbation(i, gamma)[0])
+    print("Test passed: batched perturbations agree with one at a time for TernaryMag.")
+
+def test_state_index(n=6):
+    rng = np.random.RandomState(0)
+    hJ = rng.normal(scale=.1, size=n*(n-1)//2+n)
+    isingdkl = Magnetization(n, h=hJ[:n], J=hJ[n:], precompute=False)
+
+    assert np.array_equal(isingdkl.state_index(isingdkl.allStates), np.arange(2**n))
+    X = isingdkl.allStates[rng.randint(2**n, size=20)]
+    assert (isingdkl.allStates[isingdkl.state_index(X)]==X).all()
+    print("Test passed: states are mapped to their rows.")
+
+    kix = isingdkl.minority_size()
+    for k in range(n//2+1):
+        assert np.array_equal(kix==k, np.abs(isingdkl.allStates.sum(1))==(n-2*k))
+    print("Test passed: minority sizes agree with the magnetization.")
+
+def test_dlogpk_batch(n=5):
+    rng = np.random.RandomState(0)
+    hJ = rng.normal(scale=.2, size=n*(n-1)//2+n)
+    isingdkl = Coupling(n, h=hJ[:n], J=hJ[n:], eps=1e-4)
+    
+    ds = rng.normal(size=(n*(n-1),4))
+    dlogp = isingdkl.dlogpk_batch(ds)
+    assert dlogp.shape==(n//2+1,4)
+    assert np.allclose(dlogp, isingdkl.dlogpk_batch(ds, eps=1e-5), rtol=1e-6, atol=1e-8)
+    print("Test passed: analytic derivative agrees with finite difference.")
+
+    for d, ds_ in zip(dlogp.T, ds.T):
+        assert np.allclose(d, isingdkl.dlogpk_batch(ds_))
+    print("Test passed: batched directions agree with one at a time.")
+
+    # Potts model with indicator observables and plurality partitions
+    h = rng.normal(scale=.2, size=3*n)
+    h[2*n:] = 0
+    pottsdkl = Coupling3(n, h=h, J=hJ[n:], precompute=False)
+    dJ = rng.normal(size=(pottsdkl.hJ.size,3))
+    dlogp = pottsdkl.dlogpk_batch(dJ, ds_as_dJ=True)
+    eps = 1e-5
+    for d, dJ_ in zip(dlogp.T, dJ.T):
+        # dE is calc_e(states, dJ) as in BlocProjection, so the plus step is hJ - eps*dJ
+        pkplus = np.bincount(pottsdkl.coarseInvix, weights=pottsdkl.ising.p(pottsdkl.hJ - eps*dJ_))
+        pkminus = np.bincount(pottsdkl.coarseInvix, weights=pottsdkl.ising.p(pottsdkl.hJ + eps*dJ_))
+        assert np.allclose(d, (np.log2(pkplus) - np.log2(pkminus))/(2*eps), rtol=1e-6, atol=1e-8)
+    print("Test passed: Potts derivative agrees with finite difference of the model.")
+
 def test_IsingSpinReplacementFIM(n=4, disp=True, time=False):
     rng = np.random.RandomState(0)
     hJ = rng.normal(scale=.1, size=n*(n-1)//2+n)
@@ -145,6 +216,14 @@ def test_IsingSpinReplacementFIM(n=4, disp=True, time=False):
     if disp:
         print("Test passed: All cols of transition matrix sum to 1.")
 
+    pairs = isingdkl.pairs
+    q = spin_replace(isingdkl.p, n, pairs[:,0], pairs[:,1], isingdkl.eps)
+    for (i,j),q_ in zip(pairs, q):
+        assert np.allclose(isingdkl.pair_transition_matrix(i, j).dot(isingdkl.p), q_)
+        assert np.allclose(spin_replace(isingdkl.p, n, i, j, isingdkl.eps), q_)
+    if disp:
+        print("Test passed: Implicit spin replacement agrees with transition matrix.")
+
 #def test_IsingFisherCurvatureMethod3():
 #    n = 5
 #    rng = np.random.RandomState(0)
@@ -447,3 +526,66 @@ def generate_test_params(n, k=2, seed=0):
                                       rng.normal(size=(k-1)*n))),
                                       rng.normal(size=n*(n-1)//2, scale=1/n))
     raise NotImplementedError
+
+def test_ExactEnumeration(rng=np.random.RandomState(0)):
+    from .models import ExactIsing, ExactPotts
+    from coniii.utils import xpotts_states, define_potts_helper_functions
+    
+    # compare with brute force calculation over all states
+    n = 5
+    hJ = rng.normal(size=n+n*(n-1)//2)
+    allStates = bin_states(n, True)
+    p = np.exp(-calc_e(allStates, hJ))
+    p /= p.sum()
+    sisj = np.concatenate((p.dot(allStates),
+                           [p.dot(allStates[:,i]*allStates[:,j])
+                            for i,j in combinations(range(n),2)]))
+    for chunk_size in [2**20, 4]:
+        ising = ExactIsing(n, chunk_size=chunk_size)
+        assert np.allclose(ising.p(hJ), p)
+        assert np.allclose(ising.calc_observables(hJ), sisj)
+    print("Test passed: Ising enumeration agrees with brute force.")
+    
+    pottsCalcE, pottsCalcObservables = define_potts_helper_functions(3)[:2]
+    allStates = np.vstack([np.array(s, dtype=int) for s in xpotts_states(n, 3)])
+    hJ = rng.normal(size=3*n+n*(n-1)//2)
+    w = np.exp(-pottsCalcE(allStates, hJ))
+    for chunk_size in [2**20, 9]:
+        potts = ExactPotts(n, chunk_size=chunk_size)
+        assert np.isclose(potts.logZ(hJ), np.log(w.sum()))
+        assert np.allclose(potts.p(hJ), w/w.sum())
+        assert np.allclose(potts.calc_observables(hJ), (w/w.sum()).dot(pottsCalcObservables(allStates)))
+    print("Test passed: Potts enumeration agrees with brute force.")
+
+def test_Magnetization_high_prec(n=5, rng=np.random.RandomState(0)):
+    hJ = np.concatenate((rng.normal(scale=.1, size=n), rng.normal(loc=1, scale=.1, size=n*(n-1)//2)))
+    isingdkl = Magnetization(n, h=hJ[:n], J=hJ[n:], n_cpus=1)
+    hpisingdkl = Magnetization(n, h=hJ[:n], J=hJ[n:], n_cpus=1, high_prec=True)
+    assert np.allclose(isingdkl.dJ, hpisingdkl.dJ)
+    
+    # finite difference with extended precision converges to float calculation without
+    # hitting a floor from round off error
+    hess = isingdkl._maj_curvature(dJ=hpisingdkl.dJ, iprint=False)
+    err = [np.abs(hpisingdkl._maj_curvature_high_prec(epsdJ=eps)-hess).max()/np.abs(hess).max()
+           for eps in [1e-5, 1e-7, 1e-9]]
+    assert err[0]>err[1]>err[2] and err[2]<1e-10, err
+    print("Test passed: high precision Hessian converges with decreasing step size.")
+
+def test_model_stats(n=5, rng=np.random.RandomState(0)):
+    hJ = rng.normal(scale=.1, size=n+n*(n-1)//2)
+    isingdkl = Magnetization(n, h=hJ[:n], J=hJ[n:], precompute=False)
+
+    E, logZ, logsumEk = isingdkl.model_stats()
+    assert np.allclose(np.exp(-E-logZ), isingdkl.p)
+    assert np.isclose(np.exp(logsumEk-logZ).sum(), 1)
+    assert isingdkl.model_stats()[0] is E
+    assert isingdkl.model_stats(hJ.copy())[0] is E
+    print("Test passed: model statistics are memoized on the parameter values.")
+
+    newhJ = hJ.copy()
+    newhJ[0] += .1
+    assert not np.array_equal(isingdkl.model_stats(newhJ)[0], E)
+    isingdkl.hJ = newhJ
+    assert isingdkl.model_stats()[0] is not E
+    assert len(pickle.loads(pickle.dumps(isingdkl._statsCache)))==0
+    print("Test passed: cache misses when parameters change and is not pickled.")
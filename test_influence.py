@@ -19,3 +19,25 @@ def test_pair_asymmetry(n=10, rng=np.random.RandomState(0), n_samples=100):
         a = pair_asymmetry(x[:,None],n)
         assert np.all((a>=0)&(a<=1)) and 0<=a.sum()<=1
     print("Test passed: asymmetry measure is properly normalized.")
+
+def test_shuffled_block_fim(n=6, rng=np.random.RandomState(0)):
+    A = rng.normal(size=(n*(n-1),n*(n-1)))
+    fim = A.dot(A.T)
+    
+    # compare with shuffling the full matrix using the same random streams
+    coarse = shuffled_block_fim(fim, n, 5, n_cpus=1, batch_size=2, seed=0)
+    coarsefull = []
+    for stream, n_samples in zip(np.random.SeedSequence(0).spawn(3), [2,2,1]):
+        streamrng = np.random.default_rng(stream)
+        for i in range(n_samples):
+            mixedfim = np.zeros_like(fim)
+            mixedfim[np.triu_indices_from(fim, k=1)] = streamrng.permutation(
+                    fim[np.triu_indices_from(fim, k=1)])
+            mixedfim += mixedfim.T
+            mixedfim[np.diag_indices_from(fim)] = streamrng.permutation(fim.diagonal())
+            coarsefull.append(block_mean(n, mixedfim))
+    assert np.isclose(coarse, coarsefull).all()
+    print("Test passed: block-reduced shuffle agrees with shuffling the full FIM.")
+
+    assert np.array_equal(coarse, shuffled_block_fim(fim, n, 5, n_cpus=2, batch_size=2, seed=0))
+    print("Test passed: shuffled samples do not depend on the number of cpus.")
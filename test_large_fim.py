@@ -39,6 +39,25 @@ def test_Mag3(n=5):
                  rng=rng)
     print("Test passed: Successfully precomputes.")
 
+def test_Mag3_observables_after_perturbation_batch(n=5):
+    # statistics of a random ternary sample such that the batch can be checked without
+    # sampling from the model
+    rng = np.random.RandomState(0)
+    X = rng.choice(3, size=(1000,n), p=[.5,.3,.2])
+    ix = np.triu_indices(n, k=1)
+    model = Mag3.__new__(Mag3)
+    model.n, model.kStates, model.eps = n, 3, 1e-4
+    model.sisj = np.concatenate([(X==k).mean(0) for k in range(3)] +
+                                [(X[:,ix[0]]==X[:,ix[1]]).mean(0)])
+
+    C = model.observables_after_perturbation_batch()
+    assert C.shape==(3*n, model.sisj.size)
+    for ix, c in enumerate(C):
+        i, k = divmod(ix, 3)
+        assert not np.array_equal(c, model.sisj)
+        assert np.allclose(c, model.observables_after_perturbation(i, k), rtol=1e-12, atol=1e-15)
+    print("Test passed: batched perturbations agree with one at a time for Mag3.")
+
 def test_Coupling3(n=5, disp=True, time=False):
     """Tests for Coupling3.
     
@@ -11,6 +11,20 @@ def test_corr():
         assert np.isclose(pair_corr(bin_states(n,True), weights=create_mvm_p(n, 1))[1][0],
                           corr(n)[0])
 
+def test_create_mvm_p(n=7):
+    q = np.array([0, .2, 1])
+    p = create_mvm_p(n, q)
+    assert np.allclose(p.sum(1), 1)
+    assert np.allclose(p[0], 2.**-n)
+    for q_, p_ in zip(q, p):
+        assert np.array_equal(p_, create_mvm_p(n, q_))
+
+    # Median is never in the minority when q=1
+    allStates = bin_states(n, True)
+    ordinarySum = allStates[:,1:].sum(1)
+    assert (p[2][(ordinarySum!=0) & (allStates[:,0]!=np.sign(ordinarySum))]==0).all()
+    print("Test passed: MVM distribution is normalized for a batch of q.")
+
 def test_couplings():
     np.random.seed(0)
     J = np.random.normal(size=4, scale=.5)
@@ -63,6 +77,50 @@ def test_setup_maxent():
         assert np.isclose( pkME, pk(Jmo, Jmop, Joo, Jop) ).all()
     print("Test passed: Pairwise correlations agree with ConIII module.")
 
+def test_setup_maxent_evaluator():
+    from .models import ExactIsing
+    np.random.seed(0)
+    Jmo, Jmop, Joo, Jop = np.random.normal(size=4, scale=.3)
+
+    for n in [5,7,9]:
+        hJ = np.zeros(n+n*(n-1)//2)
+        hJ[n:2*n-1] = Jmo
+        hJ[n] = Jmop
+        hJ[2*n-1:] = Joo
+        hJ[2*n-1:2*n-1+n-2] = Jop
+        ising = ExactIsing(n)
+        sisjME = ising.calc_observables(hJ)
+        
+        evaluate = setup_maxent_evaluator(n)
+        logZ, sisj, pk = evaluate(Jmo, Jmop, Joo, Jop)
+        # terms only count one of each pair of states related by a global flip
+        assert np.isclose(logZ + np.log(2), ising.logZ(hJ))
+        assert np.allclose(sisj, sisjME[[n+1, n, -1, 2*n-1]])
+        assert np.isclose(pk.sum(), 1)
+        # repeated evaluation is memoized
+        assert evaluate(Jmo, Jmop, Joo, Jop)[1] is sisj
+    print("Test passed: fused evaluator agrees with exact enumeration.")
+
+def test_newton_solve(n=9):
+    rng = np.random.RandomState(0)
+    evaluate = setup_maxent_evaluator(n)
+    J = rng.normal(scale=.2, size=(5,4))
+    sisj = np.array([evaluate(*J_)[1] for J_ in J])
+
+    # many targets at once
+    Jsoln, soln = couplings(n, sisj, full_output=True, tol=1e-15)
+    assert soln['success'].all() and soln['nit']<30
+    assert np.abs(soln['fun']).max()<=1e-15
+    assert np.allclose(Jsoln, J)
+    print("Test passed: Newton solver recovers couplings from correlations.")
+    
+    # one perturbation solution agrees with finite differences of the solution
+    Jpair = couplings(n)
+    J0 = [Jpair[0],Jpair[0],Jpair[1],Jpair[1]]
+    dJ = solve_mo_perturbation(n, J0, eps=1e-6)
+    assert np.allclose(dJ, solve_mo_perturbation(n, J0, eps=1e-5), rtol=1e-4)
+    print("Test passed: M->O perturbation derivative is stable.")
+
 def test_setup_mo_perturbation():
     logPartitionList, sMOpcoeffs, sMOcoeffs, sOOpcoeffs, sOOcoeffs = setup_mo_perturbation(5, 0, 0, 0, 0)
 
@@ -162,3 +220,24 @@ def test_setup_perturbation(n=9):
 
         assert np.linalg.norm(sisj-sisjME)<1e-13
     print("Test passed: pairwise correlations are numerically in agreement with ConIII calculation.")
+
+    # many couplings at once
+    Js = rng.normal(size=(5,12))
+    logPartitionList = setup_perturbation(Js, n)[0]
+    for J, logPartitionList_ in zip(Js, logPartitionList):
+        assert np.allclose(logPartitionList_, setup_perturbation(J, n)[0])
+    print("Test passed: batch of couplings agrees with one at a time.")
+
+def test_fim_sweep():
+    nRange = [7,9]
+    q = np.array([.5, 1.])
+    smallfim, eigval, pk = fim_sweep(nRange, q=q, n_cpus=1)
+    assert smallfim.shape==(2,2,3,3) and eigval.shape==(2,2,2)
+    
+    for i, n in enumerate(nRange):
+        for j, q_ in enumerate(q):
+            smallfim_, eigval_, eigvec_, pk_ = fim(n, q=q_)
+            assert np.allclose(smallfim[i,j], smallfim_, rtol=1e-5)
+            assert np.allclose(eigval[i,j], eigval_, rtol=1e-5)
+            assert np.allclose(pk[i][j], pk_)
+    print("Test passed: sweep agrees with FIM for each n and q.")
@@ -0,0 +1,150 @@
+# ============================================================================================ #
+# Test module for organizer.py
+# Author : Eddie Lee, edlee@santafe.edu
+# ============================================================================================ #
+from .organizer import *
+from .organizer import Catalog, FIM, checksum
+from tempfile import mkdtemp
+
+
+
+def test_Catalog(rng=np.random.RandomState(0)):
+    dr = mkdtemp()
+    indata = {'X':rng.randint(3, size=(100,5)),
+              'hJ':rng.normal(size=25),
+              'n':5,
+              'name':'test',
+              'model':{'a':1}}
+    pickle.dump(indata, open(f'{dr}/a.p', 'wb'))
+    cat = Catalog(dr)
+
+    # arrays are extracted into .npy files and round trip exactly
+    assert sorted(cat.keys('a.p'))==sorted(indata.keys())
+    assert cat.shape('a.p', 'X')==(100,5)
+    for key in ('X', 'hJ'):
+        assert os.path.isfile(f'{dr}/{cat.ARRAY_DR}/a.{key}.npy')
+        X = cat.load('a.p', key)
+        assert isinstance(X, np.memmap) and not X.flags.writeable
+        assert np.array_equal(X, indata[key]) and X.dtype==indata[key].dtype
+        assert np.array_equal(cat.load('a.p', key, mmap=False), indata[key])
+    assert cat.load('a.p', 'n')==5 and cat.load('a.p', 'name')=='test'
+    assert cat.load('a.p', 'model')=={'a':1}
+    assert cat.checksum('a.p')==checksum(f'{dr}/a.p')
+    print("Test passed: arrays round trip through .npy files.")
+
+    # unchanged file is not reindexed, including by a new instance reading the saved index
+    calls = []
+    def index_file(fname, stat, cat=cat):
+        calls.append(fname)
+        return Catalog._index_file(cat, fname, stat)
+    cat._index_file = index_file
+    cat.entry('a.p')
+    cat2 = Catalog(dr)
+    cat2._index_file = index_file
+    cat2.entry('a.p')
+    assert calls==[]
+
+    # reindexed when size changes
+    indata['hJ'] = rng.normal(size=30)
+    pickle.dump(indata, open(f'{dr}/a.p', 'wb'))
+    assert cat.shape('a.p', 'hJ')==(30,) and calls==['a.p']
+    assert np.array_equal(cat.load('a.p', 'hJ'), indata['hJ'])
+
+    # reindexed when only mtime changes
+    stat = os.stat(f'{dr}/a.p')
+    indata['hJ'] = rng.normal(size=30)
+    pickle.dump(indata, open(f'{dr}/a.p', 'wb'))
+    os.utime(f'{dr}/a.p', ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+    assert os.path.getsize(f'{dr}/a.p')==stat.st_size
+    assert np.array_equal(cat.load('a.p', 'hJ'), indata['hJ']) and calls==['a.p']*2
+    assert cat.checksum('a.p')==checksum(f'{dr}/a.p')
+    print("Test passed: files are reindexed only when size or mtime change.")
+
+    # entries from separate instances, as in separate processes, are merged into the index
+    pickle.dump({'fim':np.eye(3)}, open(f'{dr}/b.p', 'wb'))
+    cat2.entry('b.p')
+    assert sorted(pickle.load(open(f'{dr}/{cat.INDEX_F}', 'rb')).keys())==['a.p', 'b.p']
+    assert sorted(Catalog(dr).index.keys())==['a.p', 'b.p']
+    print("Test passed: index entries from separate instances are merged.")
+
+def test_MESolution_X(rng=np.random.RandomState(0)):
+    dr = mkdtemp()
+    X = rng.randint(3, size=(100,5))
+    pickle.dump({'X':X, 'hJ':rng.normal(size=25), 'neuronix':np.arange(5)},
+                open(f'{dr}/test_solnA0a.p', 'wb'))
+
+    class Solution(MESolution):
+        DEFAULT_DR = dr
+    soln = Solution('test', 0, iprint=False)
+    assert soln.n==5
+    assert isinstance(soln.X(), np.memmap) and not soln.X().flags.writeable
+    assert np.array_equal(soln.X(), X)
+    print("Test passed: X() returns a read-only memory map of the sample.")
+
+def test_FIM_sample_subset_eigval(n=8, k=3, rng=np.random.RandomState(0)):
+    A = rng.normal(size=(n*k,n*k))
+    fim = FIM(n, A.dot(A.T))
+
+    for nComp, nSample in [(2, 5), (3, 50), (n, 1)]:
+        # both the rejection sampling and enumeration branches give distinct sorted subsets
+        subsets = fim._unique_subsets(nComp, nSample, np.random.default_rng(0))
+        assert subsets.shape==(nSample, nComp)
+        assert (np.diff(subsets, axis=1)>0).all()
+        assert len(set(map(tuple, subsets)))==nSample
+    print("Test passed: subsets are unique.")
+
+    for method in ['power', 'eigvalsh']:
+        topval = fim._sample_subset_eigval(3, 20, rng=np.random.default_rng(1), method=method,
+                                           max_elements=5*(3*k)**2)
+        subsets = fim._unique_subsets(3, 20, np.random.default_rng(1))
+        for s, val in zip(subsets, topval):
+            ix = (s[:,None]*k + np.arange(k)[None,:]).ravel()
+            assert np.isclose(val, np.linalg.eigh(fim.fim[ix][:,ix])[0][-1], rtol=1e-6)
+    print("Test passed: top eigenvalue of subsets agrees with eigh.")
+
+def test_MESolution_eig(rng=np.random.RandomState(0)):
+    dr = mkdtemp()
+    pickle.dump({'X':rng.randint(3, size=(100,5)), 'hJ':rng.normal(size=25)},
+                open(f'{dr}/test_solnA0a.p', 'wb'))
+    A = rng.normal(size=(20,20))
+    pickle.dump({'fim':A.dot(A.T)}, open(f'{dr}/test_fimA0ai.p', 'wb'))
+    mtime = os.stat(f'{dr}/test_fimA0ai.p').st_mtime_ns
+    val, vec = sorted_eigh(A.dot(A.T))
+
+    class Solution(MESolution):
+        DEFAULT_DR = dr
+    soln = Solution('test', 0, iprint=False)
+    
+    # sidecar is keyed by checksum and number of modes
+    val3, vec3 = soln.eig(top_k=3)
+    prefix = f"{dr}/{soln.EIG_DR}/test_fimA0ai.{checksum(f'{dr}/test_fimA0ai.p')[:16]}"
+    assert sorted(os.listdir(f'{dr}/{soln.EIG_DR}'))==[f'{os.path.basename(prefix)}.k3.{s}.npy'
+                                                        for s in ('eigval', 'eigvec')]
+    assert np.allclose(np.load(f'{prefix}.k3.eigval.npy'), val[:3])
+    assert np.allclose(val3, val[:3]) and np.allclose(np.abs(vec3.T.dot(vec[:,:3])), np.eye(3))
+    print("Test passed: sidecar is keyed by checksum and top_k.")
+
+    # fewer modes are read from the existing sidecar and more are calculated
+    val2, vec2 = soln.eig(top_k=2)
+    assert isinstance(val2, np.memmap) and np.array_equal(val2, val3[:2])
+    assert np.array_equal(vec2, vec3[:,:2]) and len(os.listdir(f'{dr}/{soln.EIG_DR}'))==2
+    val5, vec5 = soln.eig(top_k=5)
+    assert not isinstance(val5, np.memmap) and os.path.isfile(f'{prefix}.k5.eigval.npy')
+    assert np.allclose(val5, val[:5])
+    assert np.array_equal(soln.eig(top_k=4)[0], np.load(f'{prefix}.k5.eigval.npy')[:4])
+    valAll, vecAll = soln.eig()
+    assert os.path.isfile(f'{prefix}.kall.eigval.npy') and np.allclose(valAll, val)
+    assert isinstance(soln.eig()[0], np.memmap)
+    print("Test passed: partial top-k results are reused or recalculated.")
+
+    # FIM pickle is never rewritten
+    assert isinstance(soln.fim(), np.memmap) and np.array_equal(soln.fim(), A.dot(A.T))
+    assert os.stat(f'{dr}/test_fimA0ai.p').st_mtime_ns==mtime
+    print("Test passed: FIM pickle is not modified.")
+    
+    # a changed FIM has a different checksum and does not use the old sidecars
+    B = rng.normal(size=(20,20))
+    pickle.dump({'fim':B.dot(B.T)}, open(f'{dr}/test_fimA0ai.p', 'wb'))
+    assert np.allclose(soln.eig(top_k=2)[0], sorted_eigh(B.dot(B.T))[0][:2])
+    assert len(os.listdir(f'{dr}/{soln.EIG_DR}'))==8
+    print("Test passed: sidecar is invalidated when the FIM changes.")
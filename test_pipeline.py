@@ -0,0 +1,188 @@
+# ============================================================================================ #
+# Test module for pipeline.py
+# Author : Eddie Lee, edlee@santafe.edu
+# ============================================================================================ #
+from .pipeline import *
+from . import pipeline
+from tempfile import mkdtemp
+
+
+
+def test_cached_solve_inverse(n=5, rng=np.random.RandomState(0)):
+    calls = []
+    def solve_inverse(X, name='', potts=False, force_krylov=False, initial_guess=None):
+        calls.append(initial_guess)
+        hJ = sufficient_stats(X)
+        return hJ, {'success':not X[0,0]==X[0,1]==X[0,2], 'fun':np.zeros(hJ.size)}
+
+    dr = mkdtemp()
+    X = rng.choice([-1,1], size=(1000,n))
+    X[0,:3] = [1,-1,1]
+    solve_inverse_ = pipeline.solve_inverse
+    pipeline.solve_inverse = solve_inverse
+    try:
+        # cache hit skips the solver even when the samples are reordered
+        hJ, soln = cached_solve_inverse(X, cache_dr=dr)
+        assert len(calls)==1 and calls[0] is None
+        hJ2, soln2 = cached_solve_inverse(X[rng.permutation(len(X))], cache_dr=dr)
+        assert len(calls)==1
+        assert np.array_equal(hJ, hJ2) and soln2['success']
+        assert len(ResultStore(dr).keys())==1
+        print("Test passed: key does not depend on sample order and hits skip the solver.")
+
+        # similar data is warm started from the cached solution but dissimilar data is not
+        Xp = X.copy()
+        Xp[1] *= -1
+        hJp, _ = cached_solve_inverse(Xp, cache_dr=dr, warm_start_tol=1e-2)
+        assert np.array_equal(calls[-1], hJ)
+        assert 0<np.abs(sufficient_stats(Xp) - sufficient_stats(X)).max()<1e-2
+        cached_solve_inverse(Xp[:-1], cache_dr=dr, warm_start_tol=1e-5)
+        assert calls[-1] is None
+        print("Test passed: warm start only from solutions within tolerance.")
+
+        # failed solves are not stored and are retried
+        Xf = X.copy()
+        Xf[0,:3] = 1
+        nKeys = len(ResultStore(dr).keys())
+        assert not cached_solve_inverse(Xf, cache_dr=dr)[1]['success']
+        assert len(ResultStore(dr).keys())==nKeys
+        cached_solve_inverse(Xf, cache_dr=dr)
+        assert len(calls)==5
+        print("Test passed: failed solves are not stored.")
+    finally:
+        pipeline.solve_inverse = solve_inverse_
+
+def test_ResultStore(rng=np.random.RandomState(0)):
+    dr = mkdtemp()
+    store = ResultStore(dr)
+    records = {k:{'a':rng.normal(size=(3,3)), 'b':k, 'c':{'k':k}} for k in ['x', ('y',1)]}
+    for k, rec in records.items():
+        store.save(k, rec)
+    size = os.path.getsize(f'{dr}/{store.INDEX_F}')
+
+    # torn tail from an interrupted write is ignored and truncated
+    with open(f'{dr}/{store.INDEX_F}', 'ab') as f:
+        f.write(dill.dumps(('z', {'b':('value', 0)}), -1)[:-3])
+    store = ResultStore(dr)
+    assert sorted(map(repr, store.keys()))==sorted(map(repr, records.keys()))
+    assert os.path.getsize(f'{dr}/{store.INDEX_F}')==size
+    store.save('z', {'b':0})
+    assert 'z' in ResultStore(dr) and len(ResultStore(dr).keys())==3
+    print("Test passed: torn journal tail is ignored and truncated.")
+
+    # completed keys are found by a restarted store and records round trip
+    store = ResultStore(dr)
+    for k, rec in records.items():
+        assert k in store
+        loaded = store.load(k)
+        assert isinstance(loaded['a'], np.memmap) and np.array_equal(loaded['a'], rec['a'])
+        assert loaded['b']==rec['b'] and loaded['c']==rec['c']
+
+    # only the requested files are read
+    os.remove(f"{dr}/{store.index['x']['c'][1]}")
+    assert np.array_equal(store.load('x', ['a', 'b'])['a'], records['x']['a'])
+    assert sorted(store.load('x', ['b']).keys())==['b']
+    print("Test passed: completed keys are found on restart and load only reads names.")
+
+def test_calculate_fisher_on_pk_resume(n=3):
+    class Ising():
+        def __init__(self, n):
+            self.n = n
+        def hess_eig(self, hess):
+            return np.linalg.eigh(hess)
+
+    computed = []
+    def fisher_model(n, hJ, fi_method, **kwargs):
+        return Ising(n)
+    def fisher_hessian(isingdkl, fi_method):
+        computed.append(isingdkl)
+        return np.eye(n)*len(computed), None, 0.
+
+    data = {k:[list(range(n)), None, np.zeros(n), {'fun':np.zeros(n)}] for k in 'abc'}
+    cwd = os.getcwd()
+    fisher_model_, fisher_hessian_ = pipeline.fisher_model, pipeline.fisher_hessian
+    pipeline.fisher_model, pipeline.fisher_hessian = fisher_model, fisher_hessian
+    os.chdir(mkdtemp())
+    try:
+        calculate_fisher_on_pk({k:data[k] for k in 'ab'})
+        assert len(computed)==2
+        result = calculate_fisher_on_pk(data)
+        assert len(computed)==3
+        
+        # stored results are memory mapped and isingdkl is only deserialized when needed
+        assert isinstance(result['a'], LazyFisherResult) and not result['a']._loaded
+        assert isinstance(result['a'][1][0], np.memmap) and not result['a']._loaded
+        assert np.array_equal(result['b'][1][0], np.eye(n)*2)
+        assert result['a'][0].n==n and result['a']._loaded
+        isingdkl, (hess, errflag, err), eigval, eigvec = result['b']
+        assert isingdkl.n==n and np.array_equal(eigval, [2,2,2])
+        assert result['c'][0] is computed[-1]
+        print("Test passed: finished keys are loaded lazily instead of recomputed.")
+
+        from warnings import catch_warnings, simplefilter
+        with catch_warnings(record=True) as w:
+            simplefilter('always')
+            calculate_fisher_on_pk(data, high_prec_dps=30)
+        assert len(computed)==3 and w[0].category is DeprecationWarning
+        print("Test passed: high_prec_dps is deprecated.")
+    finally:
+        os.chdir(cwd)
+        pipeline.fisher_model, pipeline.fisher_hessian = fisher_model_, fisher_hessian_
+
+def test_BatchRunner(n=3, rng=np.random.RandomState(0)):
+    from functools import partial
+    class Model():
+        def __init__(self, n):
+            self.n = n
+
+    def stage_f(stage, k, fail, *inputs):
+        if (stage, k)==fail:
+            raise ValueError("Stub failure.")
+        if stage=='solve':
+            return np.ones(n), {'success':True}
+        if stage=='dJ':
+            return Model(n)
+        if stage=='hessian':
+            return np.eye(n), None, 0.
+        if stage=='eigen':
+            return np.linalg.eigh(inputs[1][0])
+        return {'eigval':inputs[2][:1], 'n':inputs[0].n}
+
+    class Runner(BatchRunner):
+        # stub stages that log the order in which their outputs are stored
+        def __init__(self, *args, fail=None, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.fail = fail
+            self.log = []
+        def _task(self, k, stage, inputs):
+            return partial(stage_f, stage, k, self.fail), inputs
+        def _store(self, k, stage, inputs, output):
+            self.log.append((k, stage))
+            return super()._store(k, stage, inputs, output)
+
+    dr = mkdtemp()
+    data = {k:[list(range(n)), rng.choice([-1,1], size=(10,n))] for k in 'abc'}
+    runner = Runner(data, dr, n_cpus=2, fail=('hessian', 'b'))
+    try:
+        runner.run(iprint=False)
+        raise Exception("RuntimeError was not raised.")
+    except RuntimeError as e:
+        assert 'b (hessian)' in str(e)
+    assert list(runner.failures)==['b'] and runner.failures['b'][0]=='hessian'
+    for k in 'ac':
+        assert [s for k_, s in runner.log if k_==k]==list(BatchRunner.STAGES)
+        assert sorted(runner.timings[k])==sorted(BatchRunner.STAGES)
+    assert [s for k_, s in runner.log if k_=='b']==['solve', 'dJ']
+    assert all(dt>=0 for t in runner.timings.values() for dt in t.values())
+    assert sorted(runner.stage_timings())==sorted(BatchRunner.STAGES)
+    print("Test passed: stages run in order and a failing stage raises RuntimeError.")
+
+    # restart resumes from the last stored stage and skips finished keys
+    runner = Runner(data, dr, n_cpus=2)
+    summaries = runner.run(iprint=False)
+    assert runner.log==[('b', 'hessian'), ('b', 'eigen'), ('b', 'summaries')]
+    assert sorted(runner.timings)==['b'] and not runner.failures
+    assert sorted(summaries)==list('abc')
+    for k in 'abc':
+        assert summaries[k]['n']==n and np.isclose(summaries[k]['eigval'][0], 1)
+    print("Test passed: restarted run resumes from stored stages.")
@@ -0,0 +1,22 @@
+# ============================================================================================ #
+# Test module for spectral.py
+# Author : Eddie Lee, edlee@santafe.edu
+# ============================================================================================ #
+from .spectral import *
+
+
+
+def test_top_eigval(rng=np.random.RandomState(0)):
+    # stack of positive semidefinite matrices of varying conditioning such that power
+    # iteration converges after different numbers of iterations
+    A = rng.normal(size=(20,30,30))
+    X = np.einsum('bij,bkj->bik', A, A)
+    X[::3] += np.diag(np.arange(30.))*10
+    val = np.linalg.eigh(X)[0][:,-1]
+
+    assert np.allclose(top_eigval(X, method='eigvalsh'), val)
+    assert np.allclose(top_eigval(X, method='power', tol=1e-14, max_iter=100_000), val,
+                       rtol=1e-6)
+    assert np.allclose(top_eigval(X[:1], method='power', tol=1e-14, max_iter=100_000),
+                       val[:1], rtol=1e-6)
+    print("Test passed: batched top eigenvalue agrees with eigh.")
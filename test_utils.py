@@ -65,3 +65,83 @@ def test_remove_principal_mode():
     #print(v)
     assert np.isclose(elnew, el).all(), (elnew, el)
     assert np.isclose(np.abs(vnew.T.dot(v)),np.eye(3)).all(), (vnew, v)
+
+def test_block_reduce_fim(n=7, rng=np.random.RandomState(0)):
+    from tempfile import TemporaryDirectory
+    k = n-1
+    A = rng.normal(size=(n*k,n*k))
+    fim = A.dot(A.T)
+
+    # compare with block by block coarse graining
+    coarsefim = np.zeros((n,n))
+    for i in range(n):
+        for j in range(i, n):
+            coarsefim[i,j] = coarsefim[j,i] = fim[i*k:(i+1)*k,j*k:(j+1)*k].mean()
+    assert np.allclose(block_mean_fim(n, fim), coarsefim)
+    assert np.allclose(block_sum_fim(n, fim, tile_size=2), coarsefim*k*k)
+    coarsefim = np.zeros((n,n))
+    for i in range(n):
+        for j in range(i, n):
+            coarsefim[i,j] = coarsefim[j,i] = fim[i*k:(i+1)*k,j*k:(j+1)*k].max()
+    assert np.allclose(block_reduce_fim(n, fim, np.max, tile_size=3), coarsefim)
+    coarsefim = block_mean_fim(n, fim)
+    print("Test passed: block reduction agrees with block by block coarse graining.")
+
+    # packed and memmapped storage
+    assert np.allclose(block_mean_fim(n, fim[np.triu_indices(n*k)], packed=True, tile_size=2),
+                       coarsefim)
+    with TemporaryDirectory() as dr:
+        np.save('%s/fim.npy'%dr, fim)
+        assert np.allclose(block_mean_fim(n, np.load('%s/fim.npy'%dr, mmap_mode='r'), tile_size=2),
+                           coarsefim)
+    print("Test passed: packed and memmapped FIMs are coarse grained in tiles.")
+
+def test_parity_corr(n=6, rng=np.random.RandomState(0)):
+    p = rng.rand(2**n)
+    p /= p.sum()
+    allStates = bin_states(n, True)
+    X = rng.choice([-1,1], size=(100,n))
+    
+    parity = parity_corr(p)
+    Xparity = sample_parity_corr(X)
+    for k in range(1, n+1):
+        assert np.isclose(parity[parity_index(n,k)], k_corr(allStates, k, weights=p)).all()
+        assert np.isclose(Xparity[parity_index(n,k)], k_corr(X, k)).all()
+    print("Test passed: Walsh-Hadamard correlations agree with k_corr.")
+
+def test_extended_precision(rng=np.random.RandomState(0)):
+    from fractions import Fraction
+    from math import factorial
+
+    # sums with heavy cancellation compared with exact rational arithmetic
+    x = rng.normal(size=1000) * 10.**rng.randint(-8, 8, size=1000)
+    x = np.concatenate((x, -x[:500]*(1+1e-12)))
+    exact = float(sum(map(Fraction, x)))
+    assert dd_sum(x)==exact
+    assert np.allclose(dd_sum(x.reshape(5,-1), axis=1), x.reshape(5,-1).sum(1))
+    print("Test passed: double-double sum is correctly rounded.")
+    
+    # Hilbert matrix is notoriously ill conditioned
+    n = 10
+    A = 1/(np.arange(n)[:,None] + np.arange(n)[None,:] + 1.)
+    x = rng.normal(size=n)
+    b = A.dot(x)
+    r = np.array([float(Fraction(b_) - sum(Fraction(a)*Fraction(x_) for a,x_ in zip(row,x)))
+                  for row,b_ in zip(A,b)])
+    assert np.allclose(dd_residual(A, x, b), r, rtol=1e-12, atol=0)
+    xsolve = refined_solve(A, b)
+    assert np.abs(dd_residual(A, xsolve, b)).max() < np.abs(dd_residual(A, np.linalg.solve(A,b), b)).max()
+    print("Test passed: iterative refinement reduces the residual.")
+
+    x = np.array([-.5, -1e-3, 1e-9, 1e-3, .0999, .1, 2.])
+    exact = np.array([float(sum(Fraction(x_)**k/factorial(k) for k in range(2, 30)))
+                      for x_ in x])
+    assert np.allclose(expm1mx(x), exact, rtol=1e-14, atol=0)
+    print("Test passed: expm1mx is accurate for small arguments.")
+
+    x = rng.normal(size=1000) * 10.**rng.randint(-8, 8, size=1000)
+    invix = rng.randint(6, size=1000)
+    invix[invix==2] = 3
+    segsum = segment_dd_sum(x, invix, 7)
+    assert np.array_equal(segsum, [dd_sum(x[invix==i]) for i in range(7)])
+    print("Test passed: segmented double-double sums agree with summing each segment.")
@@ -5,7 +5,6 @@
 import numpy as np
 from numba import njit
 from coniii.utils import *
-import importlib
 from warnings import warn
 from itertools import combinations, product
 import os
@@ -92,14 +91,32 @@ def perturb_3_spin(p, k,
     
     return newp
 
-def block_mean_fim(n, fim):
-    """Coarse grain FIM by taking averages of blocks that correspond to perturbations
-    focused on particular receiver and target pairs.
+def block_reduce_fim(n, fim,
+                     reducer='mean',
+                     packed=False,
+                     tile_size=None):
+    """Coarse grain FIM by reducing each block that corresponds to perturbations focused
+    on particular receiver and target pairs.
+
+    Rows are read in tiles of whole block rows and each tile of shape (b*k, P) is viewed
+    as (b, k, n, k) such that blocks are reduced over the inner axes. Only the tile is
+    ever loaded into memory, so fim can be a np.memmap (e.g. from np.load with
+    mmap_mode='r') that does not fit into RAM. As with the original block averaging,
+    only blocks on and above the diagonal are used and the result is symmetrized.
     
     Parameters
     ----------
     n : int
     fim : ndarray
+        Either P x P matrix or, if packed, upper triangle including the diagonal
+        flattened row by row, i.e. fim[np.triu_indices(P)].
+    reducer : str or function, 'mean'
+        'mean', 'sum', or function with signature f(x, axis) like np.max that reduces
+        a (b, k, n, k) array over axis=(1,3).
+    packed : bool, False
+    tile_size : int, None
+        Number of block rows per tile. By default, chosen such that a tile has about
+        2**22 elements.
     
     Returns
     -------
@@ -107,20 +124,58 @@ def block_mean_fim(n, fim):
         Coarse-grained FIM.
     """
     
-    assert n==(fim.shape[0]/(n-1))
+    k = n-1
+    P = n*k
+    if packed:
+        assert fim.ndim==1 and fim.size==P*(P+1)//2
+    else:
+        assert n==(fim.shape[0]/(n-1)) and fim.shape==(P,P)
+    if reducer=='mean':
+        reducer = np.mean
+    elif reducer=='sum':
+        reducer = np.sum
+    assert callable(reducer)
+    tile_size = tile_size or max(1, 2**22//(k*P))
+    
     coarsefim = np.zeros((n,n))
+    for i in range(0, n, tile_size):
+        b = min(tile_size, n-i)
+        if packed:
+            # unpack rows from the upper triangle (lower blocks are discarded below)
+            tile = np.zeros((b*k,P))
+            for r in range(i*k, (i+b)*k):
+                offset = r*P - r*(r-1)//2
+                tile[r-i*k,r:] = fim[offset:offset+P-r]
+            # fill in lower triangle of the diagonal blocks
+            for j in range(b):
+                block = tile[j*k:(j+1)*k,(i+j)*k:(i+j+1)*k]
+                block += np.triu(block, 1).T
+        else:
+            tile = np.asarray(fim[i*k:(i+b)*k])
+        coarsefim[i:i+b] = reducer(tile.reshape(b, k, n, k), axis=(1,3))
     
-    # coarse-grain diagonal
-    for i in range(n):
-        coarsefim[i,i] = fim[i*(n-1):(i+1)*(n-1),i*(n-1):(i+1)*(n-1)].mean()
-    # coarse grain off-diagonal elements
-    for i in range(n-1):
-        for j in range(i+1, n):
-            coarsefim[i,j] = coarsefim[j,i] = fim[i*(n-1):(i+1)*(n-1),j*(n-1):(j+1)*(n-1)].mean()
-            
-    return coarsefim
+    return np.triu(coarsefim) + np.triu(coarsefim, 1).T
 
-def block_sum_fim(n, fim):
+def block_mean_fim(n, fim, **kwargs):
+    """Coarse grain FIM by taking averages of blocks that correspond to perturbations
+    focused on particular receiver and target pairs.
+    
+    Parameters
+    ----------
+    n : int
+    fim : ndarray
+    **kwargs
+        Passed to block_reduce_fim.
+    
+    Returns
+    -------
+    ndarray
+        Coarse-grained FIM.
+    """
+    
+    return block_reduce_fim(n, fim, 'mean', **kwargs)
+
+def block_sum_fim(n, fim, **kwargs):
     """Coarse grain FIM by taking sums of blocks that correspond to perturbations focused
     on particular receiver and target pairs.
     
@@ -128,6 +183,8 @@ def block_sum_fim(n, fim):
     ----------
     n : int
     fim : ndarray
+    **kwargs
+        Passed to block_reduce_fim.
     
     Returns
     -------
@@ -135,18 +192,7 @@ def block_sum_fim(n, fim):
         Coarse-grained FIM.
     """
     
-    assert n==(fim.shape[0]/(n-1))
-    coarsefim = np.zeros((n,n))
-    
-    # coarse-grain diagonal
-    for i in range(n):
-        coarsefim[i,i] = fim[i*(n-1):(i+1)*(n-1),i*(n-1):(i+1)*(n-1)].sum()
-    # coarse grain off-diagonal elements
-    for i in range(n-1):
-        for j in range(i+1, n):
-            coarsefim[i,j] = coarsefim[j,i] = fim[i*(n-1):(i+1)*(n-1),j*(n-1):(j+1)*(n-1)].sum()
-            
-    return coarsefim
+    return block_reduce_fim(n, fim, 'sum', **kwargs)
 
 def missing_fim_files(dr, mnix, mxix):
     """Display names of files missing in the sequence.
@@ -487,9 +533,11 @@ def refine_maxent_solution(n, sisj, J0,
         Error history.
     """
     
+    from .models import ExactIsing
+
     assert sisj.size==J0.size
     hJ = np.concatenate((np.zeros(n), J0))
-    ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%n)
+    ising = ExactIsing(n)
     
     counter = 0
     errHistory = [1]
@@ -577,7 +625,7 @@ def multi_info(X, hJ, method, n_boot=10_000, disp=True, **Spoly_kwargs):
     """
 
     from entropy.estimators import S_poly
-    import importlib
+    from .models import ExactIsing, ExactPotts
     
     # estimate the data entropy (enforcing symmetrization of prob)
     Sdata, fit, err = S_poly(np.unique(X, axis=0, return_counts=True)[1],
@@ -587,9 +635,9 @@ def multi_info(X, hJ, method, n_boot=10_000, disp=True, **Spoly_kwargs):
     
     # measure pairwise model entropy
     if not '4' in method:
-        ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_sym'%X.shape[1])
+        ising = ExactIsing(X.shape[1])
     else:
-        ising = importlib.import_module('coniii.ising_eqn.ising_eqn_%d_potts'%X.shape[1])
+        ising = ExactPotts(X.shape[1])
     p = ising.p(hJ)
     
     Spair = -p.dot(np.log2(p))
@@ -601,6 +649,11 @@ def multi_info(X, hJ, method, n_boot=10_000, disp=True, **Spoly_kwargs):
 
 def check_correlations(X, p, orders, allStates=None):
     """Check how well correlations are fit by model probability distribution.
+
+    By default, correlations of all orders are computed at once with a Walsh-Hadamard
+    transform of the model distribution and of the empirical distribution of the data, and
+    each order is a slice of the transformed vectors. If allStates is given, correlations
+    are computed order by order with k_corr instead.
     
     Parameters
     ----------
@@ -611,6 +664,7 @@ def check_correlations(X, p, orders, allStates=None):
     orders : list
         Correlation functions of orders to check.
     allStates : ndarray, None
+        States corresponding to p. If None, the ordering of bin_states(n, sym=True).
     
     Returns
     -------
@@ -620,13 +674,18 @@ def check_correlations(X, p, orders, allStates=None):
         Correlation coefficient.
     """
     
-    from coniii import bin_states
-
-    if allStates is None:
-        allStates = bin_states(X.shape[1], sym=True)
-
     errs = np.zeros(len(orders))
     corr = np.zeros(len(orders))
+    
+    if allStates is None:
+        n = X.shape[1]
+        Xparity = sample_parity_corr(X)
+        modelparity = parity_corr(p)
+        for i,k in enumerate(orders):
+            ix = parity_index(n, k)
+            errs[i] = np.linalg.norm(Xparity[ix]-modelparity[ix])
+            corr[i] = np.corrcoef(Xparity[ix], modelparity[ix])[0,1]
+        return errs, corr
 
     for i,k in enumerate(orders):
         Xcorr = k_corr(X, k)
@@ -634,6 +693,362 @@ def check_correlations(X, p, orders, allStates=None):
         errs[i] = np.linalg.norm(Xcorr-modelcorr)
         corr[i] = np.corrcoef(Xcorr, modelcorr)[0,1]
     return errs, corr
+
+def fwht(x):
+    """Unnormalized fast Walsh-Hadamard transform along the last axis in O(n * 2^n).
+    
+    Entry m of the result is sum_i x[i] * (-1)^popcount(i & m).
+
+    Parameters
+    ----------
+    x : ndarray
+        Last axis has length 2^n.
+
+    Returns
+    -------
+    ndarray
+    """
+
+    x = np.array(x, dtype=float)
+    N = x.shape[-1]
+    assert N & (N-1)==0, "Length must be a power of 2."
+    shape = x.shape
+    
+    h = 1
+    while h<N:
+        x = x.reshape(shape[:-1]+(N//(2*h), 2, h))
+        a = x[...,0,:].copy()
+        x[...,0,:] += x[...,1,:]
+        x[...,1,:] = a - x[...,1,:]
+        h *= 2
+    return x.reshape(shape)
+
+def parity_corr(p):
+    """Correlations <prod_{j in S} s_j> for every subset S of spins given a probability
+    distribution over all states in {-1,1} basis.
+
+    Parameters
+    ----------
+    p : ndarray
+        Probabilities of all 2^n states ordered as in bin_states(n, sym=True).
+
+    Returns
+    -------
+    ndarray
+        Correlation for each subset S indexed by bit mask m where spin j corresponds to
+        bit n-1-j as in the ordering of states. Use parity_index to select orders.
+    """
+
+    n = int(np.log2(p.size))
+    assert 2**n==p.size
+    
+    # spin j is -1 when its bit is 0, so complement bits contribute a sign for each spin
+    H = fwht(p)
+    m = np.arange(2**n)
+    sign = np.ones(2**n)
+    for j in range(n):
+        sign[(m>>j)&1==1] *= -1
+    return sign * H
+
+def sample_parity_corr(X):
+    """Correlations of every order for data samples as in parity_corr by transforming the
+    empirical distribution over states.
+
+    Parameters
+    ----------
+    X : ndarray
+        (n_samples, n) in {-1,1} basis.
+
+    Returns
+    -------
+    ndarray
+        Correlation for each subset indexed by bit mask.
+    """
+    
+    n = X.shape[1]
+    ix = ((X>0).astype(np.int64) * (2**np.arange(n-1,-1,-1))[None,:]).sum(1)
+    return parity_corr(np.bincount(ix, minlength=2**n) / len(X))
+
+def parity_index(n, k):
+    """Bit masks of all order k subsets of n spins in the same order as
+    itertools.combinations such that parity_corr(p)[parity_index(n,k)] is the same as
+    k_corr(allStates, k, weights=p).
+
+    Parameters
+    ----------
+    n : int
+    k : int
+
+    Returns
+    -------
+    ndarray
+    """
+
+    if k==0:
+        return np.zeros(1, dtype=np.int64)
+    comb = np.array(list(combinations(range(n), k)))
+    return (2**(n-1-comb)).sum(1)
+
+def two_sum(a, b):
+    """Error-free transformation of a sum such that a+b = s+e exactly.
+
+    Parameters
+    ----------
+    a : ndarray
+    b : ndarray
+
+    Returns
+    -------
+    ndarray
+        Floating point sum s.
+    ndarray
+        Rounding error e.
+    """
+
+    s = a + b
+    bb = s - a
+    return s, (a - (s - bb)) + (b - bb)
+
+def two_prod(a, b):
+    """Error-free transformation of a product such that a*b = p+e exactly using Dekker's
+    splitting.
+
+    Parameters
+    ----------
+    a : ndarray
+    b : ndarray
+
+    Returns
+    -------
+    ndarray
+        Floating point product p.
+    ndarray
+        Rounding error e.
+    """
+
+    def split(x, factor=2.**27+1):
+        c = factor * x
+        hi = c - (c - x)
+        return hi, x - hi
+
+    p = a * b
+    ahi, alo = split(a)
+    bhi, blo = split(b)
+    return p, ((ahi*bhi - p) + ahi*blo + alo*bhi) + alo*blo
+
+def dd_sum(x, axis=-1):
+    """Sum in double-double precision by pairwise reduction with error-free additions.
+    The result is as accurate as if the sum were computed with twice the working
+    precision and then rounded.
+
+    Parameters
+    ----------
+    x : ndarray
+    axis : int, -1
+
+    Returns
+    -------
+    ndarray or float
+    """
+
+    hi = np.moveaxis(np.asarray(x, dtype=float), axis, 0)
+    if len(hi)==0:
+        return np.zeros(hi.shape[1:])[()]
+    lo = np.zeros_like(hi)
+
+    while len(hi)>1:
+        if len(hi)%2:
+            hi = np.concatenate((hi, np.zeros_like(hi[:1])))
+            lo = np.concatenate((lo, np.zeros_like(lo[:1])))
+        hi, e = two_sum(hi[0::2], hi[1::2])
+        lo = lo[0::2] + lo[1::2] + e
+    return (hi[0] + lo[0])[()]
+
+def dd_residual(A, x, b):
+    """Residual b - A.x with products and sums computed in double-double precision.
+
+    Parameters
+    ----------
+    A : ndarray
+    x : ndarray
+    b : ndarray
+
+    Returns
+    -------
+    ndarray
+    """
+
+    p, e = two_prod(A, x[None,:])
+    return dd_sum(np.concatenate((b[:,None], -p, -e), axis=1), axis=1)
+
+def refined_solve(A, b, n_iter=5):
+    """Solve A.x = b with an LU decomposition followed by iterative refinement, where
+    each residual is computed in double-double precision. For matrices that are not too
+    badly conditioned (cond(A) << 1e16), this recovers a solution that is accurate to
+    float64 precision instead of to cond(A) times float64 precision.
+
+    Parameters
+    ----------
+    A : ndarray
+    b : ndarray
+    n_iter : int, 5
+        Max number of refinement steps.
+
+    Returns
+    -------
+    ndarray
+    """
+
+    from scipy.linalg import lu_factor, lu_solve
+
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float)
+    lu = lu_factor(A, check_finite=False)
+    x = lu_solve(lu, b)
+    for i in range(n_iter):
+        dx = lu_solve(lu, dd_residual(A, x, b))
+        x = x + dx
+        if (np.abs(dx)<=np.finfo(float).eps*np.abs(x)).all():
+            break
+    return x
+
+def expm1mx(x):
+    """exp(x) - 1 - x without the loss of precision for small x.
+
+    Parameters
+    ----------
+    x : ndarray
+
+    Returns
+    -------
+    ndarray
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.array(np.expm1(x) - x)
+    small = np.abs(x)<.1
+    xs = x[small]
+    # Taylor series from the x^2 term in Horner form
+    series = np.zeros_like(xs)
+    for k in range(16, 1, -1):
+        series = (series + 1) * xs / k
+    y[small] = series * xs
+    return y[()]
+
+def segment_sum(x, invix, n_segments=None):
+    """Sum rows of x within the segments labeled by invix with a single sort and a
+    reduction over contiguous blocks.
+
+    Parameters
+    ----------
+    x : ndarray
+        (n_samples, ...)
+    invix : ndarray
+        Segment label of each row in 0, ..., n_segments-1.
+    n_segments : int, None
+        By default, one more than the largest label.
+
+    Returns
+    -------
+    ndarray
+        (n_segments, ...) with zeros for empty segments.
+    """
+
+    x = np.asarray(x, dtype=float)
+    invix = np.asarray(invix, dtype=np.int64)
+    if n_segments is None:
+        n_segments = invix.max() + 1
+    order = np.argsort(invix, kind='stable')
+    bounds = np.searchsorted(invix[order], np.arange(n_segments))
+    nonempty = np.bincount(invix, minlength=n_segments)>0
+
+    out = np.zeros((n_segments,)+x.shape[1:])
+    out[nonempty] = np.add.reduceat(x[order], bounds[nonempty], axis=0)
+    return out
+
+def segment_dd_sum(x, invix, n_segments=None, order=None):
+    """Sum elements of x within the segments labeled by invix in double-double precision
+    as with dd_sum. Elements are sorted by segment once and laid out as the rows of a
+    zero-padded matrix such that all segments are summed with a single pairwise
+    reduction.
+
+    Parameters
+    ----------
+    x : ndarray
+    invix : ndarray
+        Segment label of each element in 0, ..., n_segments-1.
+    n_segments : int, None
+        By default, one more than the largest label.
+    order : ndarray, None
+        np.argsort(invix, kind='stable') if it has been precomputed.
+
+    Returns
+    -------
+    ndarray
+        (n_segments,) with zeros for empty segments.
+    """
+
+    invix = np.asarray(invix, dtype=np.int64)
+    if n_segments is None:
+        n_segments = invix.max() + 1
+    if order is None:
+        order = np.argsort(invix, kind='stable')
+    counts = np.bincount(invix, minlength=n_segments)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sortedix = invix[order]
+    
+    padded = np.zeros((n_segments, max(counts.max(), 1)))
+    padded[sortedix, np.arange(invix.size)-starts[sortedix]] = np.asarray(x, dtype=float)[order]
+    return dd_sum(padded, axis=1)
+
+def directional_dlogpk(logp, dE, invix, n_bins=None, eps=None):
+    """Rate of change in log2 p(k) for many perturbation directions at once, where the
+    log probability of each state changes as logp + eps*dE[:,d] (up to normalization)
+    along direction d.
+
+    In the analytic mode, the derivative is the difference between the average of dE
+    within each coarse-grained bin and its average over all states,
+        (<dE>_k - <dE>) / log(2).
+    Otherwise, the symmetric finite difference with step eps is returned.
+
+    Parameters
+    ----------
+    logp : ndarray
+        Log probability of each state.
+    dE : ndarray
+        (n_states, n_directions) change in log probability of each state.
+    invix : ndarray
+        Coarse-grained bin of each state.
+    n_bins : int, None
+    eps : float, None
+        If None, the analytic derivative is returned.
+
+    Returns
+    -------
+    ndarray
+        (n_bins, n_directions)
+    """
+
+    from coniii.enumerate import fast_logsumexp
+    
+    dE = np.asarray(dE, dtype=float)
+    if dE.ndim==1:
+        dE = dE[:,None]
+    logp = logp - fast_logsumexp(logp)[0]
+
+    if eps is None:
+        p = np.exp(logp)
+        pk = segment_sum(p, invix, n_bins)
+        avgdE = segment_sum(p[:,None]*dE, invix, n_bins) / pk[:,None]
+        return (avgdE - p.dot(dE)[None,:]) / np.log(2)
+    
+    logpk = []
+    for sign in (1, -1):
+        E = logp[:,None] + sign * eps * dE
+        E -= E.max(0)[None,:]
+        pk = segment_sum(np.exp(E), invix, n_bins)
+        logpk.append(np.log2(pk) - np.log2(pk.sum(0))[None,:])
+    return (logpk[0] - logpk[1]) / (2*eps)
     
 def coarse_grain(X, nbins, sortix=None, method='maj', params=()):
     """Coarse-grain given votes into n bins by using specified coarse-graining method. If
@@ -868,3 +1283,88 @@ def degree_collective_exp(rate, n=9):
     r2 = np.nansum(-p*np.log2(p))/np.log2(p.size)
     
     return r1,r2
+
+
+
+# ======= #
+# Classes #
+# ======= #
+class ParameterCache():
+    """Small least-recently-used cache for quantities that are expensive to compute from
+    model parameters such as the energies of all states and the partition function.
+    
+    Entries are keyed on a hash of the contents of the parameter vector (and of any other
+    arrays that the quantities depend on), so changing the parameters automatically
+    misses the cache. Cached values are not pickled.
+    """
+    def __init__(self, maxsize=4):
+        """
+        Parameters
+        ----------
+        maxsize : int, 4
+        """
+
+        assert maxsize>=1
+        self.maxsize = maxsize
+        self._cache = {}
+
+    @staticmethod
+    def key(*arrays):
+        """Hash of the contents, dtypes, and shapes of the given arrays.
+
+        Parameters
+        ----------
+        *arrays : ndarray
+
+        Returns
+        -------
+        str
+        """
+        
+        import hashlib
+
+        h = hashlib.sha1()
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            h.update(repr((a.dtype.str, a.shape)).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def get(self, f, *arrays):
+        """Value of f() memoized on the contents of the given arrays.
+
+        Parameters
+        ----------
+        f : function
+            Takes no arguments.
+        *arrays : ndarray
+
+        Returns
+        -------
+        object
+        """
+
+        key = self.key(*arrays)
+        if key in self._cache:
+            # move to the end as the most recently used
+            value = self._cache.pop(key)
+        else:
+            value = f()
+        self._cache[key] = value
+
+        while len(self._cache)>self.maxsize:
+            del self._cache[next(iter(self._cache))]
+        return value
+
+    def clear(self):
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __getstate__(self):
+        return {'maxsize':self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+#end ParameterCache